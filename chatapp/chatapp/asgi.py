@@ -14,3 +14,12 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
 
 application = get_asgi_application()
+
+# Load the suggestion model in the background instead of on the first
+# /suggest/ request
+from django.conf import settings
+
+if settings.SUGGEST_WARMUP:
+    from firebase import suggester
+
+    suggester.warm_up()
@@ -0,0 +1,35 @@
+"""Counters exported by the caches, pools and queues across the project.
+
+Each subsystem registers a zero-argument callable returning a dict;
+``/stats/`` returns all of them as one JSON document. It needs
+``Authorization: Bearer <STATS_TOKEN>``; without a token configured it only
+answers requests from the machine itself.
+"""
+import hmac
+
+from django.conf import settings
+from django.http import JsonResponse
+
+_sources = {}
+
+
+def register(name, source):
+    _sources[name] = source
+
+
+def snapshot():
+    return {name: source() for name, source in _sources.items()}
+
+
+def allowed(request):
+    token = getattr(settings, "STATS_TOKEN", None)
+    if token:
+        given = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        return hmac.compare_digest(given.encode(), str(token).encode())
+    return request.META.get("REMOTE_ADDR") in ("127.0.0.1", "::1")
+
+
+def stats(request):
+    if not allowed(request):
+        return JsonResponse({"error": "Forbidden"}, status=403)
+    return JsonResponse(snapshot())
@@ -0,0 +1,306 @@
+"""Pooled HTTP clients for the services the project calls out to.
+
+One ``requests.Session`` per upstream, created on first use and kept for
+the life of the process, so calls reuse kept-alive connections instead
+of paying a TCP + TLS handshake each time. Every upstream has its own
+settings in ``OUTBOUND`` (merged over ``DEFAULTS``):
+
+- ``BASE_URL``: where the upstream lives; point it at a local stand-in
+  for tests (``override()`` does that at runtime)
+- ``POOL``: connections kept open to it per process
+- ``CONNECT_TIMEOUT`` / ``READ_TIMEOUT``: applied unless a call passes
+  its own ``timeout``
+- ``RETRIES``: retries on failed connects and on 429/503, with
+  full-jitter exponential backoff from ``BACKOFF`` seconds, or after the
+  ``Retry-After`` seconds a 429/503 asks for. A request
+  that reached the upstream and timed out is never retried, so a POST
+  is not repeated after the upstream may already have acted on it.
+
+``async_client(name)`` is the same for async views: an ``httpx``
+``AsyncClient`` per upstream and event loop, with the same pool size,
+timeouts and retry rules, recording into the same per-upstream stats.
+
+Per-upstream call counts, errors and latency percentiles are in
+``/stats/`` under ``upstreams``.
+"""
+import asyncio
+import contextlib
+import random
+import threading
+import time
+import weakref
+from collections import deque
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from chatapp import metrics
+
+DEFAULTS = {
+    "identitytoolkit": {
+        "BASE_URL": "https://identitytoolkit.googleapis.com",
+        "POOL": 10,
+        "CONNECT_TIMEOUT": 3.05,
+        "READ_TIMEOUT": 10,
+        "RETRIES": 2,
+    },
+    "openrouter": {
+        "BASE_URL": "https://openrouter.ai/api/v1",
+        "POOL": 20,
+        "CONNECT_TIMEOUT": 3.05,
+        "READ_TIMEOUT": 60,
+        "RETRIES": 1,
+    },
+    "ollama": {
+        "BASE_URL": "http://127.0.0.1:11434",
+        "POOL": 8,
+        "CONNECT_TIMEOUT": 1,
+        "READ_TIMEOUT": 30,
+        "RETRIES": 0,
+    },
+}
+RETRY_STATUSES = (429, 503)  # refused before any work was done
+
+
+class JitteredRetry(Retry):
+    def get_backoff_time(self):
+        # Full jitter: spread retries from many workers instead of syncing them
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff else 0
+
+
+class UpstreamStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = self.errors = 0
+        self.outcomes = {}
+        self._latencies = deque(maxlen=2048)
+
+    def record(self, started, outcome):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.calls += 1
+            if outcome in ("error", "5xx"):
+                self.errors += 1
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self._latencies.append(elapsed)
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        percentile = lambda p: round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "outcomes": dict(self.outcomes),
+            "p50_ms": percentile(0.5) if latencies else None,
+            "p95_ms": percentile(0.95) if latencies else None,
+            "p99_ms": percentile(0.99) if latencies else None,
+        }
+
+
+def _retry_after(response):
+    # Seconds a 429/503 asked us to wait (HTTP dates are left to the backoff)
+    try:
+        return max(float(response.headers["Retry-After"]), 0)
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+
+def _url(base_url, path):
+    if path.startswith(("http://", "https://")):
+        return path
+    return f"{base_url}/{path.lstrip('/')}"
+
+
+class Upstream:
+    def __init__(self, name, base_url, pool=10, connect_timeout=3.05, read_timeout=30, retries=1, backoff=0.3):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.stats = _stats_for(name)
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        retry = JitteredRetry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,  # POST too: only connects and refusals are retried
+            backoff_factor=backoff,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, _url(self.base_url, path), **kwargs)
+        except requests.RequestException:
+            self.stats.record(started, "error")
+            raise
+        self.stats.record(started, f"{response.status_code // 100}xx")
+        return response
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncUpstream:
+    def __init__(self, name, base_url, pool=10, connect_timeout=3.05, read_timeout=30, retries=1, backoff=0.3):
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("Async views need httpx (pip install httpx)") from e
+
+        self._httpx = httpx
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.stats = _stats_for(name)
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool, max_keepalive_connections=pool),
+        )
+
+    async def request(self, method, path, **kwargs):
+        url = _url(self.base_url, path)
+        for attempt in range(self.retries + 1):
+            response = None
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except self._httpx.ConnectError:
+                self.stats.record(started, "error")
+                if attempt == self.retries:
+                    raise
+            except self._httpx.HTTPError:
+                self.stats.record(started, "error")
+                raise  # may have reached the upstream; never repeated
+            else:
+                self.stats.record(started, f"{response.status_code // 100}xx")
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+            delay = _retry_after(response)
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt) if delay is None else delay)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, path, **kwargs):
+        """``async with client.stream("POST", path, json=...) as response``; not retried."""
+        started = time.perf_counter()
+        try:
+            async with self.client.stream(method, _url(self.base_url, path), **kwargs) as response:
+                # Latency here is time to response headers
+                self.stats.record(started, f"{response.status_code // 100}xx")
+                yield response
+        except self._httpx.TransportError:
+            self.stats.record(started, "error")
+            raise
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    def close(self):
+        try:
+            asyncio.get_running_loop().create_task(self.client.aclose())
+        except RuntimeError:
+            pass  # its loop is gone, and its connections with it
+
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {name: AsyncUpstream}
+_overrides = {}
+_stats = {}  # name -> UpstreamStats, shared by the sync and async clients
+_lock = threading.Lock()
+_stats_lock = threading.Lock()
+
+
+def _stats_for(name):
+    with _stats_lock:
+        return _stats.setdefault(name, UpstreamStats())
+
+
+def config(name):
+    configured = getattr(settings, "OUTBOUND", {}) if settings.configured else {}
+    merged = {**DEFAULTS.get(name, {}), **configured.get(name, {}), **_overrides.get(name, {})}
+    if "BASE_URL" not in merged:
+        raise KeyError(f"No BASE_URL configured for upstream {name!r}")
+    return merged
+
+
+def _create(cls, name):
+    c = config(name)
+    return cls(
+        name,
+        c["BASE_URL"],
+        pool=c.get("POOL", 10),
+        connect_timeout=c.get("CONNECT_TIMEOUT", 3.05),
+        read_timeout=c.get("READ_TIMEOUT", 30),
+        retries=c.get("RETRIES", 1),
+        backoff=c.get("BACKOFF", 0.3),
+    )
+
+
+def client(name):
+    """The shared client for an upstream, e.g. ``client("openrouter").post("/chat/completions", ...)``."""
+    upstream = _clients.get(name)
+    if upstream is None:
+        with _lock:
+            upstream = _clients.get(name)
+            if upstream is None:
+                upstream = _clients[name] = _create(Upstream, name)
+    return upstream
+
+
+def async_client(name):
+    """The async client for an upstream on the running event loop."""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        if name not in clients:
+            clients[name] = _create(AsyncUpstream, name)
+        return clients[name]
+
+
+def reset(name=None):
+    """Drop pooled clients (all, or one) so the next call picks up new settings."""
+    with _lock:
+        for clients in [_clients, *_async_clients.values()]:
+            for key in [name] if name else list(clients):
+                upstream = clients.pop(key, None)
+                if upstream is not None:
+                    upstream.close()
+
+
+def override(name, **values):
+    """Point an upstream somewhere else at runtime, e.g. ``override("ollama", BASE_URL=stub_url)``."""
+    _overrides.setdefault(name, {}).update(values)
+    reset(name)
+
+
+def _on_setting_changed(setting, **kwargs):
+    if setting == "OUTBOUND":
+        reset()
+
+
+setting_changed.connect(_on_setting_changed)
+metrics.register("upstreams", lambda: {
+    name: dict(stats.snapshot(), base_url=config(name)["BASE_URL"]) for name, stats in list(_stats.items())
+})
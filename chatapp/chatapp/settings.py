@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -135,4 +136,193 @@ CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:5000",
 ]
 
-CORS_ALLOW_CREDENTIALS = True
\ No newline at end of file
+CORS_ALLOW_CREDENTIALS = True
+
+# Route signup/login/bot/store/fetch_data/suggest to the async views
+# (*/async_views.py). Only worth it under an ASGI server (chatapp/asgi.py);
+# ENCODE_THREADS is the pool the suggestion encode runs on off the loop.
+ASYNC_VIEWS = {
+    'ENABLED': False,
+    'ENCODE_THREADS': 4,
+}
+
+# /stats/ (see chatapp/metrics.py) needs "Authorization: Bearer <STATS_TOKEN>";
+# left unset, only requests from localhost get the counters.
+STATS_TOKEN = os.environ.get('STATS_TOKEN')
+
+# Outbound HTTP clients (see chatapp/outbound.py). Each entry is merged over
+# the defaults there; set BASE_URL to a local stand-in to test offline.
+OUTBOUND = {
+    'identitytoolkit': {'POOL': 10, 'READ_TIMEOUT': 10, 'RETRIES': 2},
+    'openrouter': {'POOL': 20, 'READ_TIMEOUT': 60, 'RETRIES': 1},
+    'ollama': {'BASE_URL': 'http://127.0.0.1:11434', 'POOL': 8, 'READ_TIMEOUT': 30, 'RETRIES': 0},
+}
+
+# /bot/ answers (see login/bot_cache.py): cached per normalized question for
+# TTL seconds (MAX_ENTRIES 0 turns the cache off), one OpenRouter call per
+# question in flight, and at most MAX_CONCURRENT calls at once with up to
+# MAX_QUEUE more waiting QUEUE_TIMEOUT seconds for a slot before a 503.
+# SIMILARITY_THRESHOLD (e.g. 0.92) also reuses the answer to a cached
+# question embedded at least that close (with the suggestion encoder).
+BOT_CACHE = {
+    'MAX_ENTRIES': 2000,
+    'TTL': 24 * 3600,
+    'SIMILARITY_THRESHOLD': None,
+    'MAX_CONCURRENT': 8,
+    'MAX_QUEUE': 32,
+    'QUEUE_TIMEOUT': 10,
+}
+# Multi-turn /bot/ for signed-in users (see login/bot_memory.py): the newest
+# exchanges verbatim up to HISTORY_TOKENS, older ones folded into a summary
+# of at most SUMMARY_TOKENS by a background thread. Sessions are per process.
+# Off by default: an answer that depends on the conversation so far cannot
+# come from BOT_CACHE, so with memory on only a user's first turn is cached.
+BOT_MEMORY = {
+    'ENABLED': False,
+    'HISTORY_TOKENS': 1500,
+    'SUMMARY_TOKENS': 300,
+    'SUMMARY_MODEL': 'gpt-oss-20b',
+    'MAX_USERS': 10_000,
+    'IDLE_TTL': 3600,
+}
+
+# OTP emails (see login/otp_delivery.py): login only queues them; WORKERS
+# background threads send them in batches of up to BATCH over SMTP sessions
+# they keep authenticated, retrying temporary failures RETRIES times. For
+# tests point HOST/PORT at a local sink, e.g. `python -m aiosmtpd -n -l
+# localhost:1025` with STARTTLS False and USERNAME None. /otp/status/?id=
+# reports on the last HISTORY deliveries.
+OTP_EMAIL = {
+    'HOST': 'smtp.gmail.com',
+    'PORT': 587,
+    'STARTTLS': True,
+    'USERNAME': 'abcdef@gmail.com',
+    'PASSWORD': '',
+    'FROM': 'abcdef@gmail.com',
+    'WORKERS': 2,
+    'BATCH': 20,
+    'RETRIES': 4,
+    'BACKOFF': 1.0,
+    'TIMEOUT': 10,
+    'MAX_MESSAGES_PER_CONNECTION': 100,
+    'IDLE_TIMEOUT': 60,
+    'HISTORY': 10_000,
+}
+
+# Chat storage
+# "merge" appends with a single upsert; "transaction" assigns gap-free
+# integer sequence numbers at the cost of one extra read per message.
+CHAT_APPEND_MODE = "merge"
+# "array" keeps every message in the conversation document's `data` array;
+# "messages" stores one document per message (see `manage.py migrate_chats`).
+CHAT_STORAGE_LAYOUT = "array"
+
+# Read-through cache for fetch_data, keyed by (owner email, contact).
+# SHARED_ALIAS names an entry in CACHES (e.g. Redis) shared by all workers.
+# Without it a worker never hears of appends made by the others, so entries
+# only live LOCAL_TTL seconds; set it whenever more than one worker runs.
+CHAT_CACHE = {
+    "MAX_ENTRIES": 1024,
+    "TTL": 300,
+    "LOCAL_TTL": 5,
+    "SHARED_ALIAS": None,
+}
+
+# Write-behind mode for add_message: messages are spooled to disk and
+# committed to Firestore in batches by a background thread. A conversation
+# whose commit keeps failing is retried with backoff from RETRY_BACKOFF
+# seconds, then dead-lettered after MAX_ATTEMPTS.
+CHAT_WRITE_BEHIND = {
+    "ENABLED": False,
+    "MAX_BATCH": 400,
+    "FLUSH_INTERVAL": 0.5,
+    "SPOOL_DIR": BASE_DIR / "spool",
+    "FSYNC": False,
+    "MAX_ATTEMPTS": 8,
+    "RETRY_BACKOFF": 1.0,
+}
+
+
+# Reply suggestions
+# `manage.py build_suggest_index` encodes SUGGEST_CORPUS into SUGGEST_INDEX_DIR;
+# workers memory-map the result instead of encoding on startup.
+SUGGEST_CORPUS = BASE_DIR / 'firebase' / 'chats.csv'
+SUGGEST_INDEX_DIR = BASE_DIR / 'firebase' / 'index'
+# Build a missing or stale index in the worker that needs it (one worker at
+# a time). Set False in production so only the command builds it and a
+# worker without a current index fails fast.
+SUGGEST_INDEX_AUTO_BUILD = True
+# "sklearn" and "numpy" are exact; "hnsw" is approximate and needs hnswlib;
+# "hybrid" takes TF-IDF candidates and re-ranks only those with embeddings.
+# See `manage.py suggest_index_report` for which to use at which corpus size.
+SUGGEST_INDEX_BACKEND = 'numpy'
+# e.g. {'m': 16, 'ef_construction': 200, 'ef_search': 64} for hnsw, or
+# {'candidates': 300, 'lexical_weight': 0.3, 'semantic_weight': 0.7, 'fallback': 'hnsw'} for hybrid
+SUGGEST_INDEX_OPTIONS = {}
+# Concurrent /suggest/ calls arriving within MAX_WAIT_MS are encoded and
+# searched as one batch of up to MAX_BATCH inputs.
+SUGGEST_BATCH = {
+    'ENABLED': True,
+    'MAX_BATCH': 32,
+    'MAX_WAIT_MS': 5,
+    'TIMEOUT': 10,
+}
+# Final suggestion lists (in-process LRU) and input embeddings (SQLite,
+# shared across workers and restarts). Both reset when the index is rebuilt.
+SUGGEST_CACHE = {
+    'MAX_ENTRIES': 10000,
+    'TTL': 3600,
+    'EMBEDDING_PATH': SUGGEST_INDEX_DIR / 'query-embeddings.sqlite3',
+    'EMBEDDING_MAX_ENTRIES': 100000,
+    'EMBEDDING_TTL': None,
+}
+# 'torch' runs the fp32 SentenceTransformer; 'onnx' runs the int8 model from
+# `manage.py export_onnx_encoder` (check it with `check_encoder_parity` first).
+SUGGEST_ENCODER = {
+    'BACKEND': 'torch',
+    'ONNX_DIR': SUGGEST_INDEX_DIR / 'onnx-int8',
+    'THREADS': 1,
+}
+# How many turns /suggest/ looks at (the newest message included) and how
+# fast older turns fade when their embeddings are pooled
+SUGGEST_CONTEXT = {
+    'TURNS': 4,
+    'DECAY': 0.5,
+}
+# Ask the LLM in suggest.py (Ollama) alongside KNN. /suggest/ waits for it
+# at most DEADLINE_MS from the start of the request, then answers with KNN
+# alone; MERGE puts on-time LLM suggestions first and fills up with KNN.
+SUGGEST_LLM = {
+    'ENABLED': False,
+    'DEADLINE_MS': 300,
+    'MERGE': True,
+    'MAX_WORKERS': 4,
+    'MODEL': 'llama3',
+}
+# The suggestion model and index load on the first /suggest/ call; set this
+# to load them in the background as soon as a web worker starts instead.
+SUGGEST_WARMUP = False
+# Set SOCKET (e.g. '/run/chatapp/suggest.sock') to serve /suggest/ from
+# `manage.py run_suggest_service` instead of loading the model in Django.
+SUGGEST_SERVICE = {
+    'SOCKET': None,
+    'WORKERS': 2,
+    'THREADS': 8,
+    'MAX_INFLIGHT': 64,
+    'TIMEOUT': 2.0,
+}
+# Learn (message, reply) pairs from chats stored through add_message and
+# add them to the live suggestion index without a rebuild. INTERVAL is how
+# often (seconds) mined pairs are written and picked up; the pair log is
+# compacted once tombstones pass COMPACT_RATIO of the live pairs.
+# Learned pairs are suggested to all users, so text from one user's private
+# chats can be offered to another: learning also needs SHARE_ACROSS_USERS.
+SUGGEST_LEARNING = {
+    'ENABLED': False,
+    'SHARE_ACROSS_USERS': False,
+    'PATH': SUGGEST_INDEX_DIR / 'learned_pairs.ndjson',
+    'INTERVAL': 30,
+    'BATCH': 64,
+    'MAX_LENGTH': 500,
+    'COMPACT_RATIO': 0.3,
+}
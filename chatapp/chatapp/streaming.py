@@ -0,0 +1,44 @@
+"""Streaming responses: Server-Sent Events or NDJSON over StreamingHttpResponse.
+
+Views produce plain dicts; ``response(events, fmt)`` frames them as
+``data: {...}\\n\\n`` (``fmt="sse"``, the default) or one JSON object per
+line (``fmt="ndjson"``). ``events`` may be a generator or an async
+generator. Either way, when the client goes away Django closes it (sync)
+or cancels it (async), so a ``finally`` in the generator is the place to
+close the upstream connection.
+"""
+import json
+
+from django.http import StreamingHttpResponse
+
+FORMATS = {
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def encode(event, fmt="sse"):
+    data = json.dumps(event, ensure_ascii=False)
+    return f"data: {data}\n\n" if fmt == "sse" else f"{data}\n"
+
+
+def response(events, fmt="sse"):
+    fmt = fmt if fmt in FORMATS else "sse"
+    if hasattr(events, "__aiter__"):
+        async def body():
+            try:
+                async for event in events:
+                    yield encode(event, fmt)
+            finally:
+                await events.aclose()
+    else:
+        def body():
+            try:
+                for event in events:
+                    yield encode(event, fmt)
+            finally:
+                events.close()
+    resp = StreamingHttpResponse(body(), content_type=FORMATS[fmt])
+    resp["Cache-Control"] = "no-cache"
+    resp["X-Accel-Buffering"] = "no"  # nginx would otherwise buffer the whole stream
+    return resp
@@ -14,20 +14,34 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
+from chatapp import metrics
 from login import views
 from firebase import views as v
 
+# Under ASGI the I/O-bound views can run natively async instead
+if settings.ASYNC_VIEWS.get("ENABLED"):
+    from login import async_views as auth_views
+    from firebase import async_views as chat_views
+else:
+    auth_views, chat_views = views, v
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     # path('',views.home,name='home'),
-    path('signup/', views.signup, name='signup'),
-    path('login/', views.login, name='login'),
-    path('store/', v.add_message, name='store'),
-    path('fetch_data/', v.fetch_data, name='fetch_data'),
+    path('signup/', auth_views.signup, name='signup'),
+    path('login/', auth_views.login, name='login'),
+    path('store/', chat_views.add_message, name='store'),
+    path('import/', v.bulk_import, name='import'),
+    path('export/', v.export_chats, name='export'),
+    path('fetch_data/', chat_views.fetch_data, name='fetch_data'),
     path('otp/', views.send_otp, name='otp'),
+    path('otp/status/', views.otp_status, name='otp_status'),
     path('check_otp/', views.check_otp, name='check_otp'),
-    path('bot/', views.bot, name='bot'),
-    path("suggest/", v.suggest_reply, name="get_suggestions"),
+    path('bot/', auth_views.bot, name='bot'),
+    path("suggest/", chat_views.suggest_reply, name="get_suggestions"),
+    path("suggest/ready/", v.suggest_ready, name="suggest_ready"),
+    path("stats/", metrics.stats, name="stats"),
 ]
@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
 
 application = get_wsgi_application()
+
+# Load the suggestion model in the background instead of on the first
+# /suggest/ request
+from django.conf import settings
+
+if settings.SUGGEST_WARMUP:
+    from firebase import suggester
+
+    suggester.warm_up()
@@ -0,0 +1,171 @@
+"""Async versions of the chat views, for ASGI deployments.
+
+urls.py routes to these instead of views.py when ``ASYNC_VIEWS["ENABLED"]``
+is set. They behave exactly like their sync counterparts, but Firestore
+calls go through storage_async.py and the CPU-bound suggestion encode runs
+on a small thread pool, so while a request waits the worker serves others.
+"""
+import asyncio
+import contextlib
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from chatapp import streaming
+from . import learning, llm_suggest, storage, storage_async, suggest_service, suggester
+from .cache import conversations
+from .views import context_turns, turn_texts
+from .writebehind import buffer as write_behind
+
+_encode_pool = ThreadPoolExecutor(
+    getattr(settings, "ASYNC_VIEWS", {}).get("ENCODE_THREADS", 4), thread_name_prefix="suggest-encode"
+)
+
+
+async def load_conversation(email, selected, limit=None):
+    # Pending first: a message committed in between is then in one or both, never neither
+    pending = write_behind.pending(email, selected) if write_behind is not None else []
+    if limit is None:
+        messages = await storage_async.read_messages(email, selected)
+    else:
+        page = await storage_async.read_page(email, selected, limit=limit)
+        messages = None if page is None else page[0]
+    if pending:
+        # Show queued messages that have not been flushed yet
+        messages = storage.merge_pending(messages, pending)
+    return messages
+
+
+@csrf_exempt
+async def add_message(request):
+    if request.method == "POST":
+        try:
+            body = json.loads(request.body)
+            selected = body.get("selected")
+            message = body.get("messages")
+
+            email = request.COOKIES.get("email")
+            if not email:
+                return JsonResponse({"success": False, "error": "Email cookie not found"})
+            email = unquote(str(email))
+
+            if write_behind is not None:
+                # Sequence numbers are only known once the batch commits
+                seq = None
+                # enqueue fsyncs the spool: not on the event loop
+                message = await sync_to_async(write_behind.enqueue, thread_sensitive=False)(email, selected, message)
+            else:
+                seq, message = await storage_async.append_message(email, selected, message)
+            await conversations.aappend(email, selected, message)
+            learning.observe(email, selected, message)
+
+            # Old clients still expect the whole conversation back
+            if body.get("echo"):
+                document = {"data": await conversations.aget_or_load(
+                    email, selected, lambda: load_conversation(email, selected))}
+                return JsonResponse({"success": True, "id": message.get("id"), "seq": seq, "document": document})
+            return JsonResponse({"success": True, "id": message.get("id"), "seq": seq, "queued": write_behind is not None})
+
+        except Exception as e:
+            print("Error:", e)
+            return JsonResponse({"success": False, "error": str(e)})
+
+
+@csrf_exempt
+async def fetch_data(request):
+    if request.method == "POST":
+        try:
+            email = request.COOKIES.get("email")
+            if not email:
+                return JsonResponse({"success": False, "error": "Email cookie not found"})
+            email = unquote(str(email))
+            body = json.loads(request.body)
+            selected = body.get("selected")
+            if not selected:
+                return JsonResponse({"success": False, "error": "Selected contact not provided"})
+            limit, before, since = body.get("limit"), body.get("before"), body.get("since")
+            if limit is None and before is None and since is None:
+                messages = await conversations.aget_or_load(
+                    email, selected, lambda: load_conversation(email, selected))
+                page = None if messages is None else (messages, None)
+            else:
+                cached = await conversations.aget(email, selected)
+                if cached is not None:
+                    page = storage.paginate(cached, storage.page_limit(limit), before, since)
+                else:
+                    page = await storage_async.read_page(email, selected, limit=limit, before=before, since=since)
+            if page is None:
+                return JsonResponse({"success": False, "error": "No chat found with this contact"})
+            messages, next_cursor = page
+            return JsonResponse({"success": True, "data": {"data": messages}, "next_cursor": next_cursor})
+        except Exception as e:
+            print("Error:", e)
+            return JsonResponse({"success": False, "error": str(e)})
+
+
+async def suggestion_context(request, body, user_input):
+    history = body.get("history")
+    email = request.COOKIES.get("email")
+    email = unquote(str(email)) if email else None
+    if history is None and body.get("selected") and email:
+        selected = body["selected"]
+        history = await conversations.aget(email, selected)
+        if history is None:
+            history = await load_conversation(email, selected, limit=settings.SUGGEST_CONTEXT.get("TURNS", 4) + 1)
+    return context_turns(history, user_input, email)
+
+
+async def suggestion_events(user_input, context, knn):
+    yield {"source": "knn", "suggestions": knn}
+    if llm_suggest.enabled():
+        try:
+            async with contextlib.aclosing(llm_suggest.get_suggester().astream(user_input, context)) as suggestions:
+                async for suggestion in suggestions:
+                    yield {"source": "llm", "suggestion": suggestion}
+        except Exception as e:
+            yield {"source": "llm", "error": str(e)}
+    yield {"done": True}
+
+
+@csrf_exempt
+async def suggest_reply(request):
+    if request.method == "POST":
+        try:
+            body = json.loads(request.body)
+            user_input = body.get("message")
+            if not user_input:
+                return JsonResponse({"error": "No input provided"}, status=400)
+
+            started = time.monotonic()
+            context = await suggestion_context(request, body, user_input)
+            if body.get("stream"):
+                knn = await asyncio.get_running_loop().run_in_executor(
+                    _encode_pool, lambda: suggester.get_replies(user_input, top_k=5, context=turn_texts(context)))
+                return streaming.response(suggestion_events(user_input, context, knn), body.get("format", "sse"))
+            llm = llm_suggest.get_suggester() if llm_suggest.enabled() else None
+            pending = llm.astart(user_input, context) if llm is not None else None
+            # Encoding is CPU-bound (or a blocking socket call with the
+            # suggestion service); keep it off the event loop
+            suggestions = await asyncio.get_running_loop().run_in_executor(
+                _encode_pool, lambda: suggester.get_replies(user_input, top_k=5, context=turn_texts(context)))
+            source = "knn"
+            if llm is not None:
+                suggestions, source = await llm.afinish(pending, suggestions, 5, started)
+            return JsonResponse({"input": user_input, "suggestions": suggestions, "source": source}, safe=False)
+        except suggest_service.ServiceBusy as e:
+            response = JsonResponse({"error": str(e)}, status=503)
+            response["Retry-After"] = "1"
+            return response
+        except suggest_service.ServiceTimeout as e:
+            return JsonResponse({"error": str(e)}, status=504)
+        except suggest_service.ServiceUnavailable as e:
+            return JsonResponse({"error": str(e)}, status=503)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+    return JsonResponse({"error": "POST required"}, status=405)
@@ -0,0 +1,76 @@
+"""Micro-batching for CPU-bound model calls.
+
+Request threads ``submit`` one item and block. A single worker thread
+takes the first waiting item, keeps collecting for up to ``max_wait_ms``
+or until ``max_batch`` items are in hand, runs the handler once on the
+whole batch, and hands each caller its own result. Under concurrency this
+turns many batch-size-1 forward passes into a few larger ones; the extra
+latency any request pays is bounded by ``max_wait_ms``.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    def __init__(self, handler, max_batch=32, max_wait_ms=5, name="micro-batcher"):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self.batches = self.items = self.failures = 0
+        self.largest = 0
+        self.wait_total = 0.0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item, timeout=None):
+        """Run ``item`` through the handler as part of a batch and return its result."""
+        future = Future()
+        self._queue.put((item, future, time.monotonic()))
+        return future.result(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            # A caller whose submit() timed out still gets a result set on
+            # its future; nobody reads it
+            try:
+                results = self.handler([item for item, _, _ in batch])
+            except Exception as e:
+                self.failures += 1
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            self.batches += 1
+            self.items += len(batch)
+            self.largest = max(self.largest, len(batch))
+            self.wait_total += sum(started - queued for _, _, queued in batch)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch": round(self.items / self.batches, 2) if self.batches else None,
+            "largest_batch": self.largest,
+            "mean_wait_ms": round(self.wait_total / self.items * 1000, 3) if self.items else None,
+            "queued": self._queue.qsize(),
+            "failures": self.failures,
+        }
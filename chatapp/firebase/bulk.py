@@ -0,0 +1,245 @@
+"""Bulk message import for chat backups and history migration.
+
+The request body is either NDJSON (one record per line) or a JSON array
+of records. Each record is ``{"selected": <contact>, "message": {...}}``;
+``"messages"`` is accepted too, as a single message like add_message
+takes or a list of them. The body is read in chunks and decoded one
+record at a time, and messages are committed in batches as they fill.
+
+Messages are deduped by id against what the conversation already holds,
+one conversation at a time: switching to another contact commits the
+batch and forgets the previous contact's ids. Memory is bounded by one
+record (``MAX_RECORD_SIZE``), one batch and one conversation's ids,
+however large the upload is. Backups from /export/ list each contact's
+messages together; interleaved contacts still import correctly, just with
+more commits and reads.
+
+In the messages layout a message without an id gets one derived from its
+content (``storage.content_id``), so importing the same file twice stores
+it once. That needs a timestamp: a message with neither id nor timestamp
+is stamped on import and stored again every time.
+"""
+import codecs
+import hashlib
+import json
+
+from . import storage
+
+CHUNK_SIZE = 64 * 1024
+MAX_REPORTED_FAILURES = 100
+MAX_RECORD_SIZE = 16 * 1024 * 1024
+
+
+class BulkImportError(ValueError):
+    pass
+
+
+def _chunks(stream, chunk_size=CHUNK_SIZE):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+            return
+        yield decoder.decode(data)
+
+
+def iter_records(stream, chunk_size=CHUNK_SIZE):
+    """Yield ``(position, record or exception)`` from an NDJSON or JSON array body."""
+    chunks = _chunks(stream, chunk_size)
+    buf = ""
+    for chunk in chunks:
+        buf += chunk
+        if buf.strip():
+            break
+    if buf.lstrip().startswith("["):
+        yield from _iter_array(buf[buf.index("[") + 1:], chunks)
+    else:
+        yield from _iter_lines(buf, chunks)
+
+
+def _too_large():
+    return BulkImportError(f"Record is longer than {MAX_RECORD_SIZE} characters")
+
+
+def _iter_lines(first, chunks):
+    line_no = 0
+    buf = ""
+    skipping = False  # in the rest of a line already reported as too large
+    for chunk in _with_eof(first, chunks):
+        if chunk is None:
+            lines, buf = [buf], ""
+        else:
+            buf += chunk
+            *lines, buf = buf.split("\n")
+        for line in lines:
+            line_no += 1
+            if skipping:
+                skipping = False
+                continue
+            if not line.strip():
+                continue
+            if len(line) > MAX_RECORD_SIZE:
+                yield line_no, _too_large()
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError as e:
+                yield line_no, e
+        if len(buf) > MAX_RECORD_SIZE:
+            # Don't hold an endless line: report it and drop it up to its newline
+            if not skipping:
+                yield line_no + 1, _too_large()
+                skipping = True
+            buf = ""
+
+
+def _iter_array(buf, chunks):
+    decoder = json.JSONDecoder()
+    index = 0
+    pos = 0
+    source = _with_eof("", chunks)
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        if pos < len(buf):
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except ValueError as e:
+                if eof or len(buf) - pos > MAX_RECORD_SIZE:
+                    yield index + 1, e
+                    return
+            else:
+                index += 1
+                yield index, record
+                continue
+        elif eof:
+            yield index + 1, BulkImportError("JSON array is not terminated")
+            return
+        # Need more input: drop what has been consumed and read on
+        chunk = next(source)
+        buf = buf[pos:]
+        pos = 0
+        if chunk is None:
+            eof = True
+        else:
+            buf += chunk
+
+
+def _with_eof(first, chunks):
+    if first:
+        yield first
+    yield from chunks
+    yield None
+
+
+def _message_key(message):
+    return hashlib.blake2b(str(message["id"]).encode(), digest_size=8).digest()
+
+
+class Importer:
+    def __init__(self, email, batch_messages=450):
+        self.email = email
+        self.batch_messages = batch_messages
+        self.current = None  # the conversation being imported; seen and buffer belong to it
+        self.seen = set()
+        self.buffer = []
+        self.report = {}
+        self.failures = []
+        self.failed = 0
+
+    def _conversation(self, selected):
+        if selected != self.current:
+            self.flush()
+            self.current = selected
+            self.seen = set()
+            if storage.storage_layout() != storage.MESSAGES:
+                # ArrayUnion only drops exact copies, so load what the
+                # array already holds. Per-message docs are checked against
+                # Firestore batch by batch in flush().
+                for message in storage.read_messages(self.email, selected) or []:
+                    if message.get("id"):
+                        self.seen.add(_message_key(message))
+        return self.report.setdefault(selected, {"imported": 0, "duplicates": 0, "failed": 0})
+
+    def fail(self, position, error, selected=None, count=1):
+        self.failed += count
+        if selected is not None:
+            self.report[selected]["failed"] += count
+        if len(self.failures) < MAX_REPORTED_FAILURES:
+            self.failures.append({"position": position, "selected": selected, "error": str(error)})
+
+    def add(self, position, record):
+        if isinstance(record, Exception):
+            return self.fail(position, record)
+        if not isinstance(record, dict) or not record.get("selected"):
+            return self.fail(position, "Record needs a selected contact")
+        selected = str(record["selected"])
+        messages = record.get("message", record.get("messages"))
+        if isinstance(messages, dict):
+            messages = [messages]
+        if not isinstance(messages, list) or not messages:
+            return self.fail(position, "Record has no message")
+
+        counts = self._conversation(selected)
+        for message in messages:
+            if not isinstance(message, dict):
+                self.fail(position, "Message must be an object", selected)
+                continue
+            if not message.get("id") and message.get("timestamp") and storage.storage_layout() == storage.MESSAGES:
+                # Otherwise it gets a fresh document id every time it is imported
+                message = dict(message, id=storage.content_id(message))
+            if message.get("id"):
+                key = _message_key(message)
+                if key in self.seen:
+                    counts["duplicates"] += 1
+                    continue
+                self.seen.add(key)
+            self.buffer.append(storage.prepare_message(message))
+        if len(self.buffer) >= self.batch_messages:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        selected, messages = self.current, self.buffer
+        self.buffer = []
+        counts = self.report[selected]
+        try:
+            if storage.storage_layout() == storage.MESSAGES:
+                # Rewriting a stored message would count it again
+                stored = storage.existing_ids(self.email, selected, [m["id"] for m in messages if m.get("id")])
+                if stored:
+                    counts["duplicates"] += sum(1 for m in messages if str(m.get("id")) in stored)
+                    messages = [m for m in messages if not m.get("id") or str(m["id"]) not in stored]
+            if messages:
+                storage.write_grouped({(self.email, selected): messages})
+        except Exception as e:
+            # Earlier batches of this flush may have landed; re-importing the
+            # same file stores them once (messages are deduped by id), except
+            # messages-layout ones that have neither id nor timestamp
+            self.fail(None, e, selected, len(messages))
+        else:
+            counts["imported"] += len(messages)
+
+    def result(self):
+        return {
+            "imported": sum(c["imported"] for c in self.report.values()),
+            "duplicates": sum(c["duplicates"] for c in self.report.values()),
+            "failed": self.failed,
+            "conversations": self.report,
+            "failures": self.failures,
+        }
+
+
+def import_messages(email, stream):
+    importer = Importer(email)
+    for position, record in iter_records(stream):
+        importer.add(position, record)
+    importer.flush()
+    return importer.result()
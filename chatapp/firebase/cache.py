@@ -0,0 +1,217 @@
+"""In-process caches for the firebase app.
+
+``LRUCache`` is a small size- and TTL-bounded LRU with hit/miss/eviction
+counters. ``ConversationCache`` puts one in front of Firestore for
+``fetch_data``, keyed by (owner email, contact). When ``SHARED_ALIAS``
+names an entry in Django's ``CACHES`` (Redis, memcached, ...) workers
+also share entries through it, and a per-conversation version number
+there keeps every worker's local copy honest after another worker
+appends. Without one nothing tells a worker about appends made by the
+others, so local entries then only live for ``LOCAL_TTL`` seconds.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from chatapp import metrics
+
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key, default=MISSING, validate=None):
+        """Return the live value for key, or default.
+
+        ``validate`` can reject a value that is present but stale; it is
+        dropped and counted as a miss.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            if validate is not None and not validate(value):
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=MISSING):
+        """Like get() but leaves recency and counters alone."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                return default
+            return entry[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class ConversationCache:
+    def __init__(self, max_entries=1024, ttl=300, shared_alias=None, local_ttl=5):
+        self.shared = caches[shared_alias] if shared_alias else None
+        # Versions in the shared backend invalidate local copies; without
+        # it a short TTL is all that bounds how stale another worker gets
+        self.local = LRUCache(max_entries, ttl if self.shared is not None else local_ttl)
+        self.ttl = ttl
+        self.shared_hits = 0
+
+    def _key(self, email, selected):
+        digest = hashlib.sha1(f"{email}\0{selected}".encode()).hexdigest()
+        return f"chat:{digest}"
+
+    def _version(self, key):
+        if self.shared is None:
+            return 0
+        return self.shared.get(f"{key}:v", 0)
+
+    def get(self, email, selected):
+        """Return the cached message list, or None."""
+        key = self._key(email, selected)
+        version = self._version(key)
+        entry = self.local.get(key, None, validate=lambda e: e[0] == version)
+        if entry is not None:
+            return entry[1]
+        if self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None and entry[0] == version:
+                self.shared_hits += 1
+                self.local.set(key, entry)
+                return entry[1]
+        return None
+
+    def set(self, email, selected, messages, version=None):
+        key = self._key(email, selected)
+        entry = (self._version(key) if version is None else version, messages)
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry, self.ttl)
+
+    def get_or_load(self, email, selected, loader):
+        messages = self.get(email, selected)
+        if messages is None:
+            # Take the version before reading so an append that lands while
+            # we load makes this entry stale instead of silently losing it
+            version = self._version(self._key(email, selected))
+            messages = loader()
+            if messages is not None:
+                self.set(email, selected, messages, version)
+        return messages
+
+    async def _off_loop(self, fn, *args):
+        # The shared backend is a network round trip; the local LRU is not
+        if self.shared is None:
+            return fn(*args)
+        return await sync_to_async(fn, thread_sensitive=False)(*args)
+
+    async def aget(self, email, selected):
+        return await self._off_loop(self.get, email, selected)
+
+    async def aget_or_load(self, email, selected, loader):
+        """get_or_load for async views: ``loader`` is a coroutine function."""
+        messages = await self.aget(email, selected)
+        if messages is None:
+            version = await self._off_loop(self._version, self._key(email, selected))
+            messages = await loader()
+            if messages is not None:
+                await self._off_loop(self.set, email, selected, messages, version)
+        return messages
+
+    async def aappend(self, email, selected, message):
+        await self._off_loop(self.append, email, selected, message)
+
+    def append(self, email, selected, message):
+        """Apply a just-written message to the cached conversation.
+
+        The local copy is updated in place (copy-on-write, so a response
+        being serialized never sees the list change). Other workers drop
+        theirs on their next read because the shared version moves on.
+        """
+        key = self._key(email, selected)
+        entry = self.local.peek(key, None)
+        version = 0
+        if self.shared is not None:
+            self.shared.add(f"{key}:v", 0, None)
+            version = self.shared.incr(f"{key}:v")
+            self.shared.delete(key)
+        if entry is None:
+            return
+        if entry[0] != version - (1 if self.shared is not None else 0):
+            self.local.delete(key)
+            return
+        messages = entry[1]
+        if not message.get("id") or all(m.get("id") != message.get("id") for m in messages):
+            messages = messages + [message]
+        self.local.set(key, (version, messages))
+
+    def invalidate(self, email, selected):
+        key = self._key(email, selected)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.add(f"{key}:v", 0, None)
+            self.shared.incr(f"{key}:v")
+            self.shared.delete(key)
+
+    def stats(self):
+        return dict(self.local.stats(), ttl=self.local.ttl, shared_hits=self.shared_hits,
+                    shared=self.shared is not None)
+
+
+_config = getattr(settings, "CHAT_CACHE", {})
+conversations = ConversationCache(
+    max_entries=_config.get("MAX_ENTRIES", 1024),
+    ttl=_config.get("TTL", 300),
+    shared_alias=_config.get("SHARED_ALIAS"),
+    local_ttl=_config.get("LOCAL_TTL", 5),
+)
+metrics.register("conversation_cache", conversations.stats)
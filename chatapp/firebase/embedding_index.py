@@ -0,0 +1,148 @@
+"""Prebuilt sentence-embedding index for reply suggestions.
+
+``build_index`` encodes every ``input`` of the suggestion corpus
+(``chats.csv``) once and writes three files to the index directory:
+
+- ``embeddings.npy``: the L2-normalized float32 embedding matrix
+- ``replies.json``: the reply for each row
+- ``meta.json``: the model name and a SHA-256 of the corpus CSV
+
+``load_index`` memory-maps ``embeddings.npy`` so every worker process
+shares one page-cache copy instead of re-encoding the corpus on boot. The
+index is rebuilt only when the corpus checksum or model no longer match,
+by one process at a time (``build_lock``): workers that find it stale
+together build it once, and each file is written under a temporary name of
+its own before it replaces the old one.
+
+Django-free on purpose so scripts like ``temp.py`` can use it too.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev server only
+    fcntl = None
+
+MODEL_NAME = "all-MiniLM-L6-v2"
+DEFAULT_CORPUS = Path(__file__).resolve().parent / "chats.csv"
+DEFAULT_DIR = Path(__file__).resolve().parent / "index"
+
+
+class EmbeddingIndex:
+    def __init__(self, embeddings, replies, meta):
+        self.embeddings = embeddings
+        self.replies = replies
+        self.meta = meta
+
+    @property
+    def checksum(self):
+        return self.meta["checksum"]
+
+    def __len__(self):
+        return len(self.replies)
+
+
+def corpus_checksum(corpus=DEFAULT_CORPUS):
+    digest = hashlib.sha256()
+    with open(corpus, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_meta(index_dir=DEFAULT_DIR):
+    try:
+        with open(Path(index_dir) / "meta.json", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(corpus=DEFAULT_CORPUS, index_dir=DEFAULT_DIR, model_name=MODEL_NAME):
+    meta = read_meta(index_dir)
+    return bool(meta) and meta.get("checksum") == corpus_checksum(corpus) and meta.get("model") == model_name
+
+
+def _save_npy(path, array):
+    # np.save(path) would append ".npy" to the temporary name
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+
+def replace_file(path, write):
+    """Write path through ``write(tmp)`` on a private temporary file, then swap it in."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    os.close(fd)
+    tmp = Path(tmp)
+    try:
+        write(tmp)
+        os.chmod(tmp, 0o644)  # mkstemp creates it owner-only
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+@contextlib.contextmanager
+def build_lock(index_dir=DEFAULT_DIR):
+    """Hold the index directory's build lock (one builder across processes)."""
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    with open(index_dir / ".build.lock", "ab") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def build_index(corpus=DEFAULT_CORPUS, index_dir=DEFAULT_DIR, model=None, model_name=MODEL_NAME):
+    """Encode the corpus and write the index files. Returns the meta dict.
+
+    Call it holding ``build_lock(index_dir)`` when other processes may
+    build the same index.
+    """
+    import pandas as pd
+
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
+
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    checksum = corpus_checksum(corpus)
+    df = pd.read_csv(corpus)
+    embeddings = model.encode(
+        df["input"].astype(str).tolist(), convert_to_tensor=False, normalize_embeddings=True
+    ).astype(np.float32)
+
+    # Drop meta.json first and write it last, so a half-written index
+    # never looks current
+    (index_dir / "meta.json").unlink(missing_ok=True)
+    replace_file(index_dir / "embeddings.npy", lambda p: _save_npy(p, embeddings))
+    replace_file(index_dir / "replies.json",
+             lambda p: p.write_text(json.dumps(df["reply"].astype(str).tolist()), encoding="utf-8"))
+    meta = {"checksum": checksum, "model": model_name, "rows": len(df), "dim": int(embeddings.shape[1])}
+    replace_file(index_dir / "meta.json", lambda p: p.write_text(json.dumps(meta), encoding="utf-8"))
+    return meta
+
+
+def load_index(corpus=DEFAULT_CORPUS, index_dir=DEFAULT_DIR, model=None, model_name=MODEL_NAME, rebuild=True):
+    """Memory-map the index, building it first if it is missing or stale."""
+    index_dir = Path(index_dir)
+    if not is_current(corpus, index_dir, model_name):
+        if not rebuild:
+            raise FileNotFoundError(f"No current suggestion index in {index_dir}; run manage.py build_suggest_index")
+        with build_lock(index_dir):
+            # Another worker may have built it while we waited for the lock
+            if not is_current(corpus, index_dir, model_name):
+                build_index(corpus, index_dir, model, model_name)
+    embeddings = np.load(index_dir / "embeddings.npy", mmap_mode="r")
+    with open(index_dir / "replies.json", encoding="utf-8") as f:
+        replies = json.load(f)
+    return EmbeddingIndex(embeddings, replies, read_meta(index_dir))
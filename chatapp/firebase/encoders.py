@@ -0,0 +1,129 @@
+"""Sentence encoders for the reply suggester.
+
+Both backends follow the slice of the ``SentenceTransformer.encode`` API the
+rest of the app uses (a list of texts in, a float32 matrix out, rows
+L2-normalized when asked), so they are interchangeable everywhere:
+
+- ``torch``: the fp32 ``SentenceTransformer`` model.
+- ``onnx``: the same model exported to ONNX with int8 dynamically
+  quantized weights, run on onnxruntime with a fixed thread count. It
+  needs only ``onnxruntime``, ``tokenizers`` and numpy at runtime, so
+  workers do not import torch at all.
+
+Create the ONNX model with ``manage.py export_onnx_encoder`` and check it
+against fp32 with ``manage.py check_encoder_parity`` before switching
+``SUGGEST_ENCODER["BACKEND"]``.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from .embedding_index import MODEL_NAME
+
+ONNX_FILE = "model-int8.onnx"
+ONNX_SUFFIX = "+onnx-int8"
+MAX_LENGTH = 256  # all-MiniLM-L6-v2's max_seq_length
+
+
+class TorchEncoder:
+    def __init__(self, model_name=MODEL_NAME, threads=None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.name = model_name
+
+    def encode(self, texts, convert_to_tensor=False, normalize_embeddings=True, batch_size=32):
+        vecs = self.model.encode(
+            list(texts), batch_size=batch_size, convert_to_tensor=False, normalize_embeddings=normalize_embeddings
+        )
+        return np.asarray(vecs, dtype=np.float32)
+
+
+class OnnxEncoder:
+    def __init__(self, model_dir, model_name=MODEL_NAME, threads=1):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        model_dir = Path(model_dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            str(model_dir / ONNX_FILE), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_LENGTH)
+        self.tokenizer.enable_padding()
+        self.name = model_name + ONNX_SUFFIX
+
+    def encode(self, texts, convert_to_tensor=False, normalize_embeddings=True, batch_size=32):
+        texts = list(texts)
+        out = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            feeds = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+            }
+            hidden = self.session.run(None, {k: v for k, v in feeds.items() if k in self.input_names})[0]
+            # Mean pooling over real tokens, as the sentence-transformers model does
+            mask = feeds["attention_mask"][..., None].astype(np.float32)
+            out.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        vecs = np.vstack(out).astype(np.float32) if out else np.zeros((0, 384), dtype=np.float32)
+        if normalize_embeddings:
+            vecs /= np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+        return vecs
+
+
+def export_onnx(model_dir, model_name=MODEL_NAME, opset=14):
+    """Export the transformer to ONNX and quantize its weights to int8."""
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    st = SentenceTransformer(model_name, device="cpu")
+    transformer = st[0].auto_model.eval()
+    st.tokenizer.save_pretrained(str(model_dir))
+
+    sample = st.tokenizer(["export sample"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    fp32 = model_dir / "model.onnx"
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            tuple(sample[name] for name in names),
+            str(fp32),
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "tokens"} for name in names + ["last_hidden_state"]},
+            opset_version=opset,
+        )
+    quantize_dynamic(str(fp32), str(model_dir / ONNX_FILE), weight_type=QuantType.QInt8)
+    return model_dir / ONNX_FILE
+
+
+def encoder_name(config):
+    """The name get_encoder(config) gives its encoder (and the index it built), without loading it."""
+    backend = config.get("BACKEND", "torch")
+    if backend == "torch":
+        return MODEL_NAME
+    if backend == "onnx":
+        return MODEL_NAME + ONNX_SUFFIX
+    raise ValueError(f"Unknown suggestion encoder backend {backend!r}; choose torch or onnx")
+
+
+def get_encoder(config):
+    backend = config.get("BACKEND", "torch")
+    if backend == "torch":
+        return TorchEncoder(threads=config.get("THREADS"))
+    if backend == "onnx":
+        return OnnxEncoder(config["ONNX_DIR"], threads=config.get("THREADS") or 1)
+    raise ValueError(f"Unknown suggestion encoder backend {backend!r}; choose torch or onnx")
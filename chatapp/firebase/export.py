@@ -0,0 +1,145 @@
+"""Streaming chat backups.
+
+Every conversation under the caller's ``db.collection(email)`` is written
+out as NDJSON records in the same ``{"selected", "message"}`` shape
+``/import/`` accepts, so a backup can be loaded straight back in. Each
+record also carries an opaque ``cursor``; passing the last one received
+as ``?cursor=`` restarts the export just after that message.
+
+Conversations and messages are read page by page and the output is
+compressed as it is produced, so memory stays flat however large the
+account is.
+"""
+import base64
+import hashlib
+import json
+import re
+import zipfile
+import zlib
+from datetime import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from . import storage
+
+CONVERSATION_PAGE = 100
+FLUSH_BYTES = 64 * 1024
+
+
+def encode_cursor(selected, message):
+    position = message.get("id") or message.get("timestamp")
+    if isinstance(position, datetime):
+        # Full precision: DjangoJSONEncoder cuts to milliseconds, and a
+        # resume would then repeat the message at the cursor
+        position = position.isoformat()
+    raw = json.dumps({"c": selected, "m": position})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return data["c"], data["m"]
+
+
+def iter_conversation_ids(email, start_at=None):
+    collection = storage.db.collection(email)
+    last = None
+    while True:
+        query = collection.order_by("__name__").limit(CONVERSATION_PAGE)
+        if last is not None:
+            query = query.start_after({"__name__": last})
+        elif start_at is not None:
+            query = query.start_at({"__name__": start_at})
+        ids = [snapshot.id for snapshot in query.select([]).stream()]
+        yield from ids
+        if len(ids) < CONVERSATION_PAGE:
+            return
+        last = ids[-1]
+
+
+def iter_records(email, cursor=None):
+    """Yield ``(selected, ndjson line)`` for the whole account."""
+    start_at, since = decode_cursor(cursor) if cursor else (None, None)
+    for selected in iter_conversation_ids(email, start_at):
+        after = since if selected == start_at else None
+        for message in storage.iter_messages(email, selected, since=after):
+            record = {"selected": selected, "message": message, "cursor": encode_cursor(selected, message)}
+            yield selected, json.dumps(record, cls=DjangoJSONEncoder) + "\n"
+
+
+def gzip_ndjson(email, cursor=None):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    pending = 0
+    for _, line in iter_records(email, cursor):
+        data = line.encode()
+        pending += len(data)
+        chunk = compressor.compress(data)
+        if pending >= FLUSH_BYTES:
+            # Push out what we have so the client sees steady progress
+            chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+class _Sink:
+    """Write-only file object that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self.parts = []
+        self.offset = 0
+        self.buffered = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.offset += len(data)
+        self.buffered += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        self.buffered = 0
+        return data
+
+
+def _entry_name(selected):
+    safe = re.sub(r"[^\w@.+-]", "_", selected)
+    if safe != selected:
+        # "b/y" and "b_y" must not share an entry
+        safe += "-" + hashlib.blake2b(selected.encode(), digest_size=4).hexdigest()
+    return safe + ".ndjson"
+
+
+def zip_ndjson(email, cursor=None):
+    """One deflated ``<contact>.ndjson`` entry per conversation.
+
+    ZipFile writes to a non-seekable sink using data descriptors, so each
+    entry is streamed rather than built in memory first.
+    """
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, "w")
+    entry = None
+    current = None
+    for selected, line in iter_records(email, cursor):
+        if selected != current:
+            if entry is not None:
+                entry.close()
+            info = zipfile.ZipInfo(_entry_name(selected))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            entry = archive.open(info, "w", force_zip64=True)
+            current = selected
+        entry.write(line.encode())
+        if sink.buffered >= FLUSH_BYTES:
+            yield sink.drain()
+    if entry is not None:
+        entry.close()
+    archive.close()
+    yield sink.drain()
@@ -0,0 +1,340 @@
+"""Online learning of reply pairs from live conversations.
+
+The corpus index (chats.csv, see embedding_index.py) is frozen; this
+module grows the suggester past it without a refit.
+
+- ``PairMiner`` runs wherever ``add_message`` runs. When a message's
+  ``senderId`` differs from the previous message in the same
+  conversation, (previous text, this text) is a pair. Pairs are queued in
+  memory and a background thread appends them to the pair log every
+  ``INTERVAL`` seconds, so the request path only pays a dict lookup.
+- ``PairLog`` is an append-only NDJSON file shared by every process on
+  the host: ``{"op": "add", "id", "input", "reply"}`` and
+  ``{"op": "delete", "id"}`` records. ``compact`` rewrites it with only
+  the live pairs.
+- ``LiveIndex`` runs wherever the suggestion engine runs. It tails the
+  log, encodes new inputs in batches of ``BATCH`` (through the engine's
+  embedding cache, so a text is encoded once per host) and appends them
+  to an in-memory matrix searched next to the corpus index. Deletes are
+  tombstones until the next compaction.
+
+Pair ids are a hash of the normalized input and reply, so the same pair
+mined by several workers, or from both participants' copies of a chat,
+is stored once.
+
+Privacy: the pool is global. A reply one user typed in a private chat can
+be suggested, word for word, to any other user. Learning therefore only
+runs with both ``ENABLED`` and ``SHARE_ACROSS_USERS`` set; only do that
+where users have agreed to it. ``manage.py learned_pairs --delete`` removes
+pairs on request.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from chatapp import metrics
+from .cache import LRUCache
+from .suggest_cache import normalize_text
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev server only
+    fcntl = None
+
+
+def _config():
+    return getattr(settings, "SUGGEST_LEARNING", {})
+
+
+def enabled():
+    # Learned pairs are suggested to every user, so turning this on must be explicit
+    config = _config()
+    return bool(config.get("ENABLED") and config.get("SHARE_ACROSS_USERS"))
+
+
+def pair_id(input_text, reply):
+    key = f"{normalize_text(input_text)}\0{normalize_text(reply)}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+class PairLog:
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def _locked(self, f, exclusive=True, blocking=True):
+        if fcntl is None:
+            return True
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(f, flags if blocking else flags | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _open_locked(self, blocking=True):
+        """The log opened for appending and locked, or None if blocking is off and it is busy."""
+        while True:
+            f = open(self.path, "ab")
+            if not self._locked(f, blocking=blocking):
+                f.close()
+                return None
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+            if fcntl is None or current == os.fstat(f.fileno()).st_ino:
+                return f
+            # Compacted while we waited for the lock: this inode is no longer the log
+            f.close()
+
+    def append(self, records):
+        if not records:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+        with self._open_locked() as f:
+            f.write(data)
+
+    def read(self, offset=0):
+        """Complete records written after ``offset``: (records, new offset, inode)."""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return [], 0, None
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # leave a line still being written for next time
+        records = []
+        for line in data[:end].splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records, offset + end, inode
+
+    def live(self):
+        """The pairs that have not been deleted, in the order they were learned."""
+        pairs = {}
+        for record in self.read()[0]:
+            if record.get("op") == "delete":
+                pairs.pop(record["id"], None)
+            elif record["id"] not in pairs:
+                pairs[record["id"]] = record
+        return pairs
+
+    def compact(self, blocking=False):
+        """Rewrite the log without deleted or duplicate pairs.
+
+        Returns the number of records dropped, or None if another process
+        holds the lock. Readers notice the new inode and reload.
+        """
+        if not self.path.exists():
+            return 0
+        lock = self._open_locked(blocking=blocking)
+        if lock is None:
+            return None
+        with lock:
+            records = self.read()[0]
+            pairs = self.live()
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with open(tmp, "wb") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in pairs.values()).encode())
+            os.replace(tmp, self.path)
+        return len(records) - len(pairs)
+
+    def stats(self):
+        try:
+            return {"bytes": self.path.stat().st_size}
+        except FileNotFoundError:
+            return {"bytes": 0}
+
+
+class PairMiner:
+    def __init__(self, log, interval=30, max_length=500, conversations=10_000):
+        self.log = log
+        self.interval = interval
+        self.max_length = max_length
+        self._last = LRUCache(conversations)  # (email, contact) -> (sender, text)
+        self._queue = []
+        self._lock = threading.Lock()
+        self.mined = self.written = 0
+        self._thread = threading.Thread(target=self._run, name="pair-miner", daemon=True)
+        self._thread.start()
+
+    def observe(self, email, selected, message):
+        """Note a stored message; queue a pair if it answers the previous one."""
+        sender, text = message.get("senderId"), str(message.get("text") or "").strip()
+        if not sender or not text:
+            return
+        previous = self._last.peek((email, selected), None)
+        self._last.set((email, selected), (sender, text))
+        if previous is None or previous[0] == sender:
+            return
+        if len(previous[1]) > self.max_length or len(text) > self.max_length:
+            return
+        record = {"op": "add", "id": pair_id(previous[1], text), "input": previous[1], "reply": text,
+                  "learned": time.time()}
+        with self._lock:
+            self._queue.append(record)
+            self.mined += 1
+
+    def flush(self):
+        with self._lock:
+            records, self._queue = self._queue, []
+        try:
+            self.log.append(records)
+        except OSError as e:
+            print("Error:", e)
+            return
+        self.written += len(records)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def stats(self):
+        return {"mined": self.mined, "written": self.written, "queued": len(self._queue)}
+
+
+class LiveIndex:
+    """Learned pairs, searched next to the corpus index.
+
+    Searches read ``_view``, a (size, vectors, alive, replies) tuple that
+    sync replaces in one assignment, so they never see a half-applied
+    batch or a half-reloaded index.
+    """
+
+    def __init__(self, log, encode, dim, batch=64):
+        self.log = log
+        self.encode = encode
+        self.dim = dim
+        self.batch = batch
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._empty()
+
+    def _empty(self):
+        import numpy as np
+
+        self._vectors = np.zeros((256, self.dim), dtype=np.float32)
+        self._alive = np.zeros(256, dtype=bool)
+        self.replies, self.rows = [], {}
+        self.size = self.offset = 0
+        self.inode = None
+        self._view = (0, self._vectors, self._alive, self.replies)
+
+    def sync(self):
+        """Apply new log records. Returns True if suggestions may have changed."""
+        with self._lock:
+            records, offset, inode = self.log.read(self.offset)
+            if inode != self.inode and self.offset:
+                # The log was compacted (or removed). Rebuild from its new
+                # contents while searches keep using the old view; the
+                # embedding cache makes the re-encode cheap.
+                view = self._view
+                self._empty()
+                self._view = view
+                records, offset, inode = self.log.read(0)
+                self._apply(records)
+                changed = True
+            else:
+                changed = self._apply(records)
+            self.offset, self.inode = offset, inode
+            self._view = (self.size, self._vectors, self._alive, self.replies)
+            if changed:
+                self.generation += 1
+            return changed
+
+    def _apply(self, records):
+        changed = False
+        adds = {}
+        for record in records:
+            if record.get("op") == "delete":
+                adds.pop(record["id"], None)
+                row = self.rows.pop(record["id"], None)
+                if row is not None:
+                    self._alive[row] = False
+                    changed = True
+            elif record["id"] not in self.rows:
+                adds.setdefault(record["id"], record)
+        adds = list(adds.values())
+        for start in range(0, len(adds), self.batch):
+            chunk = adds[start:start + self.batch]
+            self._append(chunk, self.encode([record["input"] for record in chunk]))
+            changed = True
+        return changed
+
+    def _append(self, records, vectors):
+        import numpy as np
+
+        needed = self.size + len(records)
+        if needed > len(self._vectors):
+            capacity = max(needed, len(self._vectors) * 2)
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            alive = np.zeros(capacity, dtype=bool)
+            grown[:self.size], alive[:self.size] = self._vectors[:self.size], self._alive[:self.size]
+            self._vectors, self._alive = grown, alive
+        self._vectors[self.size:needed] = vectors
+        self._alive[self.size:needed] = True
+        for i, record in enumerate(records):
+            self.rows[record["id"]] = self.size + i
+            self.replies.append(record["reply"])
+        self.size = needed
+
+    def search(self, queries, k):
+        """(scores, replies) per query, best first; rows may be shorter than k."""
+        import numpy as np
+
+        size, vectors, alive, replies = self._view
+        queries = np.atleast_2d(queries)
+        live = int(alive[:size].sum()) if size else 0
+        if not live:
+            return np.zeros((len(queries), 0), dtype=np.float32), [[] for _ in queries]
+        scores = queries.astype(np.float32) @ vectors[:size].T
+        scores[:, ~alive[:size]] = -np.inf
+        order = np.argsort(-scores, axis=1)[:, :min(k, live)]
+        return np.take_along_axis(scores, order, axis=1), [[replies[i] for i in row] for row in order]
+
+    def stats(self):
+        size, _, alive, _ = self._view
+        live = int(alive[:size].sum())
+        return {"pairs": live, "tombstones": size - live, "generation": self.generation}
+
+
+_miner = None
+_miner_lock = threading.Lock()
+
+
+def get_miner():
+    global _miner
+    if _miner is None and enabled():
+        with _miner_lock:
+            if _miner is not None:
+                return _miner
+            config = _config()
+            _miner = PairMiner(
+                PairLog(config["PATH"]),
+                interval=config.get("INTERVAL", 30),
+                max_length=config.get("MAX_LENGTH", 500),
+            )
+            metrics.register("pair_miner", _miner.stats)
+    return _miner
+
+
+def observe(email, selected, message):
+    miner = get_miner()
+    if miner is not None:
+        miner.observe(email, selected, message)
+
+
+def forget(ids):
+    """Delete learned pairs by id; every live index drops them on its next sync."""
+    PairLog(_config()["PATH"]).append([{"op": "delete", "id": i, "deleted": time.time()} for i in ids])
@@ -0,0 +1,221 @@
+"""LLM reply suggestions next to the KNN ones, under a deadline.
+
+``/suggest/`` starts ``suggest.get_suggestions`` (Ollama) on a small
+thread pool, computes the KNN suggestions meanwhile, and then waits for
+the LLM only until ``DEADLINE_MS`` after the request started. On time,
+the LLM suggestions come first (with ``MERGE``, KNN fills the remaining
+slots); late, the KNN list goes out alone and the LLM answer, when it
+arrives, is cached so the next request for the same text gets it
+straight away. With every pool slot busy the LLM is not called at all,
+so a slow Ollama can never queue up work behind the UI.
+
+Async views use ``astart``/``afinish`` instead: the LLM call is a task on
+the event loop (the async Ollama client) and waiting for it never holds
+a thread.
+
+Streaming ``/suggest/`` has no deadline: ``stream``/``astream`` yield each
+LLM suggestion as Ollama produces it, under the same slots and cache.
+"""
+import asyncio
+import contextlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from django.conf import settings
+
+from chatapp import metrics
+from .cache import LRUCache
+from .suggest_cache import normalize_text
+
+
+def _config():
+    return getattr(settings, "SUGGEST_LLM", {})
+
+
+def enabled():
+    return bool(_config().get("ENABLED"))
+
+
+class LLMSuggester:
+    def __init__(self, max_workers=4, deadline_ms=300, merge=True, model="llama3", cache_entries=10_000, cache_ttl=3600):
+        self.deadline = deadline_ms / 1000
+        self.merge = merge
+        self.model = model
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="llm-suggest")
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.cache = LRUCache(cache_entries, cache_ttl)
+        self.counts = {"on_time": 0, "late": 0, "cached": 0, "skipped": 0, "empty": 0, "streamed": 0}
+        self._tasks = set()
+
+    def _key(self, user_input, context):
+        return normalize_text(user_input), tuple((turn["role"], normalize_text(turn["content"])) for turn in context)
+
+    def _admit(self, user_input, context):
+        # (key, cached suggestions or None, messages or None when there is no free slot)
+        key = self._key(user_input, context)
+        cached = self.cache.get(key, None)
+        if cached is not None:
+            return key, cached, None
+        if not self.slots.acquire(blocking=False):
+            return key, None, None
+        # context: {"role", "content"} turns, the requesting user's own as "assistant"
+        return key, None, [*context, {"role": "user", "content": str(user_input)}]
+
+    def start(self, user_input, context=()):
+        """Begin an LLM call for this input; returns a handle for ``finish``."""
+        key, cached, messages = self._admit(user_input, context)
+        if messages is None:
+            return key, cached
+        try:
+            future = self.pool.submit(self._call, key, messages)
+        except Exception:
+            self.slots.release()
+            raise
+        return key, future
+
+    def _call(self, key, messages):
+        import suggest  # the Ollama client next to manage.py
+
+        try:
+            suggestions = suggest.get_suggestions(messages, model=self.model)
+            if suggestions:
+                # Late answers still pay off on the next request
+                self.cache.set(key, suggestions)
+            return suggestions
+        finally:
+            self.slots.release()
+
+    def astart(self, user_input, context=()):
+        """start() for async views: the call runs as a task on the running loop."""
+        key, cached, messages = self._admit(user_input, context)
+        if messages is None:
+            return key, cached
+        task = asyncio.get_running_loop().create_task(self._acall(key, messages))
+        self._tasks.add(task)  # keep late calls alive after the view returns
+        task.add_done_callback(self._tasks.discard)
+        return key, task
+
+    async def _acall(self, key, messages):
+        import suggest
+
+        try:
+            suggestions = await suggest.aget_suggestions(messages, model=self.model)
+            if suggestions:
+                self.cache.set(key, suggestions)
+            return suggestions
+        finally:
+            self.slots.release()
+
+    def stream(self, user_input, context=()):
+        """Yield LLM suggestions as Ollama generates them."""
+        import suggest
+
+        key, cached, messages = self._admit(user_input, context)
+        if messages is None:
+            self.counts["cached" if cached is not None else "skipped"] += 1
+            yield from cached or []
+            return
+        collected = []
+        try:
+            with contextlib.closing(suggest.stream_suggestions(messages, model=self.model)) as suggestions:
+                for suggestion in suggestions:
+                    collected.append(suggestion)
+                    yield suggestion
+            self.counts["streamed" if collected else "empty"] += 1
+            if collected:
+                self.cache.set(key, collected)  # only streams that ran to the end
+        finally:
+            self.slots.release()
+
+    async def astream(self, user_input, context=()):
+        import suggest
+
+        key, cached, messages = self._admit(user_input, context)
+        if messages is None:
+            self.counts["cached" if cached is not None else "skipped"] += 1
+            for suggestion in cached or []:
+                yield suggestion
+            return
+        collected = []
+        try:
+            async with contextlib.aclosing(suggest.astream_suggestions(messages, model=self.model)) as suggestions:
+                async for suggestion in suggestions:
+                    collected.append(suggestion)
+                    yield suggestion
+            self.counts["streamed" if collected else "empty"] += 1
+            if collected:
+                self.cache.set(key, collected)
+        finally:
+            self.slots.release()
+
+    def _remaining(self, started):
+        return max(self.deadline - (time.monotonic() - started), 0)
+
+    def finish(self, handle, knn, top_k, started):
+        """Blend the KNN list with whatever the LLM produced by the deadline: (suggestions, source)."""
+        _, pending = handle
+        if pending is None or isinstance(pending, list):
+            return self._blend(pending, knn, top_k)
+        try:
+            llm = pending.result(timeout=self._remaining(started))
+        except FutureTimeout:
+            self.counts["late"] += 1
+            return knn, "knn"
+        self.counts["on_time"] += 1
+        return self._blend(llm, knn, top_k, fresh=True)
+
+    async def afinish(self, handle, knn, top_k, started):
+        _, pending = handle
+        if pending is None or isinstance(pending, list):
+            return self._blend(pending, knn, top_k)
+        try:
+            # shield: a missed deadline must not cancel the call, its answer gets cached
+            llm = await asyncio.wait_for(asyncio.shield(pending), self._remaining(started))
+        except asyncio.TimeoutError:
+            self.counts["late"] += 1
+            return knn, "knn"
+        self.counts["on_time"] += 1
+        return self._blend(llm, knn, top_k, fresh=True)
+
+    def _blend(self, llm, knn, top_k, fresh=False):
+        if llm is None:
+            self.counts["skipped"] += 1
+            return knn, "knn"
+        if not fresh:
+            self.counts["cached"] += 1
+        if not llm:
+            self.counts["empty"] += 1
+            return knn, "knn"
+        if not self.merge:
+            return llm[:top_k], "llm"
+        merged, seen = [], set()
+        for suggestion in [*llm, *knn]:
+            if normalize_text(suggestion) not in seen:
+                seen.add(normalize_text(suggestion))
+                merged.append(suggestion)
+        return merged[:top_k], "llm+knn"
+
+    def stats(self):
+        return dict(self.counts, cache=self.cache.stats())
+
+
+_suggester = None
+_lock = threading.Lock()
+
+
+def get_suggester():
+    global _suggester
+    if _suggester is None:
+        with _lock:
+            if _suggester is None:
+                config = _config()
+                _suggester = LLMSuggester(
+                    max_workers=config.get("MAX_WORKERS", 4),
+                    deadline_ms=config.get("DEADLINE_MS", 300),
+                    merge=config.get("MERGE", True),
+                    model=config.get("MODEL", "llama3"),
+                )
+                metrics.register("llm_suggest", _suggester.stats)
+    return _suggester
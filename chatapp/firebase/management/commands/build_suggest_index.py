@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from firebase import embedding_index, encoders
+
+
+class Command(BaseCommand):
+    # System checks import the URLconf, which would load the suggestion index
+    requires_system_checks = []
+    help = "Encode the suggestion corpus into the memory-mapped index used by /suggest/."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Rebuild even if the corpus checksum is unchanged")
+
+    def handle(self, *args, **options):
+        corpus = settings.SUGGEST_CORPUS
+        index_dir = settings.SUGGEST_INDEX_DIR
+        # The encoder the workers load: an index built by another one is stale to them
+        name = encoders.encoder_name(settings.SUGGEST_ENCODER)
+        if not options["force"] and embedding_index.is_current(corpus, index_dir, name):
+            self.stdout.write(f"Index in {index_dir} is up to date ({name})")
+            return
+        encoder = encoders.get_encoder(settings.SUGGEST_ENCODER)
+        with embedding_index.build_lock(index_dir):
+            meta = embedding_index.build_index(corpus, index_dir, model=encoder, model_name=encoder.name)
+        self.stdout.write(self.style.SUCCESS(
+            f"Built {meta['rows']} x {meta['dim']} index in {index_dir} (corpus {meta['checksum'][:12]})"
+        ))
@@ -0,0 +1,80 @@
+import csv
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from firebase import encoders, vector_index
+
+
+def _load(backend, onnx_dir, threads):
+    if backend == "onnx":
+        return encoders.OnnxEncoder(onnx_dir, threads=threads)
+    return encoders.TorchEncoder(threads=threads)
+
+
+def _probe(backend, onnx_dir, threads, texts, result):
+    # Runs in a fresh process so each backend's RSS is measured on its own
+    encoder = _load(backend, onnx_dir, threads)
+    timings = []
+    for text in texts:
+        started = time.perf_counter()
+        encoder.encode([text])
+        timings.append(time.perf_counter() - started)
+    result.put({
+        "p50_ms": float(np.percentile(timings, 50) * 1000),
+        "p95_ms": float(np.percentile(timings, 95) * 1000),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Compare the int8 ONNX encoder with fp32 torch on the suggestion corpus."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--k", type=int, default=5)
+        parser.add_argument("--samples", type=int, default=200, help="Single-sentence encodes timed per backend")
+        parser.add_argument("--min-cosine", type=float, default=0.98)
+        parser.add_argument("--min-overlap", type=float, default=0.9)
+
+    def handle(self, *args, **options):
+        onnx_dir = settings.SUGGEST_ENCODER["ONNX_DIR"]
+        threads = settings.SUGGEST_ENCODER.get("THREADS") or 1
+        with open(settings.SUGGEST_CORPUS, encoding="utf-8") as f:
+            texts = [row["input"] for row in csv.DictReader(f)]
+
+        fp32 = _load("torch", onnx_dir, threads).encode(texts)
+        int8 = _load("onnx", onnx_dir, threads).encode(texts)
+        cosine = (fp32 * int8).sum(axis=1)
+
+        # Same queries against each encoder's own corpus matrix: how often
+        # do the suggestions stay the same?
+        k = options["k"]
+        _, fp32_rows = vector_index.NumpyIndex(fp32).search(fp32, k + 1)
+        _, int8_rows = vector_index.NumpyIndex(int8).search(int8, k + 1)
+        overlap = np.mean([len(set(a[1:]) & set(b[1:])) / k for a, b in zip(fp32_rows, int8_rows)])
+
+        self.stdout.write(f"rows: {len(texts)}")
+        self.stdout.write(f"cosine fp32 vs int8: mean {cosine.mean():.4f}  min {cosine.min():.4f}")
+        self.stdout.write(f"top-{k} neighbour overlap: {overlap:.4f}")
+
+        ctx = multiprocessing.get_context("spawn")
+        sample = texts[:options["samples"]]
+        for backend in ("torch", "onnx"):
+            result = ctx.Queue()
+            proc = ctx.Process(target=_probe, args=(backend, onnx_dir, threads, sample, result))
+            proc.start()
+            stats = result.get()
+            proc.join()
+            self.stdout.write(
+                f"{backend:>5}: p50 {stats['p50_ms']:.2f} ms  p95 {stats['p95_ms']:.2f} ms  "
+                f"max RSS {stats['max_rss_mb']:.0f} MB"
+            )
+
+        if cosine.mean() < options["min_cosine"] or overlap < options["min_overlap"]:
+            raise CommandError("int8 encoder is below the parity thresholds; keep the torch backend")
+        self.stdout.write(self.style.SUCCESS("int8 encoder is within parity thresholds"))
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from firebase import encoders
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Export the suggestion encoder to ONNX with int8-quantized weights."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--out", default=None, help="Output directory (default: SUGGEST_ENCODER['ONNX_DIR'])")
+        parser.add_argument("--opset", type=int, default=14)
+
+    def handle(self, *args, **options):
+        out = options["out"] or settings.SUGGEST_ENCODER["ONNX_DIR"]
+        path = encoders.export_onnx(out, opset=options["opset"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {path}; run check_encoder_parity before switching backends"))
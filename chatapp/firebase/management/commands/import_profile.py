@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+PROBE = """
+import time
+started = time.perf_counter()
+import django
+django.setup()
+import importlib
+importlib.import_module({module!r})
+booted = time.perf_counter()
+if {suggest!r}:
+    from firebase import suggester
+    suggester.warm_up(background=False)
+print("boot_seconds=%.3f" % (booted - started))
+print("suggest_seconds=%.3f" % (time.perf_counter() - booted))
+"""
+
+
+class Command(BaseCommand):
+    # Checks import the URLconf in this process; the probe runs in a fresh one
+    requires_system_checks = []
+    help = "Report where web-worker startup time goes, using python -X importtime in a fresh process."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--module", default=settings.ROOT_URLCONF, help="Module a worker imports on boot")
+        parser.add_argument("--top", type=int, default=20, help="How many top-level packages to list")
+        parser.add_argument("--suggest", action="store_true", help="Also load the suggestion engine and time it")
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "chatapp.settings"))
+        code = PROBE.format(module=options["module"], suggest=options["suggest"])
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode:
+            self.stderr.write(proc.stderr[-2000:])
+            return
+
+        # Charge every module's own import time to its top-level package
+        self_us = defaultdict(int)
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line or "self [us]" in line:
+                continue
+            own, _, name = line[len("import time:"):].split("|")
+            self_us[name.strip().split(".")[0]] += int(own)
+
+        for line in proc.stdout.splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                self.stdout.write(f"{key.replace('_', ' ')}: {value}")
+        self.stdout.write(f"{'package':<32} {'ms':>9}")
+        for package, us in sorted(self_us.items(), key=lambda item: -item[1])[:options["top"]]:
+            self.stdout.write(f"{package:<32} {us / 1000:>9.1f}")
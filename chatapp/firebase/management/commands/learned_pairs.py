@@ -0,0 +1,36 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from firebase import learning
+from firebase.suggest_cache import normalize_text
+
+
+class Command(BaseCommand):
+    # System checks import the URLconf, which would load the suggestion index
+    requires_system_checks = []
+    help = "List, delete or compact reply pairs learned from live chats."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--delete", nargs="+", metavar="ID", default=[], help="Pair ids to delete")
+        parser.add_argument("--delete-matching", metavar="TEXT",
+                            help="Delete every pair whose input or reply normalizes to TEXT")
+        parser.add_argument("--compact", action="store_true", help="Rewrite the log without deleted pairs")
+
+    def handle(self, *args, **options):
+        log = learning.PairLog(settings.SUGGEST_LEARNING["PATH"])
+        ids = list(options["delete"])
+        if options["delete_matching"]:
+            target = normalize_text(options["delete_matching"])
+            ids += [pair_id for pair_id, pair in log.live().items()
+                    if target in (normalize_text(pair["input"]), normalize_text(pair["reply"]))]
+        if ids:
+            learning.forget(ids)
+            self.stdout.write(f"Deleted {len(ids)} pairs")
+        if options["compact"]:
+            dropped = log.compact(blocking=True)
+            self.stdout.write(f"Compacted the pair log, dropped {dropped} records")
+        if not ids and not options["compact"]:
+            for pair in log.live().values():
+                self.stdout.write(json.dumps({"id": pair["id"], "input": pair["input"], "reply": pair["reply"]}))
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from google.cloud.firestore_v1 import DELETE_FIELD
+from firebase_admin import firestore
+
+from firebase import storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Move conversations from the single `data` array into one document "
+        "per message. Set CHAT_STORAGE_LAYOUT = \"messages\" before running "
+        "so nothing new lands in the arrays being migrated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--email", action="append", help="Only migrate these owners (repeatable)")
+        parser.add_argument("--batch-size", type=int, default=400, help="Writes per batch commit (max 500)")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would move without writing")
+
+    def handle(self, *args, **options):
+        batch_size = min(options["batch_size"], 499)
+        emails = options["email"] or [c.id for c in storage.db.collections()]
+        total = 0
+        for email in emails:
+            for doc in storage.db.collection(email).stream():
+                data = (doc.to_dict() or {}).get("data")
+                if data is None:
+                    continue
+                self.stdout.write(f"{email}/{doc.id}: {len(data)} messages")
+                total += len(data)
+                if not options["dry_run"]:
+                    self.migrate(email, doc.id, data, batch_size)
+        self.stdout.write(self.style.SUCCESS(f"Migrated {total} messages"))
+
+    def migrate(self, email, selected, data, batch_size):
+        # Copy the bulk outside a transaction; the doc ids are the message
+        # ids, so re-running after an interruption just overwrites.
+        stamps = fill_timestamps(data)
+        for start in range(0, len(data), batch_size):
+            batch = storage.db.batch()
+            for seq, message in enumerate(data[start:start + batch_size], start=start + 1):
+                message = _prepare(message, seq, stamps[seq - 1])
+                batch.set(storage.message_ref(email, selected, message), message)
+            batch.commit()
+        _finish(storage.db.transaction(), email, selected, len(data))
+
+
+def _parse(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def fill_timestamps(data):
+    """A timestamp for every message of a legacy array, in array order.
+
+    The subcollection is ordered by timestamp, so a message that never had
+    one cannot take the migration time: it would sort after everything
+    written meanwhile. It gets its nearest earlier stamped neighbour's time
+    plus one microsecond per position (or the next one's minus), and the
+    Unix epoch plus its position when nothing in the array is stamped.
+    """
+    parsed = [_parse(m["timestamp"]) if m.get("timestamp") else None for m in data]
+    stamps = [m.get("timestamp") for m in data]
+    anchor = None
+    for i, value in enumerate(parsed):
+        if value is not None:
+            anchor = (i, value)
+        elif not stamps[i] and anchor is not None:
+            stamps[i] = (anchor[1] + timedelta(microseconds=i - anchor[0])).isoformat()
+    anchor = None
+    for i in reversed(range(len(data))):
+        if parsed[i] is not None:
+            anchor = (i, parsed[i])
+        elif not stamps[i]:
+            base = (anchor[0], anchor[1]) if anchor is not None else (0, datetime(1970, 1, 1, tzinfo=timezone.utc))
+            stamps[i] = (base[1] - timedelta(microseconds=base[0] - i)).isoformat()
+    return stamps
+
+
+def _prepare(message, seq, timestamp):
+    # Messages without an id get a positional one so re-runs stay idempotent
+    message = dict(message, seq=message.get("seq", seq), id=message.get("id") or f"legacy-{seq}")
+    return message if message.get("timestamp") else dict(message, timestamp=timestamp)
+
+
+@firestore.transactional
+def _finish(transaction, email, selected, copied):
+    # Anything appended to the array while the bulk copy ran is moved in the
+    # same transaction that drops the array, so no message is lost.
+    doc_ref = storage.conversation_ref(email, selected)
+    current = doc_ref.get(transaction=transaction).to_dict() or {}
+    data = current.get("data", [])
+    stamps = fill_timestamps(data)
+    for seq, message in enumerate(data[copied:], start=copied + 1):
+        message = _prepare(message, seq, stamps[seq - 1])
+        transaction.set(storage.message_ref(email, selected, message), message)
+    count = max(current.get("count", 0), len(data))
+    transaction.set(doc_ref, {"data": DELETE_FIELD, "count": count, "layout": storage.MESSAGES}, merge=True)
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from firebase import suggest_service
+
+
+class Command(BaseCommand):
+    requires_system_checks = []
+    help = "Run the suggestion worker pool on SUGGEST_SERVICE['SOCKET']."
+
+    def add_arguments(self, parser):
+        config = getattr(settings, "SUGGEST_SERVICE", {})
+        parser.add_argument("--socket", default=config.get("SOCKET"))
+        parser.add_argument("--workers", type=int, default=config.get("WORKERS", 2))
+        parser.add_argument("--threads", type=int, default=config.get("THREADS", 8),
+                            help="Request threads per worker")
+        parser.add_argument("--max-inflight", type=int, default=config.get("MAX_INFLIGHT", 64),
+                            help="Requests a worker holds before answering busy")
+
+    def handle(self, *args, **options):
+        if not options["socket"]:
+            raise CommandError("Set SUGGEST_SERVICE['SOCKET'] or pass --socket")
+        suggest_service.serve(
+            options["socket"],
+            workers=options["workers"],
+            threads=options["threads"],
+            max_inflight=options["max_inflight"],
+            log=self.stdout.write,
+        )
@@ -0,0 +1,239 @@
+import json
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapp import outbound
+from firebase import encoders, vector_index
+from firebase.suggest_cache import normalize_text
+
+DENSE = ["sklearn", "numpy", "hnsw", "hybrid"]
+STUB_REPLIES = ["Sounds good to me!", "Sure, tell me more.", "Not sure yet, why?"]
+
+
+def _stub_server(latency):
+    """A local stand-in for Ollama's /api/chat, so the LLM path is timed without a model."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency)
+            body = json.dumps({"message": {"content": json.dumps({"suggestions": STUB_REPLIES})}}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _percentiles(latencies):
+    ms = np.array(latencies) * 1000
+    return {f"p{p}_ms": round(float(np.percentile(ms, p)), 3) for p in (50, 95, 99)}
+
+
+class Command(BaseCommand):
+    # System checks import the URLconf, which would load the suggestion index
+    requires_system_checks = []
+    help = "Benchmark every reply suggester on a held-out split: quality, latency, throughput, build cost. Prints JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--corpus", default=str(settings.SUGGEST_CORPUS))
+        parser.add_argument("--test-fraction", type=float, default=0.2)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--queries", type=int, default=200, help="Held-out pairs to evaluate at most")
+        parser.add_argument("--k", type=int, default=5)
+        parser.add_argument("--backends", nargs="+", default=["tfidf", *DENSE, "ollama"])
+        parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256],
+                            help="ef_search values to sweep for hnsw")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+        parser.add_argument("--match", choices=["semantic", "exact"], default="semantic",
+                            help="A suggestion counts as correct if it matches the held-out reply exactly "
+                                 "(normalized) or, with semantic, if their embeddings are this close")
+        parser.add_argument("--match-threshold", type=float, default=0.7)
+        parser.add_argument("--stub-latency-ms", type=float, default=200,
+                            help="Response time of the local stand-in for Ollama")
+        parser.add_argument("--no-memory", action="store_true", help="Skip the traced second build for peak memory")
+        parser.add_argument("--output", help="Also write the JSON report here")
+        parser.add_argument("--baseline", help="Earlier report to compare against; fail on regressions")
+        parser.add_argument("--max-recall-drop", type=float, default=0.02)
+        parser.add_argument("--max-latency-growth", type=float, default=0.25,
+                            help="Allowed relative growth of p95 latency over the baseline")
+
+    def handle(self, *args, **options):
+        df = pd.read_csv(options["corpus"])[["input", "reply"]].astype(str).sample(frac=1, random_state=options["seed"])
+        n_test = max(1, int(len(df) * options["test_fraction"]))
+        test, train = df.iloc[:n_test].head(options["queries"]), df.iloc[n_test:]
+        inputs, replies = train["input"].tolist(), train["reply"].tolist()
+        k = options["k"]
+
+        needs_model = options["match"] == "semantic" or any(b in DENSE for b in options["backends"])
+        encoder = encoders.get_encoder(settings.SUGGEST_ENCODER) if needs_model else None
+        corpus_vecs, encode_s = None, None
+        if any(b in DENSE for b in options["backends"]):
+            started = time.perf_counter()
+            corpus_vecs = encoder.encode(inputs)
+            encode_s = round(time.perf_counter() - started, 3)
+        truth = test["reply"].tolist()
+        truth_vecs = encoder.encode(truth) if options["match"] == "semantic" else None
+
+        suggestion_vecs = {}  # retrieval backends keep suggesting the same train replies
+
+        def relevant(i, suggestion):
+            if normalize_text(suggestion) == normalize_text(truth[i]):
+                return True
+            if truth_vecs is None:
+                return False
+            if suggestion not in suggestion_vecs:
+                suggestion_vecs[suggestion] = encoder.encode([suggestion])[0]
+            return float(suggestion_vecs[suggestion] @ truth_vecs[i]) >= options["match_threshold"]
+
+        report = {
+            "corpus": options["corpus"],
+            "train_rows": len(train),
+            "queries": len(test),
+            "k": k,
+            "match": options["match"],
+            "encoder": encoder.name if encoder is not None else None,
+            "corpus_encode_s": encode_s,
+            "results": [],
+        }
+        stub = None
+        for backend in options["backends"]:
+            try:
+                variants = self._variants(backend, options, inputs, replies, corpus_vecs, encoder)
+            except ImportError as e:
+                self.stderr.write(f"skipping {backend}: {e}")
+                continue
+            if backend == "ollama":
+                stub = stub or _stub_server(options["stub_latency_ms"] / 1000)
+                outbound.override("ollama", BASE_URL=f"http://127.0.0.1:{stub.server_address[1]}")
+            for name, build, knobs in variants:
+                report["results"].append(self._run(name, build, knobs, test["input"].tolist(), relevant, options))
+        if stub is not None:
+            stub.shutdown()
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(output)
+        self.stdout.write(output)
+        if options["baseline"]:
+            self._compare(report, options)
+
+    def _variants(self, backend, options, inputs, replies, corpus_vecs, encoder):
+        """(name, build, knobs) per configuration; build() returns suggest(text, k)."""
+        if backend == "tfidf":
+            def build():
+                # The same model as knn_model.py
+                from sklearn.feature_extraction.text import TfidfVectorizer
+                from sklearn.neighbors import NearestNeighbors
+
+                vectorizer = TfidfVectorizer(stop_words="english")
+                knn = NearestNeighbors(metric="cosine").fit(vectorizer.fit_transform(inputs))
+
+                def suggest(text, k):
+                    _, rows = knn.kneighbors(vectorizer.transform([text]), n_neighbors=k)
+                    return [replies[i] for i in rows[0]]
+                return suggest
+            return [("tfidf", build, {})]
+
+        if backend == "ollama":
+            def build():
+                import suggest as llm
+                return lambda text, k: llm.get_suggestions([{"role": "user", "content": text}])[:k]
+            return [("ollama-stub", build, {"stub_latency_ms": options["stub_latency_ms"]})]
+
+        if backend not in vector_index.BACKENDS:
+            raise CommandError(f"Unknown backend {backend!r}")
+        if backend == "hnsw":
+            import hnswlib  # noqa: F401  (skip cleanly when missing)
+        sweeps = [{"ef_search": ef} for ef in options["ef_search"]] if backend == "hnsw" else [{}]
+        variants = []
+        for knobs in sweeps:
+            def build(knobs=knobs):
+                extra = {"inputs": inputs} if backend == "hybrid" else {}
+                index = vector_index.create_index(backend, corpus_vecs, **knobs, **extra)
+
+                def suggest(text, k):
+                    query = encoder.encode([text])
+                    if getattr(index, "uses_text", False):
+                        _, rows = index.search(query, k, texts=[text])
+                    else:
+                        _, rows = index.search(query, k)
+                    return [replies[i] for i in rows[0]]
+                return suggest
+            name = backend + (f"-ef{knobs['ef_search']}" if knobs else "")
+            variants.append((name, build, knobs))
+        return variants
+
+    def _run(self, name, build, knobs, queries, relevant, options):
+        k = options["k"]
+        started = time.perf_counter()
+        suggest = build()
+        build_s = time.perf_counter() - started
+        peak_mb = None
+        if not options["no_memory"]:
+            tracemalloc.start()
+            build()
+            peak_mb = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+            tracemalloc.stop()
+
+        latencies, hits, reciprocal = [], 0, 0.0
+        for i, text in enumerate(queries):
+            started = time.perf_counter()
+            suggestions = suggest(text, k)
+            latencies.append(time.perf_counter() - started)
+            rank = next((r for r, s in enumerate(suggestions[:k], 1) if relevant(i, s)), None)
+            if rank is not None:
+                hits += 1
+                reciprocal += 1 / rank
+
+        throughput = {}
+        for workers in options["concurrency"]:
+            with ThreadPoolExecutor(workers) as pool:
+                started = time.perf_counter()
+                list(pool.map(lambda text: suggest(text, k), queries))
+                throughput[str(workers)] = round(len(queries) / (time.perf_counter() - started), 2)
+
+        self.stderr.write(f"{name}: done")
+        return {
+            "backend": name,
+            **knobs,
+            f"recall@{k}": round(hits / len(queries), 4),
+            "mrr": round(reciprocal / len(queries), 4),
+            **_percentiles(latencies),
+            "throughput_qps": throughput,
+            "build_s": round(build_s, 3),
+            "build_peak_mb": peak_mb,
+        }
+
+    def _compare(self, report, options):
+        with open(options["baseline"], encoding="utf-8") as f:
+            baseline = {row["backend"]: row for row in json.load(f)["results"]}
+        recall = f"recall@{report['k']}"
+        failures = []
+        for row in report["results"]:
+            before = baseline.get(row["backend"])
+            if before is None or recall not in before:
+                continue
+            if row[recall] < before[recall] - options["max_recall_drop"]:
+                failures.append(f"{row['backend']}: {recall} {before[recall]} -> {row[recall]}")
+            if row["p95_ms"] > before["p95_ms"] * (1 + options["max_latency_growth"]):
+                failures.append(f"{row['backend']}: p95 {before['p95_ms']} ms -> {row['p95_ms']} ms")
+        if failures:
+            raise CommandError("Regressions against the baseline:\n" + "\n".join(failures))
+        self.stderr.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,89 @@
+import json
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from firebase import embedding_index, encoders, vector_index
+
+
+def _corpus(base, size, noise, rng):
+    # Grow the real embeddings to `size` rows by jittering them, so the
+    # synthetic corpus keeps the clustering real sentences have
+    rows = base[rng.integers(0, len(base), size)]
+    rows = rows + rng.normal(scale=noise, size=rows.shape).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+class Command(BaseCommand):
+    # System checks import the URLconf, which would load the suggestion index
+    requires_system_checks = []
+    help = "Compare suggestion index backends: recall@k against exact search, and query latency, per corpus size."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+        # hybrid needs corpus text, which the synthetic corpora do not have
+        parser.add_argument("--backends", nargs="+",
+                            default=[name for name, cls in vector_index.BACKENDS.items() if not getattr(cls, "uses_text", False)])
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--k", type=int, default=5)
+        parser.add_argument("--noise", type=float, default=0.05)
+        parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256],
+                            help="ef_search values to sweep for hnsw")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        # Read the index the workers use; never rebuild it from here with another encoder
+        index = embedding_index.load_index(
+            settings.SUGGEST_CORPUS, settings.SUGGEST_INDEX_DIR,
+            model_name=encoders.encoder_name(settings.SUGGEST_ENCODER), rebuild=False)
+        base = np.asarray(index.embeddings)
+        k = options["k"]
+        report = []
+        for size in options["sizes"]:
+            corpus = _corpus(base, size, options["noise"], rng)
+            queries = _corpus(base, options["queries"], options["noise"], rng)
+            _, truth = vector_index.NumpyIndex(corpus).search(queries, k)
+            for backend in options["backends"]:
+                if getattr(vector_index.BACKENDS.get(backend), "uses_text", False):
+                    self.stderr.write(f"skipping {backend}: needs the corpus text, not synthetic vectors")
+                    continue
+                sweeps = [{"ef_search": ef} for ef in options["ef_search"]] if backend == "hnsw" else [{}]
+                try:
+                    started = time.perf_counter()
+                    index = vector_index.create_index(backend, corpus)
+                    build = time.perf_counter() - started
+                except ImportError as e:
+                    self.stderr.write(f"skipping {backend}: {e}")
+                    continue
+                for knobs in sweeps:
+                    if "ef_search" in knobs:
+                        index.graph.set_ef(knobs["ef_search"])
+                    latencies, hits = [], 0
+                    for query, expected in zip(queries, truth):
+                        started = time.perf_counter()
+                        _, rows = index.search(query, k)
+                        latencies.append(time.perf_counter() - started)
+                        hits += len(set(rows[0]) & set(expected))
+                    latencies = np.array(latencies) * 1000
+                    report.append({
+                        "size": size,
+                        "backend": backend,
+                        **knobs,
+                        f"recall@{k}": round(hits / (len(queries) * k), 4),
+                        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+                        "build_s": round(build, 3),
+                    })
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"{'size':>8} {'backend':<16} {'recall@' + str(k):>9} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8}")
+        for row in report:
+            name = row["backend"] + (f" ef={row['ef_search']}" if "ef_search" in row else "")
+            self.stdout.write(
+                f"{row['size']:>8} {name:<16} {row[f'recall@{k}']:>9} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['build_s']:>8}"
+            )
@@ -0,0 +1,377 @@
+"""Firestore access for conversations.
+
+Two layouts live side by side while ``migrate_chats`` runs:
+
+- "array": the original layout, every message in the ``data`` array of
+  ``<email>/<contact>``.
+- "messages": one document per message under
+  ``<email>/<contact>/messages/<message id>``, ordered by timestamp. The
+  parent document only keeps the ``count`` and a ``layout`` marker, so it
+  never grows towards the 1 MiB document limit.
+
+New messages go to the layout named by ``CHAT_STORAGE_LAYOUT``; reads
+merge whatever is in either layout.
+"""
+from datetime import datetime, timezone
+from django.conf import settings
+import hashlib
+import json
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1 import Query
+from google.cloud.firestore_v1 import ArrayUnion, Increment
+
+_db = None
+
+
+def get_db():
+    """The Firestore client, created on first use rather than at import."""
+    global _db
+    if _db is None:
+        # Initialize only if not already initialized
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.Certificate("firebase.json"))
+        _db = firestore.client()
+    return _db
+
+
+def __getattr__(name):
+    # Keeps `storage.db` working for callers outside this module
+    if name == "db":
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+MESSAGES = "messages"
+MAX_PAGE = 500
+MAX_BATCH_OPS = 500
+
+
+def conversation_ref(email, selected):
+    return get_db().collection(email).document(selected)
+
+
+def message_doc(collection, message):
+    """The message's document in a messages collection (sync or async)."""
+    if message.get("id"):
+        return collection.document(str(message["id"]))
+    return collection.document()
+
+
+def content_id(message):
+    """A document id derived from the message's own fields, for messages sent without one.
+
+    The same message always gets the same id, so writing it twice
+    overwrites one document instead of adding another.
+    """
+    key = json.dumps({k: v for k, v in message.items() if k != "id"}, sort_keys=True, default=str)
+    return "c-" + hashlib.blake2b(key.encode(), digest_size=12).hexdigest()
+
+
+def message_ref(email, selected, message):
+    return message_doc(conversation_ref(email, selected).collection(MESSAGES), message)
+
+
+def with_timestamp(message):
+    # Per-message docs are ordered by timestamp; Firestore drops documents
+    # that lack the ordered field from the query entirely.
+    if message.get("timestamp"):
+        return message
+    return dict(message, timestamp=datetime.now(timezone.utc).isoformat())
+
+
+def storage_layout():
+    return getattr(settings, "CHAT_STORAGE_LAYOUT", "array")
+
+
+def prepare_message(message):
+    """The message exactly as append_message/stage_messages will store it."""
+    return with_timestamp(message) if storage_layout() == MESSAGES else message
+
+
+def append_message(email, selected, message):
+    """Append one message to a conversation.
+
+    "merge" mode is a single write; the sequence number is the write's
+    update time in microseconds, which Firestore keeps monotonic per
+    document. "transaction" mode reads the counter inside a transaction so
+    every message gets a gap-free integer position.
+
+    Returns ``(seq, message)`` with the message as it was stored.
+    """
+    doc_ref = conversation_ref(email, selected)
+    message = prepare_message(message)
+    if getattr(settings, "CHAT_APPEND_MODE", "merge") == "transaction":
+        return _append_ordered(get_db().transaction(), doc_ref, message, storage_layout())
+
+    if storage_layout() == MESSAGES:
+        batch = get_db().batch()
+        stage_messages(batch, email, selected, [message])
+        result = batch.commit()[-1]
+    else:
+        result = doc_ref.set(append_update([message], storage_layout()), merge=True)
+    return write_seq(result), message
+
+
+def write_seq(result):
+    """The "merge" mode sequence number of a write: its update time in microseconds."""
+    return int(result.update_time.timestamp() * 1_000_000)
+
+
+def append_update(messages, layout):
+    """The parent document update that appends ``messages`` in "merge" mode."""
+    if layout == MESSAGES:
+        return {"count": Increment(len(messages)), "layout": MESSAGES}
+    return {"data": ArrayUnion(messages), "count": Increment(len(messages))}
+
+
+@firestore.transactional
+def _append_ordered(transaction, doc_ref, message, layout):
+    snapshot = doc_ref.get(transaction=transaction)
+    current = snapshot.to_dict() or {}
+    seq = current.get("count", len(current.get("data", []))) + 1
+    message = dict(message, seq=seq)
+    if layout == MESSAGES:
+        transaction.set(message_doc(doc_ref.collection(MESSAGES), message), message)
+        transaction.set(doc_ref, {"count": seq, "layout": MESSAGES}, merge=True)
+    else:
+        transaction.set(doc_ref, {"data": ArrayUnion([message]), "count": seq}, merge=True)
+    return seq, message
+
+
+def stage_messages(batch, email, selected, messages):
+    """Add writes for several messages of one conversation to a batch.
+
+    Returns the number of operations staged. Sequence numbers are not
+    assigned here; batched writes always use the "merge" append semantics.
+    """
+    doc_ref = conversation_ref(email, selected)
+    layout = storage_layout()
+    if layout == MESSAGES:
+        for message in messages:
+            batch.set(message_ref(email, selected, message), message)
+    batch.set(doc_ref, append_update(messages, layout), merge=True)
+    return len(messages) + 1 if layout == MESSAGES else 1
+
+
+def write_grouped(groups, max_ops=MAX_BATCH_OPS):
+    """Commit ``{(email, selected): [messages]}`` in as few batches as fit.
+
+    Returns the number of batch commits made.
+    """
+    batch, ops, commits = get_db().batch(), 0, 0
+    per_chunk = max_ops - 1  # room for the parent counter write
+    for (email, selected), messages in groups.items():
+        for start in range(0, len(messages), per_chunk):
+            chunk = messages[start:start + per_chunk]
+            needed = len(chunk) + 1 if storage_layout() == MESSAGES else 1
+            if ops and ops + needed > max_ops:
+                batch.commit()
+                batch, ops, commits = get_db().batch(), 0, commits + 1
+            ops += stage_messages(batch, email, selected, chunk)
+    if ops:
+        batch.commit()
+        commits += 1
+    return commits
+
+
+def existing_ids(email, selected, ids):
+    """The ids among ``ids`` already stored as per-message docs of a conversation."""
+    if not ids:
+        return set()
+    collection = conversation_ref(email, selected).collection(MESSAGES)
+    refs = [collection.document(str(i)) for i in ids]
+    return {snapshot.id for snapshot in get_db().get_all(refs, field_paths=["id"]) if snapshot.exists}
+
+
+def merge_messages(legacy, migrated):
+    """Legacy array messages first, then per-message docs not already seen.
+
+    Anything in the subcollection but not in the array was written after the
+    conversation switched layouts, so it always comes later.
+    """
+    seen = {m.get("id") for m in legacy if m.get("id")}
+    return legacy + [m for m in migrated if not m.get("id") or m.get("id") not in seen]
+
+
+def merge_pending(stored, pending):
+    """Stored messages plus the write-behind ones not committed among them yet."""
+    stored = stored or []
+    ids = {m.get("id") for m in stored if m.get("id")}
+    return stored + [m for m in pending if (m.get("id") not in ids if m.get("id") else m not in stored)]
+
+
+def iter_messages(email, selected, since=None, page_size=MAX_PAGE):
+    """Yield a conversation's messages oldest first, one page in memory at a time.
+
+    ``since`` (message id or timestamp) skips everything up to and
+    including that message.
+    """
+    doc_ref = conversation_ref(email, selected)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return
+    current = doc.to_dict()
+    if current.get("layout") != MESSAGES or current.get("data"):
+        messages = merge_messages(current.get("data", []), _stream_all(doc_ref, current))
+        if since is not None:
+            messages, _ = paginate(messages, since=since)
+        yield from messages
+        return
+
+    collection = doc_ref.collection(MESSAGES)
+    cursor = _cursor(collection, since) if since is not None else None
+    while True:
+        query = collection.order_by("timestamp")
+        if cursor is not None:
+            query = query.start_after(cursor)
+        snapshots = list(query.limit(page_size).stream())
+        for snapshot in snapshots:
+            yield snapshot.to_dict()
+        if len(snapshots) < page_size:
+            return
+        cursor = snapshots[-1]
+
+
+def _stream_all(doc_ref, current):
+    if current.get("layout") != MESSAGES:
+        return []
+    query = page_query(doc_ref.collection(MESSAGES), None, forward=True)
+    return [snapshot.to_dict() for snapshot in query.stream()]
+
+
+def read_messages(email, selected):
+    """Return the whole conversation, or None if it does not exist."""
+    doc_ref = conversation_ref(email, selected)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return None
+    current = doc.to_dict()
+    return merge_messages(current.get("data", []), _stream_all(doc_ref, current))
+
+
+def _timestamp(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def message_cursor(message):
+    """The cursor that points at message: its id, or its timestamp if it has none."""
+    if message.get("id"):
+        return message["id"]
+    return _timestamp(message["timestamp"]) if message.get("timestamp") else None
+
+
+def _position(messages, cursor):
+    for i, message in enumerate(messages):
+        if str(message.get("id")) == str(cursor):
+            return i
+    return None
+
+
+def paginate(messages, limit=None, before=None, since=None):
+    """Cut one page out of an in-memory conversation.
+
+    ``before``/``since`` are a message id or a timestamp. ``since`` pages
+    forward from the cursor (delta sync); otherwise the page is the newest
+    ``limit`` messages older than ``before``. Returns ``(page, next_cursor)``
+    where ``next_cursor`` (see ``message_cursor``) is None once there is
+    nothing left in that direction.
+    """
+    if since is not None:
+        i = _position(messages, since)
+        if i is not None:
+            page = messages[i + 1:]
+        else:
+            page = [m for m in messages if _timestamp(m.get("timestamp", "")) > str(since)]
+        if limit and len(page) > limit:
+            page = page[:limit]
+            return page, message_cursor(page[-1])
+        return page, None
+
+    page = messages
+    if before is not None:
+        i = _position(messages, before)
+        if i is not None:
+            page = messages[:i]
+        else:
+            page = [m for m in messages if _timestamp(m.get("timestamp", "")) < str(before)]
+    if limit and len(page) > limit:
+        page = page[-limit:]
+        return page, message_cursor(page[0])
+    return page, None
+
+
+def cursor_position(snapshot, cursor):
+    """Where a cursor points: its message's snapshot, or a bare timestamp if no message has that id."""
+    return snapshot if snapshot.exists else {"timestamp": cursor}
+
+
+def _cursor(collection, cursor):
+    return cursor_position(collection.document(str(cursor)).get(), cursor)
+
+
+def paged_in_memory(current):
+    """Whether a conversation document is paged in memory rather than in Firestore.
+
+    Anything still holding a ``data`` array arrives in one read anyway.
+    """
+    return current.get("layout") != MESSAGES or bool(current.get("data"))
+
+
+def page_query(collection, limit, cursor=None, forward=False):
+    """The query for one page of the messages collection (sync or async).
+
+    ``forward`` pages oldest first after ``cursor`` (``since``); otherwise
+    newest first before it. One row more than ``limit`` is asked for, so
+    ``cut_page`` can tell whether there is a next page.
+    """
+    query = collection.order_by("timestamp", direction=Query.ASCENDING if forward else Query.DESCENDING)
+    if cursor is not None:
+        query = query.start_after(cursor)
+    if limit:
+        query = query.limit(limit + 1)
+    return query
+
+
+def cut_page(rows, limit, forward=False):
+    """``(page, next_cursor)`` from the rows of a ``page_query``, page oldest first."""
+    more = bool(limit) and len(rows) > limit
+    page = rows[:limit] if limit else rows
+    if forward:
+        return page, (message_cursor(page[-1]) if more else None)
+    page = list(reversed(page))
+    return page, (message_cursor(page[0]) if more else None)
+
+
+def page_limit(limit):
+    """A requested page size as served: None (no limit) or 1..MAX_PAGE."""
+    return None if limit is None else max(1, min(int(limit), MAX_PAGE))
+
+
+def read_page(email, selected, limit=None, before=None, since=None):
+    """Return ``(messages, next_cursor)`` for one page, or None if the
+    conversation does not exist.
+
+    Conversations fully in the per-message layout are paged in Firestore,
+    the rest in memory (see ``paged_in_memory``).
+    """
+    limit = page_limit(limit)
+    if limit is None and before is None and since is None:
+        messages = read_messages(email, selected)
+        return None if messages is None else (messages, None)
+
+    doc_ref = conversation_ref(email, selected)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return None
+    current = doc.to_dict()
+    if paged_in_memory(current):
+        messages = merge_messages(current.get("data", []), _stream_all(doc_ref, current))
+        return paginate(messages, limit, before, since)
+
+    collection = doc_ref.collection(MESSAGES)
+    forward = since is not None
+    cursor = since if forward else before
+    position = _cursor(collection, cursor) if cursor is not None else None
+    rows = [snapshot.to_dict() for snapshot in page_query(collection, limit, position, forward).stream()]
+    return cut_page(rows, limit, forward)
+
@@ -0,0 +1,107 @@
+"""Async counterparts of the storage.py calls the async views make.
+
+Same layouts, same documents, same results; only the client differs:
+Firestore's ``AsyncClient``, one per event loop, so a view awaiting
+Firestore frees its worker for other requests. Everything but the awaits
+is storage.py's (limits, cursors, queries, page cuts, message prep and
+the append writes), so the two cannot drift apart, and "transaction"
+append mode still runs the sync transaction in a thread.
+"""
+import asyncio
+import threading
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from . import storage
+from .storage import (
+    MESSAGES, append_update, cursor_position, cut_page, merge_messages, message_doc, page_limit, page_query,
+    paged_in_memory, paginate, prepare_message, storage_layout, write_seq,
+)
+
+_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncClient
+_lock = threading.Lock()
+
+
+def get_db():
+    """The Firestore AsyncClient for the running event loop."""
+    from google.cloud import firestore
+
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if loop not in _clients:
+            storage.get_db()  # initializes the firebase_admin app
+            import firebase_admin
+
+            app = firebase_admin.get_app()
+            _clients[loop] = firestore.AsyncClient(project=app.project_id, credentials=app.credential.get_credential())
+        return _clients[loop]
+
+
+def conversation_ref(email, selected):
+    return get_db().collection(email).document(selected)
+
+
+async def append_message(email, selected, message):
+    """Async storage.append_message: ``(seq, message)`` as stored."""
+    if getattr(settings, "CHAT_APPEND_MODE", "merge") == "transaction":
+        return await sync_to_async(storage.append_message, thread_sensitive=False)(email, selected, message)
+
+    doc_ref = conversation_ref(email, selected)
+    message = prepare_message(message)
+    layout = storage_layout()
+    if layout == MESSAGES:
+        batch = get_db().batch()
+        batch.set(message_doc(doc_ref.collection(MESSAGES), message), message)
+        batch.set(doc_ref, append_update([message], layout), merge=True)
+        result = (await batch.commit())[-1]
+    else:
+        result = await doc_ref.set(append_update([message], layout), merge=True)
+    return write_seq(result), message
+
+
+async def _stream(query):
+    return [snapshot.to_dict() async for snapshot in query.stream()]
+
+
+async def _stream_all(doc_ref, current):
+    if current.get("layout") != MESSAGES:
+        return []
+    return await _stream(page_query(doc_ref.collection(MESSAGES), None, forward=True))
+
+
+async def read_messages(email, selected):
+    """Return the whole conversation, or None if it does not exist."""
+    doc_ref = conversation_ref(email, selected)
+    doc = await doc_ref.get()
+    if not doc.exists:
+        return None
+    current = doc.to_dict()
+    return merge_messages(current.get("data", []), await _stream_all(doc_ref, current))
+
+
+async def _cursor(collection, cursor):
+    return cursor_position(await collection.document(str(cursor)).get(), cursor)
+
+
+async def read_page(email, selected, limit=None, before=None, since=None):
+    """Async storage.read_page: ``(messages, next_cursor)`` or None."""
+    limit = page_limit(limit)
+    if limit is None and before is None and since is None:
+        messages = await read_messages(email, selected)
+        return None if messages is None else (messages, None)
+
+    doc_ref = conversation_ref(email, selected)
+    doc = await doc_ref.get()
+    if not doc.exists:
+        return None
+    current = doc.to_dict()
+    if paged_in_memory(current):
+        messages = merge_messages(current.get("data", []), await _stream_all(doc_ref, current))
+        return paginate(messages, limit, before, since)
+
+    collection = doc_ref.collection(MESSAGES)
+    forward = since is not None
+    cursor = since if forward else before
+    position = await _cursor(collection, cursor) if cursor is not None else None
+    return cut_page(await _stream(page_query(collection, limit, position, forward)), limit, forward)
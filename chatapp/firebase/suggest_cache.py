@@ -0,0 +1,141 @@
+"""Two cache tiers in front of the reply suggester.
+
+Inputs are normalized first (case, punctuation, whitespace), so "Hey!",
+"hey" and "  HEY  " share entries.
+
+- ``SuggestionCache``: in-process LRU of final suggestion lists, keyed by
+  normalized text, the normalized earlier turns and ``top_k``.
+- ``EmbeddingCache``: SQLite-backed store of query embeddings keyed by a
+  hash of the normalized text, so encodes survive restarts and are shared
+  by every worker on the host.
+
+Both are tied to the index checksum and are emptied when the index is
+rebuilt.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+from .cache import LRUCache
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    text = _PUNCTUATION.sub(" ", str(text).lower())
+    return _SPACES.sub(" ", text).strip()
+
+
+class SuggestionCache:
+    def __init__(self, checksum, max_entries=10_000, ttl=3600):
+        self.checksum = checksum
+        self.lru = LRUCache(max_entries, ttl)
+
+    def _key(self, text, top_k, context):
+        return normalize_text(text), tuple(normalize_text(turn) for turn in context), top_k
+
+    def get(self, text, top_k, context=()):
+        return self.lru.get(self._key(text, top_k, context), None)
+
+    def set(self, text, top_k, suggestions, context=()):
+        self.lru.set(self._key(text, top_k, context), suggestions)
+
+    def reset(self, checksum):
+        self.checksum = checksum
+        self.lru.clear()
+
+    def stats(self):
+        return self.lru.stats()
+
+
+class EmbeddingCache:
+    def __init__(self, path, checksum, model_name, max_entries=100_000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB, dim INTEGER, created REAL, used REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.hits = self.misses = self.evictions = 0
+        self._writes = 0
+        self.reset(checksum)
+
+    def reset(self, checksum):
+        """Empty the cache if it was filled against a different index."""
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE name = 'checksum'").fetchone()
+            if row is None or row[0] != checksum:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('checksum', ?)", (checksum,))
+
+    def _key(self, text):
+        return hashlib.sha1(f"{self.model_name}\0{normalize_text(text)}".encode()).hexdigest()
+
+    def get_many(self, texts):
+        """Return a list aligned with ``texts``: a vector, or None on a miss."""
+        keys = [self._key(text) for text in texts]
+        now = time.time()
+        with self._lock:
+            placeholders = ",".join("?" * len(keys))
+            rows = self._db.execute(
+                f"SELECT key, vector, dim, created FROM embeddings WHERE key IN ({placeholders})", keys
+            ).fetchall()
+            import numpy as np
+
+            found = {}
+            for key, vector, dim, created in rows:
+                if self.ttl and created + self.ttl < now:
+                    continue
+                found[key] = np.frombuffer(vector, dtype=np.float32, count=dim)
+            if found:
+                self._db.executemany("UPDATE embeddings SET used = ? WHERE key = ?", [(now, k) for k in found])
+        result = [found.get(key) for key in keys]
+        hits = sum(vector is not None for vector in result)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return result
+
+    def set_many(self, texts, vectors):
+        import numpy as np
+
+        now = time.time()
+        rows = [
+            (self._key(text), np.asarray(vector, dtype=np.float32).tobytes(), len(vector), now, now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self._writes += len(rows)
+            if self._writes >= max(self.max_entries // 100, 1):
+                self._writes = 0
+                self._trim()
+
+    def _trim(self):
+        # Least recently used first; checked every ~1% of max_entries writes
+        count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+        if self.ttl:
+            self._db.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - self.ttl,))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
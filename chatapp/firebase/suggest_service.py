@@ -0,0 +1,194 @@
+"""Standalone suggestion service over a Unix socket.
+
+``manage.py run_suggest_service`` binds ``SUGGEST_SERVICE["SOCKET"]`` and
+forks ``WORKERS`` processes that all accept on it, so the kernel spreads
+connections across them. Each worker loads the suggestion engine once;
+the corpus embeddings are memory-mapped, so every worker shares one
+page-cache copy. Requests inside a worker run on a small thread pool and
+meet in the engine's micro-batcher.
+
+Backpressure: a worker with ``MAX_INFLIGHT`` requests already queued or
+running answers new ones with ``busy`` straight away instead of letting
+them pile up. The Django side (``request``) turns that into
+``ServiceBusy`` and a slow or missing service into ``ServiceTimeout`` /
+``ServiceUnavailable``, so web workers never block on suggestion CPU for
+longer than ``TIMEOUT``.
+
+Wire format: one JSON object per line each way, one request per
+connection.
+"""
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+
+class ServiceError(Exception):
+    pass
+
+
+class ServiceUnavailable(ServiceError):
+    pass
+
+
+class ServiceBusy(ServiceError):
+    pass
+
+
+class ServiceTimeout(ServiceError):
+    pass
+
+
+def _config():
+    return getattr(settings, "SUGGEST_SERVICE", {})
+
+
+def enabled():
+    return bool(_config().get("SOCKET"))
+
+
+def _read_line(conn, limit=1 << 20):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > limit:
+            raise ValueError("Request too large")
+    return data
+
+
+def request(payload, timeout=None):
+    """Send one request to the service and return its JSON reply."""
+    config = _config()
+    timeout = config.get("TIMEOUT", 2.0) if timeout is None else timeout
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(timeout)
+            conn.connect(str(config["SOCKET"]))
+            conn.sendall(json.dumps(payload).encode() + b"\n")
+            reply = _read_line(conn)
+    except socket.timeout as e:
+        raise ServiceTimeout(f"Suggestion service did not answer within {timeout}s") from e
+    except (FileNotFoundError, ConnectionRefusedError, ConnectionResetError) as e:
+        raise ServiceUnavailable(f"Suggestion service is not running: {e}") from e
+    if not reply:
+        raise ServiceUnavailable("Suggestion service closed the connection")
+    reply = json.loads(reply)
+    if reply.get("busy"):
+        raise ServiceBusy(reply.get("error", "Suggestion service is busy"))
+    if "error" in reply:
+        raise ServiceError(reply["error"])
+    return reply
+
+
+def get_replies(user_input, top_k=5, context=()):
+    payload = {"op": "suggest", "text": user_input, "top_k": top_k, "context": list(context)}
+    return request(payload)["suggestions"]
+
+
+# Server side
+
+class _Worker:
+    def __init__(self, listener, threads, max_inflight):
+        from . import suggester
+
+        self.listener = listener
+        self.engine = suggester.get_engine()
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="suggest-service")
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.served = self.rejected = self.failed = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        while True:
+            conn, _ = self.listener.accept()
+            if not self.slots.acquire(blocking=False):
+                self.rejected += 1
+                self._reply(conn, {"error": "Suggestion service is busy", "busy": True})
+                continue
+            self.pool.submit(self._handle, conn)
+
+    def _reply(self, conn, payload):
+        try:
+            conn.sendall(json.dumps(payload).encode() + b"\n")
+        except OSError:
+            pass  # client gave up
+        finally:
+            conn.close()
+
+    def _handle(self, conn):
+        try:
+            conn.settimeout(5)
+            body = json.loads(_read_line(conn))
+            op = body.get("op", "suggest")
+            if op == "suggest":
+                suggestions = self.engine.get_replies(
+                    str(body["text"]), int(body.get("top_k", 5)), body.get("context") or ())
+                reply = {"suggestions": suggestions}
+            elif op == "ping":
+                reply = {"pid": os.getpid(), "ready": True}
+            elif op == "stats":
+                reply = {"pid": os.getpid(), "served": self.served, "rejected": self.rejected, "failed": self.failed}
+            else:
+                reply = {"error": f"Unknown op {op!r}"}
+            self.served += 1
+        except Exception as e:
+            self.failed += 1
+            reply = {"error": str(e)}
+        finally:
+            self.slots.release()
+        self._reply(conn, reply)
+
+
+def _worker_main(listener, threads, max_inflight):
+    _Worker(listener, threads, max_inflight).run()
+
+
+def serve(path, workers=2, threads=8, max_inflight=64, backlog=512, log=print):
+    """Bind the socket, fork the workers and keep them running until SIGTERM/SIGINT."""
+    path = str(path)
+    if os.path.exists(path):
+        os.unlink(path)  # stale socket from a previous run
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    os.chmod(path, 0o660)
+    listener.listen(backlog)
+
+    ctx = multiprocessing.get_context("fork")
+
+    def spawn():
+        proc = ctx.Process(target=_worker_main, args=(listener, threads, max_inflight), daemon=True)
+        proc.start()
+        return proc
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    procs = [spawn() for _ in range(workers)]
+    log(f"Suggestion service on {path} with {workers} workers")
+    try:
+        while not stopping.is_set():
+            for i, proc in enumerate(procs):
+                if not proc.is_alive():
+                    log(f"Worker {proc.pid} exited with {proc.exitcode}; restarting")
+                    procs[i] = spawn()
+            stopping.wait(1)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        deadline = time.monotonic() + 10
+        for proc in procs:
+            proc.join(max(deadline - time.monotonic(), 0))
+        listener.close()
+        if os.path.exists(path):
+            os.unlink(path)
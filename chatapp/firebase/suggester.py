@@ -0,0 +1,237 @@
+"""The reply suggestion engine, loaded on first use.
+
+Importing this module is cheap: numpy, the encoder (torch or onnxruntime),
+the memory-mapped index and the caches are only loaded when the first
+``/suggest/`` call arrives or when ``warm_up()`` is called (wsgi.py/asgi.py
+do so when ``SUGGEST_WARMUP`` is on). Message and auth endpoints never pay
+for them. ``readiness()`` reports where loading stands.
+
+With ``SUGGEST_SERVICE["SOCKET"]`` set, the engine lives in the standalone
+suggestion service instead (see suggest_service.py) and Django processes
+never load it at all.
+
+Context: a query can carry the turns before the newest message. Each
+turn is embedded on its own (through the embedding cache, so in a running
+chat only the newest message is new) and the query vector is their
+recency-weighted mean: the newest turn has weight 1, the one before it
+``DECAY``, then ``DECAY**2`` and so on (``SUGGEST_CONTEXT``).
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from chatapp import metrics
+from . import suggest_service
+
+_engine = None
+_lock = threading.Lock()
+_state = {"status": "cold", "error": None, "load_seconds": None}
+
+
+class SuggestionEngine:
+    def __init__(self):
+        import numpy as np
+        from . import batching, embedding_index, encoders, learning, suggest_cache, vector_index
+
+        self._np = np
+        self._normalize = suggest_cache.normalize_text
+
+        # Load embeddings model (fp32 torch or int8 ONNX, see encoders.py)
+        self.model = encoders.get_encoder(settings.SUGGEST_ENCODER)
+
+        # Memory-map the prebuilt corpus embeddings (built on first use if
+        # missing, unless SUGGEST_INDEX_AUTO_BUILD leaves that to the command)
+        self.index = embedding_index.load_index(
+            settings.SUGGEST_CORPUS, settings.SUGGEST_INDEX_DIR, model=self.model, model_name=self.model.name,
+            rebuild=getattr(settings, "SUGGEST_INDEX_AUTO_BUILD", True))
+
+        # Nearest-neighbour search over the corpus (see vector_index.py)
+        self.knn = vector_index.create_index(
+            settings.SUGGEST_INDEX_BACKEND,
+            self.index.embeddings,
+            index_dir=settings.SUGGEST_INDEX_DIR,
+            checksum=self.index.checksum,
+            model=self.model.name,
+            corpus=settings.SUGGEST_CORPUS,
+            **settings.SUGGEST_INDEX_OPTIONS,
+        )
+
+        # Suggestion lists per normalized input, and a persistent store of
+        # input embeddings shared by all workers (see suggest_cache.py)
+        self.suggestion_cache = suggest_cache.SuggestionCache(
+            self.index.checksum,
+            max_entries=settings.SUGGEST_CACHE.get("MAX_ENTRIES", 10_000),
+            ttl=settings.SUGGEST_CACHE.get("TTL", 3600),
+        )
+        self.embedding_cache = suggest_cache.EmbeddingCache(
+            settings.SUGGEST_CACHE.get("EMBEDDING_PATH", settings.SUGGEST_INDEX_DIR / "query-embeddings.sqlite3"),
+            self.index.checksum,
+            self.model.name,
+            max_entries=settings.SUGGEST_CACHE.get("EMBEDDING_MAX_ENTRIES", 100_000),
+            ttl=settings.SUGGEST_CACHE.get("EMBEDDING_TTL"),
+        )
+        metrics.register("suggestion_cache", self.suggestion_cache.stats)
+        metrics.register("embedding_cache", self.embedding_cache.stats)
+
+        self.batcher = None
+        if settings.SUGGEST_BATCH.get("ENABLED"):
+            self.batcher = batching.MicroBatcher(
+                self.replies_for_batch,
+                max_batch=settings.SUGGEST_BATCH.get("MAX_BATCH", 32),
+                max_wait_ms=settings.SUGGEST_BATCH.get("MAX_WAIT_MS", 5),
+                name="suggest-batcher",
+            )
+            metrics.register("suggest_batching", self.batcher.stats)
+
+        # Pairs learned from live chats, searched next to the corpus (see learning.py)
+        self.learned = None
+        if learning.enabled():
+            config = settings.SUGGEST_LEARNING
+            self.learned = learning.LiveIndex(
+                learning.PairLog(config["PATH"]),
+                self.encode,
+                dim=self.index.embeddings.shape[1],
+                batch=config.get("BATCH", 64),
+            )
+            metrics.register("learned_pairs", self.learned.stats)
+            threading.Thread(target=self._learn, name="suggest-learner", daemon=True).start()
+
+    def _learn(self):
+        config = settings.SUGGEST_LEARNING
+        while True:
+            try:
+                if self.learned.sync():
+                    # Cached suggestion lists predate the new pairs
+                    self.suggestion_cache.reset(f"{self.index.checksum}:{self.learned.generation}")
+                stats = self.learned.stats()
+                if stats["tombstones"] > config.get("COMPACT_RATIO", 0.3) * max(stats["pairs"], 1):
+                    self.learned.log.compact()
+            except Exception as e:
+                print("Error:", e)
+            time.sleep(config.get("INTERVAL", 30))
+
+    def encode(self, texts):
+        """Normalized embeddings for texts, encoding only the ones not cached."""
+        texts = [self._normalize(text) for text in texts]
+        vecs = self.embedding_cache.get_many(texts)
+        missing = [i for i, vec in enumerate(vecs) if vec is None]
+        if missing:
+            fresh = self.model.encode([texts[i] for i in missing], convert_to_tensor=False, normalize_embeddings=True)
+            self.embedding_cache.set_many([texts[i] for i in missing], fresh)
+            for i, vec in zip(missing, fresh):
+                vecs[i] = vec
+        return self._np.vstack(vecs)
+
+    def query_vectors(self, items):
+        """One pooled, normalized vector per (text, top_k, context) item."""
+        decay = settings.SUGGEST_CONTEXT.get("DECAY", 0.5)
+        turns = [list(context) + [text] for text, _, context in items]
+        # Every turn of every item in one encode call
+        unique = list(dict.fromkeys(self._normalize(turn) for item in turns for turn in item))
+        vecs = dict(zip(unique, self.encode(unique)))
+        pooled = self._np.vstack([
+            sum(decay ** age * vecs[self._normalize(turn)] for age, turn in enumerate(reversed(item)))
+            for item in turns
+        ])
+        return pooled / self._np.clip(self._np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def replies_for_batch(self, items):
+        """Suggestions for a list of (text, top_k, context): one encode, one index search."""
+        vecs = self.query_vectors(items)
+        k = max(top_k for _, top_k, _ in items)
+        if getattr(self.knn, "uses_text", False):
+            scores, indices = self.knn.search(vecs, k, texts=[self._normalize(text) for text, _, _ in items])
+        else:
+            scores, indices = self.knn.search(vecs, k)
+        if self.learned is None:
+            return [[self.index.replies[idx] for idx in row[:top_k]] for row, (_, top_k, _) in zip(indices, items)]
+        learned_scores, learned_replies = self.learned.search(vecs, k)
+        results = []
+        for i, (_, top_k, _) in enumerate(items):
+            ranked = [(score, self.index.replies[idx]) for score, idx in zip(scores[i], indices[i])]
+            ranked += zip(learned_scores[i], learned_replies[i])
+            ranked.sort(key=lambda pair: -pair[0])
+            results.append([reply for _, reply in ranked[:top_k]])
+        return results
+
+    def get_replies(self, user_input, top_k=5, context=()):
+        context = trim_context(context)
+        results = self.suggestion_cache.get(user_input, top_k, context)
+        if results is not None:
+            return results
+        item = (user_input, top_k, context)
+        if self.batcher is not None:
+            results = self.batcher.submit(item, timeout=settings.SUGGEST_BATCH.get("TIMEOUT", 10))
+        else:
+            results = self.replies_for_batch([item])[0]
+        self.suggestion_cache.set(user_input, top_k, results, context)
+        return results
+
+
+def trim_context(context):
+    """The earlier turns that count, oldest first: at most TURNS - 1 of them."""
+    keep = settings.SUGGEST_CONTEXT.get("TURNS", 4) - 1
+    context = [str(turn) for turn in context if str(turn).strip()]
+    return tuple(context[-keep:]) if keep > 0 else ()
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                _state["status"] = "loading"
+                started = time.perf_counter()
+                try:
+                    _engine = SuggestionEngine()
+                except Exception as e:
+                    _state.update(status="failed", error=str(e))
+                    raise
+                _state.update(status="ready", error=None, load_seconds=round(time.perf_counter() - started, 3))
+    return _engine
+
+
+def get_replies(user_input, top_k=5, context=()):
+    """Suggestions for user_input; context is the earlier turns, oldest first."""
+    if suggest_service.enabled():
+        return suggest_service.get_replies(user_input, top_k, trim_context(context))
+    return get_engine().get_replies(user_input, top_k, context)
+
+
+def warm_up(background=True):
+    """Load the engine now instead of on the first request."""
+    if suggest_service.enabled():
+        return
+    if not background:
+        return get_engine()
+
+    def run():
+        try:
+            get_engine()
+        except Exception as e:
+            print("Suggestion warm-up failed:", e)
+
+    threading.Thread(target=run, name="suggest-warmup", daemon=True).start()
+
+
+_probe = {"at": 0.0, "state": None}
+
+
+def readiness(max_age=0):
+    """Where loading stands; with the service, a ping no older than max_age seconds."""
+    if suggest_service.enabled():
+        if _probe["state"] is not None and time.monotonic() - _probe["at"] < max_age:
+            return _probe["state"]
+        try:
+            suggest_service.request({"op": "ping"})
+            state = {"status": "service", "error": None, "ready": True}
+        except suggest_service.ServiceError as e:
+            state = {"status": "service unavailable", "error": str(e), "ready": False}
+        _probe.update(at=time.monotonic(), state=state)
+        return state
+    return dict(_state, ready=_state["status"] == "ready")
+
+
+# /stats/ can be polled often: don't make every hit a round trip to the service
+metrics.register("suggester", lambda: readiness(max_age=10))
@@ -1,27 +1,24 @@
-import pandas as pd
 from sentence_transformers import SentenceTransformer
 from sklearn.neighbors import NearestNeighbors
-
-# Load data
-df = pd.read_csv(r"D:\Video\chatapp\firebase\chats.csv")
+from embedding_index import load_index
 
 # Use a pretrained sentence embedding model
 model = SentenceTransformer("all-MiniLM-L6-v2")
 
-# Encode input sentences
-X = model.encode(df["input"], convert_to_tensor=False)
+# Reuse the prebuilt index from firebase/index instead of encoding chats.csv
+index = load_index(model=model)
 
 # Fit NearestNeighbors
 knn = NearestNeighbors(n_neighbors=5, metric="cosine")
-knn.fit(X)
+knn.fit(index.embeddings)
 
 def get_replies(user_input, top_k=5):
-    vec = model.encode([user_input], convert_to_tensor=False)
+    vec = model.encode([user_input], convert_to_tensor=False, normalize_embeddings=True)
     distances, indices = knn.kneighbors(vec, n_neighbors=top_k)
     
     results = []
     for idx, dist in zip(indices[0], distances[0]):
-        results.append((df["reply"].iloc[idx], 1-dist))  # similarity = 1 - distance
+        results.append((index.replies[idx], 1-dist))  # similarity = 1 - distance
     return results
 
 # Example
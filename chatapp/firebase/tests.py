@@ -1,3 +1,1038 @@
-from django.test import TestCase
+import io
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from chatapp import metrics
+
+from . import learning, storage
+from .cache import ConversationCache
+from .writebehind import WriteBehindBuffer
+
+
+class WriteBehindTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.buffers = []
+
+    def tearDown(self):
+        # Stop the flush threads without committing anywhere
+        with mock.patch.object(storage, "write_grouped", return_value=0):
+            for buffer in self.buffers:
+                buffer._stopped.set()
+                buffer._wake.set()
+                buffer._thread.join(5)
+
+    def buffer(self, **options):
+        # A long interval: the tests flush by hand
+        buffer = WriteBehindBuffer(self.dir.name, flush_interval=3600, **options)
+        self.buffers.append(buffer)
+        return buffer
+
+    def spool_files(self):
+        return sorted(path.name for path in Path(self.dir.name).glob("messages-*"))
+
+    def test_flush_commits_and_removes_spool(self):
+        buffer = self.buffer()
+        buffer.enqueue("a@x.com", "b@x.com", {"id": "1", "text": "hi"})
+        with mock.patch.object(storage, "write_grouped", return_value=1) as write:
+            buffer.flush()
+        write.assert_called_once_with({("a@x.com", "b@x.com"): [{"id": "1", "text": "hi"}]})
+        self.assertEqual(buffer.pending("a@x.com", "b@x.com"), [])
+        self.assertEqual(buffer.stats()["flushed"], 1)
+        self.assertEqual(len(self.spool_files()), 1)  # only the fresh, empty spool
+
+    def test_pending_during_commit(self):
+        buffer = self.buffer()
+        buffer.enqueue("a@x.com", "b@x.com", {"id": "1"})
+        committing, release, seen = threading.Event(), threading.Event(), []
+
+        def write_grouped(groups):
+            committing.set()
+            release.wait(5)
+            return 1
+
+        with mock.patch.object(storage, "write_grouped", side_effect=write_grouped):
+            flusher = threading.Thread(target=buffer.flush)
+            flusher.start()
+            committing.wait(5)
+            seen.append(buffer.pending("a@x.com", "b@x.com"))
+            release.set()
+            flusher.join(5)
+        self.assertEqual(seen, [[{"id": "1"}]])
+        self.assertEqual(buffer.pending("a@x.com", "b@x.com"), [])
+
+    def test_failing_conversation_does_not_block_others(self):
+        buffer = self.buffer(max_attempts=2, retry_backoff=0)
+        buffer.enqueue("a@x.com", "big", {"id": "1"})
+        buffer.enqueue("c@x.com", "d@x.com", {"id": "2"})
+
+        def write_grouped(groups):
+            if ("a@x.com", "big") in groups:
+                raise ValueError("document too large")
+            return 1
+
+        with mock.patch.object(storage, "write_grouped", side_effect=write_grouped):
+            buffer.flush()
+            self.assertEqual(buffer.pending("c@x.com", "d@x.com"), [])
+            self.assertEqual(buffer.pending("a@x.com", "big"), [{"id": "1"}])
+            buffer.flush()
+        self.assertEqual(buffer.pending("a@x.com", "big"), [])
+        self.assertEqual(buffer.stats()["dead_lettered"], 1)
+        self.assertTrue(list(Path(self.dir.name).glob("dead-letter-*.ndjson")))
+        # Dead letters are not replayed, and no spool is left behind
+        self.assertEqual(len(self.spool_files()), 1)
+
+    def test_failures_back_off_and_do_not_rotate(self):
+        buffer = self.buffer(retry_backoff=60)
+        buffer.enqueue("a@x.com", "b@x.com", {"id": "1"})
+        with mock.patch.object(storage, "write_grouped", side_effect=ValueError("offline")) as write:
+            for _ in range(3):
+                buffer.flush()
+        self.assertEqual(write.call_count, 1)  # the next attempt waits for the backoff
+        self.assertEqual(len(self.spool_files()), 2)  # the rotated spool and the fresh one
+        self.assertEqual(buffer.stats()["retrying"], 1)
+
+    def test_spool_replayed_after_crash(self):
+        crashed = self.buffer()
+        crashed.enqueue("a@x.com", "b@x.com", {"id": "1"})
+        crashed.enqueue("a@x.com", "b@x.com", {"id": "2"})
+        crashed._spool.close()  # the process died here
+
+        recovered = self.buffer()
+        self.assertEqual(recovered.pending("a@x.com", "b@x.com"), [{"id": "1"}, {"id": "2"}])
+        with mock.patch.object(storage, "write_grouped", return_value=1):
+            recovered.flush()
+        self.assertFalse([name for name in self.spool_files() if "claimed" in name])
+
+    @override_settings(CHAT_STORAGE_LAYOUT="messages")
+    def test_replay_keeps_the_id_given_at_enqueue(self):
+        crashed = self.buffer()
+        queued = crashed.enqueue("a@x.com", "b@x.com", {"text": "no id"})
+        crashed._spool.close()
+
+        recovered = self.buffer()
+        self.assertTrue(queued["id"])
+        self.assertEqual(recovered.pending("a@x.com", "b@x.com"), [queued])
+
+
+class MergePendingTests(SimpleTestCase):
+    def test_committed_messages_are_not_repeated(self):
+        stored = [{"id": "1"}, {"text": "no id"}]
+        pending = [{"id": "1"}, {"text": "no id"}, {"id": "2"}]
+        self.assertEqual(storage.merge_pending(stored, pending), stored + [{"id": "2"}])
+
+    def test_missing_conversation(self):
+        self.assertEqual(storage.merge_pending(None, [{"id": "1"}]), [{"id": "1"}])
+
+
+class PairLogTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.log = learning.PairLog(Path(self.dir.name) / "pairs.ndjson")
+
+    def test_compact_drops_deleted_pairs(self):
+        self.log.append([{"id": "a", "input": "hi", "reply": "hey"}, {"id": "b", "input": "yo", "reply": "sup"}])
+        self.log.append([{"op": "delete", "id": "a"}])
+        self.assertEqual(self.log.compact(), 2)
+        self.assertEqual(list(self.log.live()), ["b"])
+
+    def test_append_waiting_on_compaction_lands_in_new_log(self):
+        self.log.append([{"id": "a", "input": "hi", "reply": "hey"}])
+        lock = self.log._open_locked()  # what compact holds while it rewrites
+        appender = threading.Thread(target=self.log.append, args=([{"op": "delete", "id": "a"}],))
+        appender.start()
+        time.sleep(0.1)
+        tmp = self.log.path.with_name("pairs.ndjson.tmp")
+        tmp.write_text(json.dumps({"id": "a", "input": "hi", "reply": "hey"}) + "\n")
+        os.replace(tmp, self.log.path)
+        lock.close()
+        appender.join(5)
+        # The tombstone was not written into the replaced file
+        self.assertEqual(self.log.live(), {})
+
+    def test_live_index_drops_forgotten_pairs(self):
+        import numpy as np
+
+        encode = lambda texts: np.ones((len(texts), 2), dtype=np.float32) / np.sqrt(2)
+        index = learning.LiveIndex(self.log, encode, dim=2)
+        self.log.append([{"id": "a", "input": "hi", "reply": "hey"}])
+        self.assertTrue(index.sync())
+        self.assertEqual(index.search(encode(["hi"]), 3)[1], [["hey"]])
+        self.log.append([{"op": "delete", "id": "a"}])
+        self.assertTrue(index.sync())
+        self.assertEqual(index.search(encode(["hi"]), 3)[1], [[]])
+
+    def test_learning_needs_explicit_sharing(self):
+        with override_settings(SUGGEST_LEARNING=dict(settings.SUGGEST_LEARNING, ENABLED=True, SHARE_ACROSS_USERS=False)):
+            self.assertFalse(learning.enabled())
+        with override_settings(SUGGEST_LEARNING=dict(settings.SUGGEST_LEARNING, ENABLED=True, SHARE_ACROSS_USERS=True)):
+            self.assertTrue(learning.enabled())
+
+
+class ImportCostTests(SimpleTestCase):
+    def test_urlconf_does_not_load_numpy(self):
+        code = "import django, sys; django.setup(); import chatapp.urls; print('numpy' in sys.modules)"
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE="chatapp.settings")
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env,
+                             cwd=settings.BASE_DIR, timeout=60)
+        self.assertEqual(out.stdout.strip().splitlines()[-1:], ["False"], out.stderr)
+
+
+class SuggestIndexTests(SimpleTestCase):
+    def test_command_builds_with_the_configured_encoder(self):
+        encoder = mock.Mock(name="encoder")
+        encoder.name = "all-MiniLM-L6-v2+onnx-int8"
+        meta = {"rows": 1, "dim": 384, "checksum": "0" * 64}
+        with mock.patch("firebase.encoders.get_encoder", return_value=encoder), \
+                override_settings(SUGGEST_ENCODER=dict(settings.SUGGEST_ENCODER, BACKEND="onnx")), \
+                mock.patch("firebase.embedding_index.is_current", return_value=False) as is_current, \
+                mock.patch("firebase.embedding_index.build_index", return_value=meta) as build:
+            call_command("build_suggest_index", stdout=mock.Mock())
+        self.assertEqual(is_current.call_args.args[2], encoder.name)
+        self.assertEqual(build.call_args.kwargs, {"model": encoder, "model_name": encoder.name})
+
+    def test_concurrent_loads_build_once(self):
+        import numpy as np
+
+        from . import embedding_index
+
+        calls = []
+
+        class Model:
+            def encode(self, texts, **options):
+                calls.append(len(texts))
+                time.sleep(0.1)
+                return np.ones((len(texts), 3), dtype=np.float32)
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            corpus = Path(index_dir) / "chats.csv"
+            corpus.write_text("input,reply\nhi,hey\nbye,see you\n")
+            loaded = []
+            load = lambda: loaded.append(embedding_index.load_index(corpus, index_dir, Model(), "test-model"))
+            threads = [threading.Thread(target=load) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual([len(index) for index in loaded], [2, 2, 2])
+            self.assertFalse(list(Path(index_dir).glob("*.tmp")))
+
+    def test_report_reads_the_workers_index_without_rebuilding(self):
+        with override_settings(SUGGEST_ENCODER=dict(settings.SUGGEST_ENCODER, BACKEND="onnx")), \
+                mock.patch("firebase.embedding_index.load_index", side_effect=FileNotFoundError("stale")) as load:
+            with self.assertRaises(FileNotFoundError):
+                call_command("suggest_index_report", "--sizes", "10", stdout=mock.Mock())
+        self.assertEqual(load.call_args.kwargs, {"model_name": "all-MiniLM-L6-v2+onnx-int8", "rebuild": False})
+
+    def test_hnsw_graph_is_keyed_by_encoder(self):
+        import numpy as np
+
+        from . import vector_index
+
+        try:
+            import hnswlib  # noqa: F401
+        except ImportError:
+            self.skipTest("hnswlib is not installed")
+        embeddings = np.eye(4, dtype=np.float32)
+        with tempfile.TemporaryDirectory() as index_dir:
+            for model in ("all-MiniLM-L6-v2", "all-MiniLM-L6-v2+onnx-int8"):
+                vector_index.HNSWIndex(embeddings, index_dir=index_dir, checksum="c" * 64, model=model)
+            self.assertEqual(len(list(Path(index_dir).glob("hnsw-*.bin"))), 2)
+
+    def test_hnsw_graph_is_saved_once_and_loaded_after(self):
+        import numpy as np
+
+        from . import vector_index
+
+        try:
+            import hnswlib  # noqa: F401
+        except ImportError:
+            self.skipTest("hnswlib is not installed")
+        embeddings = np.eye(4, dtype=np.float32)
+        with tempfile.TemporaryDirectory() as index_dir:
+            vector_index.HNSWIndex(embeddings, index_dir=index_dir, checksum="c" * 64, model="m")
+            with mock.patch.object(vector_index.HNSWIndex, "_build") as build:
+                index = vector_index.HNSWIndex(embeddings, index_dir=index_dir, checksum="c" * 64, model="m")
+            build.assert_not_called()
+            self.assertEqual(index.search(embeddings[:1], 1)[1].tolist(), [[0]])
+            self.assertFalse(list(Path(index_dir).glob("*.tmp")))
+
+
+class SuggestCacheTests(SimpleTestCase):
+    def test_normalize_text(self):
+        from .suggest_cache import normalize_text
+
+        for text in ("Hey!", "  HEY  ", "hey...", "hey\n"):
+            self.assertEqual(normalize_text(text), "hey")
+        self.assertEqual(normalize_text("How's it going?? "), "how s it going")
+        self.assertEqual(normalize_text("Ça va, ünïcode"), "ça va ünïcode")
+
+    def test_suggestions_are_shared_by_normalized_inputs_until_reset(self):
+        from .suggest_cache import SuggestionCache
+
+        cache = SuggestionCache("index-a")
+        cache.set("Hey!", 5, ["hi"], context=["Morning."])
+        self.assertEqual(cache.get("  hey ", 5, context=["morning"]), ["hi"])
+        self.assertIsNone(cache.get("hey", 3, context=["morning"]))
+        self.assertIsNone(cache.get("hey", 5))
+        cache.reset("index-b")
+        self.assertIsNone(cache.get("hey", 5, context=["morning"]))
+
+    def test_embeddings_are_dropped_when_the_index_changes(self):
+        import numpy as np
+
+        from .suggest_cache import EmbeddingCache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "embeddings.sqlite3"
+            cache = EmbeddingCache(path, "index-a", "model")
+            cache.set_many(["Hey!"], [np.array([1.0, 2.0])])
+            np.testing.assert_array_equal(cache.get_many(["hey"])[0], [1.0, 2.0])
+            # Another worker opening the same file against the same index keeps them
+            self.assertIsNotNone(EmbeddingCache(path, "index-a", "model").get_many(["hey"])[0])
+            self.assertEqual(EmbeddingCache(path, "index-a", "other-model").get_many(["hey"]), [None])
+            cache.reset("index-b")
+            self.assertEqual(cache.get_many(["hey"]), [None])
+            self.assertEqual(cache.stats()["hits"], 1)
+
+
+class VectorIndexTests(SimpleTestCase):
+    def embeddings(self, rows, dim=16, seed=0):
+        import numpy as np
+
+        vecs = np.random.default_rng(seed).normal(size=(rows, dim)).astype(np.float32)
+        return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+    def test_numpy_matches_sklearn(self):
+        import numpy as np
+
+        from . import vector_index
+
+        corpus, queries = self.embeddings(200), self.embeddings(8, seed=1)
+        exact, fast = vector_index.SklearnIndex(corpus), vector_index.NumpyIndex(corpus)
+        for k in (1, 5, 20):
+            exact_scores, exact_rows = exact.search(queries, k)
+            scores, rows = fast.search(queries, k)
+            np.testing.assert_array_equal(rows, exact_rows)
+            np.testing.assert_allclose(scores, exact_scores, atol=1e-5)
+        # k past the corpus size: every row, best first (near-ties may swap)
+        exact_scores, _ = exact.search(queries, 500)
+        scores, rows = fast.search(queries, 500)
+        self.assertEqual(rows.shape, (8, 200))
+        np.testing.assert_allclose(scores, exact_scores, atol=1e-5)
+
+
+class HybridIndexTests(SimpleTestCase):
+    def setUp(self):
+        import numpy as np
+
+        from . import vector_index
+
+        self.inputs = ["how are you", "how is work", "see you later", "good night"]
+        self.index = vector_index.HybridIndex(np.eye(4, dtype=np.float32), inputs=self.inputs)
+        self.night = np.eye(4, dtype=np.float32)[3]  # the query vector points at "good night"
+
+    def test_candidates_are_scored_semantic_plus_lexical(self):
+        import numpy as np
+
+        scores, rows = self.index.search(self.night, 2, texts=["how are you"])
+        lexical = (self.index.vectorizer.transform(["how are you"]) @ self.index.postings).toarray()[0]
+        # Only rows sharing a term are candidates, so row 3 is never scored
+        expected = sorted(((0.7 * float(self.night[row]) + 0.3 * lexical[row], row)
+                           for row in np.flatnonzero(lexical)), reverse=True)[:2]
+        self.assertEqual(rows[0].tolist(), [row for _, row in expected])
+        np.testing.assert_allclose(scores[0], [score for score, _ in expected], rtol=1e-6)
+        self.assertEqual(self.index.fallbacks, 0)
+
+    def test_unseen_words_fall_back_to_dense_search(self):
+        scores, rows = self.index.search(self.night, 2, texts=["zzz qqq"])
+        self.assertEqual(rows[0][0], 3)
+        self.assertAlmostEqual(float(scores[0][0]), 1.0, places=5)
+        self.assertEqual(self.index.fallbacks, 1)
+
+    def test_query_texts_are_required(self):
+        with self.assertRaises(ValueError):
+            self.index.search(self.night, 2)
+
+
+class PaginateTests(SimpleTestCase):
+    messages = [{"id": str(i), "timestamp": f"2024-01-01T00:00:0{i}"} for i in range(6)]
+
+    def test_newest_page_and_cursor(self):
+        page, cursor = storage.paginate(self.messages, 2)
+        self.assertEqual([m["id"] for m in page], ["4", "5"])
+        self.assertEqual(cursor, "4")
+        page, cursor = storage.paginate(self.messages, 2, before=cursor)
+        self.assertEqual([m["id"] for m in page], ["2", "3"])
+
+    def test_cursor_falls_back_to_timestamp_without_ids(self):
+        messages = [{"text": str(i), "timestamp": f"2024-01-01T00:00:0{i}"} for i in range(4)]
+        page, cursor = storage.paginate(messages, 2)
+        self.assertEqual(cursor, "2024-01-01T00:00:02")
+        self.assertEqual([m["text"] for m in storage.paginate(messages, 2, before=cursor)[0]], ["0", "1"])
+        self.assertEqual(storage.paginate(messages, 1, since="2024-01-01T00:00:00")[1], "2024-01-01T00:00:01")
+
+    def test_since_pages_forward(self):
+        page, cursor = storage.paginate(self.messages, 2, since="1")
+        self.assertEqual(([m["id"] for m in page], cursor), (["2", "3"], "3"))
+        page, cursor = storage.paginate(self.messages, 10, since="2024-01-01T00:00:03")
+        self.assertEqual(([m["id"] for m in page], cursor), (["4", "5"], None))
+
+    def test_limit_is_clamped_the_same_warm_or_cold(self):
+        self.assertEqual(storage.page_limit(None), None)
+        self.assertEqual(storage.page_limit(0), 1)
+        self.assertEqual(storage.page_limit("1000"), storage.MAX_PAGE)
+        page, _ = storage.paginate(self.messages, storage.page_limit(0))
+        self.assertEqual(len(page), 1)
+
+    def test_merge_messages_keeps_order_without_duplicates(self):
+        merged = storage.merge_messages(self.messages[:3], self.messages[2:4])
+        self.assertEqual([m["id"] for m in merged], ["0", "1", "2", "3"])
+
+
+class PageQueryTests(SimpleTestCase):
+    def test_backward_page_is_newest_before_cursor(self):
+        collection = mock.Mock()
+        storage.page_query(collection, 2, cursor="snap")
+        collection.order_by.assert_called_once_with("timestamp", direction=storage.Query.DESCENDING)
+        collection.order_by().start_after.assert_called_once_with("snap")
+        collection.order_by().start_after().limit.assert_called_once_with(3)
+        rows = [{"id": "5"}, {"id": "4"}, {"id": "3"}]  # newest first, one extra
+        self.assertEqual(storage.cut_page(rows, 2), ([{"id": "4"}, {"id": "5"}], "4"))
+        self.assertEqual(storage.cut_page(rows[:2], 2), ([{"id": "4"}, {"id": "5"}], None))
+
+    def test_forward_page_is_oldest_after_cursor(self):
+        rows = [{"id": "3"}, {"id": "4"}, {"id": "5"}]
+        self.assertEqual(storage.cut_page(rows, 2, forward=True), ([{"id": "3"}, {"id": "4"}], "4"))
+        self.assertEqual(storage.cut_page(rows, None, forward=True), (rows, None))
+
+    def test_cursor_without_a_message_is_a_timestamp(self):
+        snapshot = mock.Mock(exists=False)
+        self.assertEqual(storage.cursor_position(snapshot, "2024-01-01"), {"timestamp": "2024-01-01"})
+
+
+class FakeSnapshot:
+    def __init__(self, path, data):
+        self.id, self._data = path[-1], data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return None if self._data is None else dict(self._data)
+
+
+class FakeQuery:
+    def __init__(self, db, path, order=None, descending=False, after=None, limit=None):
+        self.db, self.path = db, path
+        self.order, self.descending, self.after, self._limit = order, descending, after, limit
+
+    def _copy(self, **changes):
+        state = dict(order=self.order, descending=self.descending, after=self.after, limit=self._limit)
+        return FakeQuery(self.db, self.path, **dict(state, **changes))
+
+    def order_by(self, field, direction=storage.Query.ASCENDING):
+        return self._copy(order=field, descending=direction == storage.Query.DESCENDING)
+
+    def start_after(self, cursor):
+        return self._copy(after=cursor.to_dict() if isinstance(cursor, FakeSnapshot) else cursor)
+
+    def limit(self, n):
+        return self._copy(limit=n)
+
+    def document(self, doc_id=None):
+        return FakeDocument(self.db, self.path + (doc_id or f"auto-{next(self.db.ids)}",))
+
+    def stream(self):
+        rows = [(path, data) for path, data in self.db.docs.items() if path[:-1] == self.path]
+        if self.order:
+            rows.sort(key=lambda row: row[1][self.order], reverse=self.descending)
+        if self.after is not None:
+            edge = self.after[self.order]
+            rows = [row for row in rows if (row[1][self.order] < edge if self.descending else row[1][self.order] > edge)]
+        return [FakeSnapshot(path, data) for path, data in rows[:self._limit]]
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self.db, self.path, self.id = db, path, path[-1]
+
+    def get(self, transaction=None):
+        return FakeSnapshot(self.path, self.db.docs.get(self.path))
+
+    def collection(self, name):
+        return FakeQuery(self.db, self.path + (name,))
+
+    def set(self, data, merge=False):
+        current = dict(self.db.docs.get(self.path) or {}) if merge else {}
+        for key, value in data.items():
+            if hasattr(value, "_value"):  # Increment
+                value = current.get(key, 0) + value._value
+            elif hasattr(value, "_values"):  # ArrayUnion
+                value = current.get(key, []) + [v for v in value._values if v not in current.get(key, [])]
+            current[key] = value
+        self.db.docs[self.path] = current
+        return self.db.write_result()
+
+
+class FakeBatch:
+    def __init__(self):
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref, data, merge))
+
+    def commit(self):
+        return [ref.set(data, merge) for ref, data, merge in self.writes]
+
+
+class FakeFirestore:
+    """Just enough of the Firestore client for storage.py's reads and merge-mode appends."""
+
+    def __init__(self):
+        self.docs = {}
+        self.ids = itertools.count()
+        self.clock = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def write_result(self):
+        self.clock += timedelta(microseconds=1)
+        return mock.Mock(update_time=self.clock)
+
+    def collection(self, name):
+        return FakeQuery(self, (name,))
+
+    def batch(self):
+        return FakeBatch()
+
+
+@override_settings(CHAT_STORAGE_LAYOUT="messages", CHAT_APPEND_MODE="merge")
+class ReadPageTests(SimpleTestCase):
+    def setUp(self):
+        self.db = FakeFirestore()
+        patcher = mock.patch.object(storage, "get_db", return_value=self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def append(self, *messages):
+        return [storage.append_message("a@x.com", "b@x.com", message) for message in messages]
+
+    def test_appends_keep_their_order(self):
+        results = self.append(*[{"id": str(i), "text": str(i), "timestamp": f"2024-01-01T00:00:0{i}"}
+                                for i in range(3)])
+        seqs = [seq for seq, _ in results]
+        self.assertEqual(seqs, sorted(seqs))
+        self.assertEqual(len(set(seqs)), 3)
+        self.assertEqual([m["id"] for m in storage.read_messages("a@x.com", "b@x.com")], ["0", "1", "2"])
+        self.assertEqual(self.db.docs[("a@x.com", "b@x.com")]["count"], 3)
+
+    def test_messages_without_timestamp_are_stamped_in_order(self):
+        self.append({"id": "1"}, {"id": "2"})
+        stamps = [m["timestamp"] for m in storage.read_messages("a@x.com", "b@x.com")]
+        self.assertEqual(stamps, sorted(stamps))
+
+    def test_pages_walk_backwards_and_forwards(self):
+        self.append(*[{"id": str(i), "timestamp": f"2024-01-01T00:00:0{i}"} for i in range(5)])
+        page, cursor = storage.read_page("a@x.com", "b@x.com", limit=2)
+        self.assertEqual(([m["id"] for m in page], cursor), (["3", "4"], "3"))
+        page, cursor = storage.read_page("a@x.com", "b@x.com", limit=2, before=cursor)
+        self.assertEqual(([m["id"] for m in page], cursor), (["1", "2"], "1"))
+        page, cursor = storage.read_page("a@x.com", "b@x.com", limit=2, before=cursor)
+        self.assertEqual(([m["id"] for m in page], cursor), (["0"], None))
+        page, cursor = storage.read_page("a@x.com", "b@x.com", limit=3, since="0")
+        self.assertEqual(([m["id"] for m in page], cursor), (["1", "2", "3"], "3"))
+
+    def test_messages_without_id_still_page(self):
+        self.append(*[{"text": str(i), "timestamp": f"2024-01-01T00:00:0{i}"} for i in range(4)])
+        page, cursor = storage.read_page("a@x.com", "b@x.com", limit=2)
+        self.assertEqual(cursor, "2024-01-01T00:00:02")
+        page, cursor = storage.read_page("a@x.com", "b@x.com", limit=2, before=cursor)
+        self.assertEqual(([m["text"] for m in page], cursor), (["0", "1"], None))
+
+    def test_missing_conversation(self):
+        self.assertIsNone(storage.read_page("a@x.com", "nobody", limit=2))
+
+
+class ConversationCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        # Two workers sharing one cache backend
+        self.a, self.b = ConversationCache(shared_alias="default"), ConversationCache(shared_alias="default")
+
+    def test_local_only_entries_expire_quickly(self):
+        local = ConversationCache(ttl=300, local_ttl=5)
+        local.set("x@x.com", "y@x.com", [{"id": "1"}])
+        self.assertEqual(self.a.local.ttl, 300)
+        with mock.patch("firebase.cache.time.monotonic", return_value=time.monotonic() + 6):
+            self.assertIsNone(local.get("x@x.com", "y@x.com"))
+
+    def test_append_elsewhere_makes_local_copy_stale(self):
+        self.a.set("x@x.com", "y@x.com", [{"id": "1"}])
+        self.assertEqual(self.b.get("x@x.com", "y@x.com"), [{"id": "1"}])
+        self.a.append("x@x.com", "y@x.com", {"id": "2"})
+        self.assertEqual(self.a.get("x@x.com", "y@x.com"), [{"id": "1"}, {"id": "2"}])
+        self.assertIsNone(self.b.get("x@x.com", "y@x.com"))
+
+    def test_async_calls_keep_the_shared_backend_off_the_loop(self):
+        import asyncio
+
+        threads = []
+        shared_get = self.a.shared.get
+
+        def get(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return shared_get(*args, **kwargs)
+
+        async def main():
+            with mock.patch.object(self.a.shared, "get", side_effect=get):
+                await self.a.aappend("x@x.com", "y@x.com", {"id": "1"})
+                return await self.a.aget("x@x.com", "y@x.com")
+
+        asyncio.run(main())
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_append_during_load_is_not_lost(self):
+        def load():
+            self.b.append("x@x.com", "y@x.com", {"id": "2"})  # lands while we read
+            return [{"id": "1"}]
+
+        self.a.get_or_load("x@x.com", "y@x.com", load)
+        self.assertIsNone(self.a.get("x@x.com", "y@x.com"))
+
+
+class StatsAccessTests(SimpleTestCase):
+    def test_token_required_when_configured(self):
+        factory = RequestFactory()
+        with override_settings(STATS_TOKEN="secret"):
+            self.assertEqual(metrics.stats(factory.get("/stats/")).status_code, 403)
+            request = factory.get("/stats/", HTTP_AUTHORIZATION="Bearer secret")
+            self.assertEqual(metrics.stats(request).status_code, 200)
+        with override_settings(STATS_TOKEN=None):
+            self.assertEqual(metrics.stats(factory.get("/stats/", REMOTE_ADDR="10.0.0.5")).status_code, 403)
+            self.assertEqual(metrics.stats(factory.get("/stats/")).status_code, 200)
+
+    def test_stats_do_not_ping_the_service_every_time(self):
+        from . import suggest_service, suggester
+
+        with mock.patch.object(suggest_service, "enabled", return_value=True), \
+                mock.patch.object(suggest_service, "request", return_value={"ok": True}) as ping:
+            suggester._probe.update(at=0.0, state=None)
+            for _ in range(3):
+                suggester.readiness(max_age=10)
+            suggester.readiness()  # /suggest/ready/ still checks now
+        self.assertEqual(ping.call_count, 2)
+
+
+class SuggestErrorTests(SimpleTestCase):
+    def post(self, view):
+        import asyncio
+
+        from . import llm_suggest, suggest_service, suggester
+
+        request = RequestFactory().post("/suggest/", json.dumps({"message": "hi", "history": []}),
+                                         content_type="application/json")
+        with mock.patch.object(llm_suggest, "enabled", return_value=False), \
+                mock.patch.object(suggester, "get_replies",
+                                  side_effect=suggest_service.ServiceUnavailable("socket missing")):
+            response = view(request)
+            return asyncio.run(response) if asyncio.iscoroutine(response) else response
+
+    def test_missing_service_is_503(self):
+        from . import async_views, views
+
+        for view in (views.suggest_reply, async_views.suggest_reply):
+            self.assertEqual(self.post(view).status_code, 503)
+
+
+class AddMessageTests(SimpleTestCase):
+    def setUp(self):
+        from . import views
+
+        self.message = {"id": "1", "text": "hi", "senderId": "a@x.com"}
+        for target, name, value in [(views, "conversations", ConversationCache()), (views, "write_behind", None),
+                                    (learning, "observe", mock.Mock())]:
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, body):
+        request = RequestFactory().post("/add/", json.dumps(body), content_type="application/json")
+        request.COOKIES["email"] = "a@x.com"
+        return request
+
+    def test_ack_carries_id_and_seq_without_reading_the_chat(self):
+        from . import views
+
+        with mock.patch.object(storage, "append_message", return_value=(42, self.message)), \
+                mock.patch.object(storage, "read_messages") as read:
+            response = views.add_message(self.post({"selected": "b@x.com", "messages": self.message}))
+        self.assertEqual(json.loads(response.content), {"success": True, "id": "1", "seq": 42, "queued": False})
+        read.assert_not_called()
+
+    def test_echo_returns_the_conversation(self):
+        from . import views
+
+        earlier = {"id": "0", "text": "hello"}
+        with mock.patch.object(storage, "append_message", return_value=(42, self.message)), \
+                mock.patch.object(storage, "read_messages", return_value=[earlier, self.message]):
+            response = views.add_message(self.post({"selected": "b@x.com", "messages": self.message, "echo": True}))
+        body = json.loads(response.content)
+        self.assertEqual(body["seq"], 42)
+        self.assertEqual(body["document"], {"data": [earlier, self.message]})
+
+    def test_async_ack(self):
+        import asyncio
+
+        from . import async_views, storage_async
+
+        with mock.patch.object(async_views, "conversations", ConversationCache()), \
+                mock.patch.object(async_views, "write_behind", None), \
+                mock.patch.object(storage_async, "append_message", mock.AsyncMock(return_value=(7, self.message))):
+            response = asyncio.run(async_views.add_message(self.post({"selected": "b@x.com", "messages": self.message})))
+        self.assertEqual(json.loads(response.content), {"success": True, "id": "1", "seq": 7, "queued": False})
+
+
+class SuggestionContextTests(SimpleTestCase):
+    def setUp(self):
+        self.request = RequestFactory().post("/suggest/")
+        self.request.COOKIES["email"] = "a@x.com"
+        self.tail = [{"text": "lunch?", "senderId": "b@x.com"}, {"text": "sure", "senderId": "a@x.com"}]
+
+    @override_settings(SUGGEST_CONTEXT={"TURNS": 4})
+    def test_cold_cache_reads_only_the_last_turns(self):
+        from . import views
+
+        with mock.patch.object(views.conversations, "get", return_value=None), \
+                mock.patch.object(views, "write_behind", None), \
+                mock.patch.object(storage, "read_messages") as read_all, \
+                mock.patch.object(storage, "read_page", return_value=(self.tail, "c")) as read_page:
+            turns = views.suggestion_context(self.request, {"selected": "b@x.com"}, "sure")
+        self.assertEqual(turns, [{"role": "user", "content": "lunch?"}])
+        read_page.assert_called_once_with("a@x.com", "b@x.com", limit=5)
+        read_all.assert_not_called()
+
+    @override_settings(SUGGEST_CONTEXT={"TURNS": 4})
+    def test_async_cold_cache_reads_only_the_last_turns(self):
+        import asyncio
+
+        from . import async_views, storage_async
+
+        with mock.patch.object(async_views.conversations, "aget", mock.AsyncMock(return_value=None)), \
+                mock.patch.object(async_views, "write_behind", None), \
+                mock.patch.object(storage_async, "read_page", mock.AsyncMock(return_value=(self.tail, "c"))) as read_page:
+            turns = asyncio.run(async_views.suggestion_context(self.request, {"selected": "b@x.com"}, "sure"))
+        self.assertEqual(turns, [{"role": "user", "content": "lunch?"}])
+        read_page.assert_awaited_once_with("a@x.com", "b@x.com", limit=5)
+
+    @override_settings(SUGGEST_CONTEXT={"TURNS": 4})
+    def test_turns_are_roles_relative_to_the_requesting_user(self):
+        from . import views
+
+        history = [{"text": "hey", "senderId": "a@x.com"}, {"text": "lunch?", "senderId": "b@x.com"},
+                   {"role": "assistant", "content": "posted"}, "plain"]
+        turns = views.context_turns(history, "where?", "a@x.com")
+        self.assertEqual([turn["role"] for turn in turns], ["assistant", "user", "assistant", "user"])
+
+    def test_llm_sees_who_said_what(self):
+        from .llm_suggest import LLMSuggester
+
+        llm = LLMSuggester(max_workers=1)
+        context = [{"role": "assistant", "content": "hey"}, {"role": "user", "content": "lunch?"}]
+        _, _, messages = llm._admit("at noon?", context)
+        llm.slots.release()
+        self.assertEqual(messages, [*context, {"role": "user", "content": "at noon?"}])
+        # Same words from the other side are another conversation
+        swapped = [{"role": "user", "content": "hey"}, {"role": "user", "content": "lunch?"}]
+        self.assertNotEqual(llm._key("at noon?", context), llm._key("at noon?", swapped))
+
+    @override_settings(SUGGEST_CONTEXT={"TURNS": 4, "DECAY": 0.5})
+    def test_query_vectors_weight_recent_turns_more(self):
+        import numpy as np
+
+        from . import suggest_cache
+        from .suggester import SuggestionEngine
+
+        basis = {"a": np.array([1.0, 0.0, 0.0]), "b": np.array([0.0, 1.0, 0.0]), "c": np.array([0.0, 0.0, 1.0])}
+        engine = SuggestionEngine.__new__(SuggestionEngine)
+        engine._np = np
+        engine._normalize = suggest_cache.normalize_text
+        engine.encode = mock.Mock(side_effect=lambda texts: np.vstack([basis[t] for t in texts]))
+
+        vecs = engine.query_vectors([("c", 5, ["a", "b"]), ("c", 5, [])])
+        expected = np.array([0.25, 0.5, 1.0]) / np.linalg.norm([0.25, 0.5, 1.0])
+        np.testing.assert_allclose(vecs[0], expected)
+        np.testing.assert_allclose(vecs[1], basis["c"])
+        # Shared turns are encoded once across the batch
+        self.assertEqual(sorted(engine.encode.call_args.args[0]), ["a", "b", "c"])
+
+
+class LLMSuggesterTests(SimpleTestCase):
+    def setUp(self):
+        from .llm_suggest import LLMSuggester
+
+        self.llm = LLMSuggester(max_workers=1, deadline_ms=50)
+        self.addCleanup(self.llm.pool.shutdown)
+
+    def test_on_time_answer_goes_first_then_knn(self):
+        with mock.patch("suggest.get_suggestions", return_value=["Sure!", "On my way"]):
+            handle = self.llm.start("lunch?")
+            result = self.llm.finish(handle, ["sure", "No thanks"], 3, time.monotonic())
+        self.assertEqual(result, (["Sure!", "On my way", "No thanks"], "llm+knn"))
+        self.assertEqual(self.llm.counts["on_time"], 1)
+
+    def test_late_answer_is_dropped_but_cached(self):
+        release = threading.Event()
+
+        def slow(messages, model):
+            release.wait(5)
+            return ["Later!"]
+
+        with mock.patch("suggest.get_suggestions", side_effect=slow):
+            key, future = self.llm.start("lunch?")
+            self.assertEqual(self.llm.finish((key, future), ["knn"], 3, time.monotonic()), (["knn"], "knn"))
+            release.set()
+            future.result(5)
+        self.assertEqual(self.llm.counts["late"], 1)
+        # The next request for the same text gets it from the cache, no call
+        handle = self.llm.start("Lunch?")
+        self.assertEqual(handle[1], ["Later!"])
+        self.assertEqual(self.llm.finish(handle, ["knn"], 3, time.monotonic()), (["Later!", "knn"], "llm+knn"))
+        self.assertEqual(self.llm.counts["cached"], 1)
+
+    def test_no_free_slot_skips_the_llm(self):
+        self.llm.slots.acquire()
+        try:
+            handle = self.llm.start("lunch?")
+        finally:
+            self.llm.slots.release()
+        self.assertEqual(self.llm.finish(handle, ["knn"], 3, time.monotonic()), (["knn"], "knn"))
+        self.assertEqual(self.llm.counts["skipped"], 1)
+
+    def test_without_merge_only_the_llm_answers(self):
+        self.llm.merge = False
+        self.assertEqual(self.llm._blend(["a", "b", "c"], ["knn"], 2, fresh=True), (["a", "b"], "llm"))
+        self.assertEqual(self.llm._blend([], ["knn"], 2, fresh=True), (["knn"], "knn"))
+        self.assertEqual(self.llm.counts["empty"], 1)
+
+    def test_async_deadline_does_not_cancel_the_call(self):
+        import asyncio
+
+        async def slow(messages, model):
+            await asyncio.sleep(0.2)
+            return ["Later!"]
+
+        async def main():
+            handle = self.llm.astart("lunch?")
+            result = await self.llm.afinish(handle, ["knn"], 3, time.monotonic())
+            return result, await handle[1]
+
+        with mock.patch("suggest.aget_suggestions", side_effect=slow):
+            result, late = asyncio.run(main())
+        self.assertEqual(result, (["knn"], "knn"))
+        self.assertEqual(late, ["Later!"])
+        self.assertEqual(self.llm.cache.peek(self.llm._key("lunch?", ())), ["Later!"])
+
+
+class MigrateTimestampTests(SimpleTestCase):
+    def test_missing_timestamps_keep_array_order(self):
+        from .management.commands.migrate_chats import fill_timestamps
+
+        data = [
+            {"id": "1"},
+            {"id": "2", "timestamp": "2024-05-01T10:00:00+00:00"},
+            {"id": "3"},
+            {"id": "4"},
+            {"id": "5", "timestamp": "2024-05-01T11:00:00+00:00"},
+        ]
+        stamps = fill_timestamps(data)
+        self.assertEqual(stamps[1], "2024-05-01T10:00:00+00:00")
+        self.assertEqual(stamps[0], "2024-05-01T09:59:59.999999+00:00")
+        self.assertEqual(stamps[3], "2024-05-01T10:00:00.000002+00:00")
+        self.assertEqual(stamps, sorted(stamps))
+
+    def test_unstamped_conversation_sorts_before_new_messages(self):
+        from .management.commands.migrate_chats import fill_timestamps
+
+        stamps = fill_timestamps([{"id": "1"}, {"id": "2"}])
+        self.assertEqual(stamps, ["1970-01-01T00:00:00+00:00", "1970-01-01T00:00:00.000001+00:00"])
+
+
+class IterRecordsTests(SimpleTestCase):
+    def records(self, body, chunk_size=3):
+        from . import bulk
+
+        return list(bulk.iter_records(io.BytesIO(body.encode()), chunk_size=chunk_size))
+
+    def test_ndjson_across_chunk_boundaries(self):
+        body = '{"selected": "b", "message": {"text": "héllo ✓"}}\n\nnot json\n{"selected": "c", "message": {}}'
+        records = self.records(body)
+        self.assertEqual(records[0], (1, {"selected": "b", "message": {"text": "héllo ✓"}}))
+        self.assertEqual(records[1][0], 3)
+        self.assertIsInstance(records[1][1], ValueError)
+        self.assertEqual(records[2], (4, {"selected": "c", "message": {}}))
+
+    def test_json_array_across_chunk_boundaries(self):
+        body = ' [ {"selected": "b", "message": {"text": "a, ]"}} ,\n{"selected": "c", "message": {}} ] '
+        self.assertEqual([record for _, record in self.records(body)],
+                         [{"selected": "b", "message": {"text": "a, ]"}}, {"selected": "c", "message": {}}])
+
+    def test_unterminated_array(self):
+        from . import bulk
+
+        (_, error), = self.records('[{"selected": "b"}'[:-1])
+        self.assertIsInstance(error, ValueError)
+        records = self.records('[{"selected": "b"}')
+        self.assertEqual(records[0], (1, {"selected": "b"}))
+        self.assertIsInstance(records[1][1], bulk.BulkImportError)
+
+    def test_oversized_ndjson_line_is_skipped(self):
+        from . import bulk
+
+        body = '{"selected": "b"}\n{"selected": "' + "x" * 100 + '"}\n{"selected": "c"}\n'
+        with mock.patch.object(bulk, "MAX_RECORD_SIZE", 40):
+            records = self.records(body, chunk_size=8)
+        self.assertEqual(records[0], (1, {"selected": "b"}))
+        self.assertEqual(records[1][0], 2)
+        self.assertIsInstance(records[1][1], bulk.BulkImportError)
+        self.assertEqual(records[2], (3, {"selected": "c"}))
+        self.assertEqual(len(records), 3)
+
+
+@override_settings(CHAT_STORAGE_LAYOUT="messages")
+class ImporterTests(SimpleTestCase):
+    def test_stored_messages_are_duplicates_not_imports(self):
+        from . import bulk
+
+        with mock.patch.object(storage, "existing_ids", return_value={"1"}), \
+                mock.patch.object(storage, "write_grouped") as write:
+            importer = bulk.Importer("a@x.com")
+            importer.add(1, {"selected": "b", "messages": [{"id": "1"}, {"id": "2"}, {"id": "2"}]})
+            importer.flush()
+        (groups,), _ = write.call_args
+        self.assertEqual([m["id"] for m in groups[("a@x.com", "b")]], ["2"])
+        self.assertEqual(importer.result()["conversations"]["b"], {"imported": 1, "duplicates": 2, "failed": 0})
+
+    def test_ids_are_kept_for_one_conversation_at_a_time(self):
+        from . import bulk
+
+        with mock.patch.object(storage, "existing_ids", return_value=set()), \
+                mock.patch.object(storage, "write_grouped") as write:
+            importer = bulk.Importer("a@x.com")
+            importer.add(1, {"selected": "b", "message": {"id": "1"}})
+            importer.add(2, {"selected": "c", "message": {"id": "1"}})
+            self.assertEqual(write.call_count, 1)  # switching contacts committed b
+            self.assertEqual(len(importer.seen), 1)
+            importer.flush()
+        self.assertEqual(importer.result()["imported"], 2)
+
+    @override_settings(CHAT_STORAGE_LAYOUT="messages")
+    def test_reimporting_messages_without_ids_stores_them_once(self):
+        from . import bulk
+
+        stored = set()
+
+        def write_grouped(groups):
+            stored.update(m["id"] for messages in groups.values() for m in messages)
+
+        record = {"selected": "b", "messages": [{"text": "hi", "timestamp": "2024-01-01T00:00:00+00:00"},
+                                                {"text": "hi", "timestamp": "2024-01-01T00:00:01+00:00"}]}
+        with mock.patch.object(storage, "existing_ids", side_effect=lambda email, selected, ids: stored & set(ids)), \
+                mock.patch.object(storage, "write_grouped", side_effect=write_grouped):
+            for _ in range(2):
+                importer = bulk.Importer("a@x.com")
+                importer.add(1, record)
+                importer.flush()
+        self.assertEqual(len(stored), 2)
+        self.assertEqual(importer.result()["conversations"]["b"], {"imported": 0, "duplicates": 2, "failed": 0})
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def test_concurrent_submits_share_a_batch(self):
+        from .batching import MicroBatcher
+
+        batches = []
+
+        def handler(items):
+            batches.append(list(items))
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(handler, max_batch=8, max_wait_ms=100)
+        results = {}
+        threads = [threading.Thread(target=lambda i=i: results.setdefault(i, batcher.submit(i, 5))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, {0: 0, 1: 2, 2: 4, 3: 6})
+        self.assertLess(len(batches), 4)
+        self.assertEqual(batcher.stats()["items"], 4)
+
+    def test_handler_errors_reach_every_caller(self):
+        from .batching import MicroBatcher
+
+        def handler(items):
+            raise RuntimeError("model failed")
+
+        batcher = MicroBatcher(handler, max_wait_ms=1)
+        with self.assertRaises(RuntimeError):
+            batcher.submit("x", 5)
+        self.assertEqual(batcher.stats()["failures"], 1)
+
+
+class SuggestionStreamTests(SimpleTestCase):
+    def test_suggestions_come_out_as_their_strings_close(self):
+        from suggest import SuggestionStream
+
+        parser = SuggestionStream()
+        reply = '{"suggestions": [" Sounds good! ", "Say \\"hi\\" for me", "", "See you"]}'
+        out = []
+        for i in range(0, len(reply), 5):
+            out.append(parser.feed(reply[i:i + 5]))
+        flat = [s for chunk in out for s in chunk]
+        self.assertEqual(flat, ["Sounds good!", 'Say "hi" for me', "See you"])
+        # Each one as soon as its closing quote arrived, not all at the end
+        self.assertGreater(sum(1 for chunk in out if chunk), 1)
+
+
+class ExportTests(SimpleTestCase):
+    def test_contacts_get_distinct_zip_entries(self):
+        import zipfile
+
+        from . import export
+
+        lines = [("b/y", "{}\n"), ("b_y", "{}\n"), ("b:y", "{}\n")]
+        with mock.patch.object(export, "iter_records", return_value=iter(lines)):
+            data = b"".join(export.zip_ndjson("a@x.com"))
+        names = zipfile.ZipFile(io.BytesIO(data)).namelist()
+        self.assertEqual(len(set(names)), 3)
+        self.assertIn("b_y.ndjson", names)
+
+    def test_timestamp_cursor_keeps_microseconds(self):
+        from datetime import datetime, timezone
+
+        from . import export
+
+        stamp = datetime(2024, 5, 1, 10, 0, 0, 123456, tzinfo=timezone.utc)
+        cursor = export.encode_cursor("b@x.com", {"text": "no id", "timestamp": stamp})
+        self.assertEqual(export.decode_cursor(cursor), ("b@x.com", stamp.isoformat()))
+        messages = [{"text": "no id", "timestamp": stamp}, {"text": "next", "timestamp": "2024-05-01T10:00:01+00:00"}]
+        page, _ = storage.paginate(messages, since=export.decode_cursor(cursor)[1])
+        self.assertEqual([m["text"] for m in page], ["next"])
@@ -0,0 +1,179 @@
+"""Nearest-neighbour backends for the suggestion index.
+
+Every backend is built from the L2-normalized embedding matrix and answers
+``search(queries, k) -> (scores, rows)`` with cosine similarities, best
+first, one row per query:
+
+- ``sklearn``: ``NearestNeighbors(metric="cosine")``, exact brute force
+- ``numpy``: exact, one normalized dot product plus ``argpartition``
+- ``hnsw``: approximate, an HNSW graph from ``hnswlib``. ``m`` and
+  ``ef_construction`` trade build time and memory for graph quality;
+  ``ef_search`` trades query latency for recall.
+- ``hybrid``: two stages. A TF-IDF inverted index over the corpus inputs
+  pulls the ``candidates`` rows sharing the most weighted terms with the
+  query text, and only those rows are scored densely; the final score is
+  ``semantic_weight * cosine + lexical_weight * tf-idf cosine``. Queries
+  with too few lexical hits (all words unseen) fall back to
+  ``fallback``. It needs the query text, so it sets ``uses_text`` and
+  callers pass ``texts=`` to ``search``.
+
+Pick one with ``SUGGEST_INDEX_BACKEND`` and pass knobs through
+``SUGGEST_INDEX_OPTIONS``. ``manage.py suggest_index_report`` shows which
+one to run at which corpus size.
+"""
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+
+class SklearnIndex:
+    name = "sklearn"
+
+    def __init__(self, embeddings, **options):
+        from sklearn.neighbors import NearestNeighbors
+
+        self.knn = NearestNeighbors(metric="cosine", algorithm="brute")
+        self.knn.fit(embeddings)
+        self.size = len(embeddings)
+
+    def search(self, queries, k):
+        k = min(k, self.size)
+        distances, rows = self.knn.kneighbors(np.atleast_2d(queries), n_neighbors=k)
+        return 1 - distances, rows
+
+
+class NumpyIndex:
+    name = "numpy"
+
+    def __init__(self, embeddings, **options):
+        self.embeddings = embeddings
+        self.size = len(embeddings)
+
+    def search(self, queries, k):
+        k = min(k, self.size)
+        scores = np.atleast_2d(queries).astype(np.float32) @ self.embeddings.T
+        if k < self.size:
+            # Top-k without sorting the whole row, then order just those
+            part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            part = np.tile(np.arange(self.size), (len(scores), 1))
+        top = np.take_along_axis(scores, part, axis=1)
+        order = np.argsort(-top, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class HNSWIndex:
+    name = "hnsw"
+
+    def __init__(self, embeddings, m=16, ef_construction=200, ef_search=64, index_dir=None, checksum=None,
+                 model=None, **options):
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError("The hnsw suggestion index needs hnswlib (pip install hnswlib)") from e
+
+        self.size = len(embeddings)
+        dim = embeddings.shape[1]
+        self.graph = hnswlib.Index(space="ip", dim=dim)
+        path = None
+        if index_dir is not None and checksum is not None:
+            # The graph takes far longer to build than to load; keep it next
+            # to the embeddings, keyed by corpus checksum, encoder and build
+            # knobs (the same corpus encoded by another backend is another graph)
+            key = hashlib.sha1(f"{checksum}:{model}".encode()).hexdigest()[:16]
+            path = Path(index_dir) / f"hnsw-{key}-m{m}-ef{ef_construction}.bin"
+        if path is None:
+            self._build(embeddings, m, ef_construction)
+        else:
+            from .embedding_index import build_lock, replace_file
+
+            # One worker builds the graph; the others wait and load it
+            with build_lock(index_dir):
+                if path.exists():
+                    self.graph.load_index(str(path), max_elements=self.size)
+                else:
+                    self._build(embeddings, m, ef_construction)
+                    replace_file(path, lambda tmp: self.graph.save_index(str(tmp)))
+        self.graph.set_ef(max(ef_search, 1))
+
+    def _build(self, embeddings, m, ef_construction):
+        self.graph.init_index(max_elements=self.size, ef_construction=ef_construction, M=m)
+        self.graph.add_items(np.asarray(embeddings, dtype=np.float32), np.arange(self.size))
+
+    def search(self, queries, k):
+        k = min(k, self.size)
+        self.graph.set_ef(max(self.graph.ef, k))
+        rows, distances = self.graph.knn_query(np.atleast_2d(queries).astype(np.float32), k=k)
+        # "ip" distance is 1 - inner product
+        return 1 - distances, rows.astype(np.int64)
+
+
+class HybridIndex:
+    name = "hybrid"
+    uses_text = True
+
+    def __init__(self, embeddings, corpus=None, candidates=300, lexical_weight=0.3, semantic_weight=0.7,
+                 fallback="numpy", inputs=None, **options):
+        import pandas as pd
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        if inputs is None:
+            if corpus is None:
+                raise ValueError("The hybrid suggestion index needs the corpus to build its TF-IDF side")
+            inputs = pd.read_csv(corpus)["input"].astype(str).tolist()
+        if len(inputs) != len(embeddings):
+            raise ValueError(f"Corpus has {len(inputs)} inputs but the index has {len(embeddings)} rows")
+        self.embeddings = embeddings
+        self.size = len(embeddings)
+        self.candidates = candidates
+        self.lexical_weight = lexical_weight
+        self.semantic_weight = semantic_weight
+        # Chat lines are short; dropping stop words would empty "how are you"
+        self.vectorizer = TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True)
+        # Term -> rows postings: a query only touches the rows of its own terms
+        self.postings = self.vectorizer.fit_transform(inputs).T.tocsr()
+        self.fallback = create_index(fallback, embeddings, **options)
+        self.fallbacks = 0
+
+    def search(self, queries, k, texts=None):
+        queries = np.atleast_2d(queries).astype(np.float32)
+        if texts is None or len(texts) != len(queries):
+            raise ValueError("The hybrid suggestion index needs one query text per query vector")
+        k = min(k, self.size)
+        lexical = self.vectorizer.transform(texts) @ self.postings  # queries x rows, sparse
+        lexical = lexical.tocsr()
+        all_scores, all_rows = [], []
+        for i, query in enumerate(queries):
+            row = lexical.getrow(i)
+            if row.nnz < k:
+                self.fallbacks += 1
+                scores, rows = self.fallback.search(query, k)
+                all_scores.append(scores[0])
+                all_rows.append(rows[0])
+                continue
+            hits, lex = row.indices, row.data
+            if len(hits) > self.candidates:
+                keep = np.argpartition(-lex, self.candidates - 1)[:self.candidates]
+                hits, lex = hits[keep], lex[keep]
+            score = self.semantic_weight * (np.asarray(self.embeddings[hits]) @ query) + self.lexical_weight * lex
+            order = np.argsort(-score)[:k]
+            all_scores.append(score[order])
+            all_rows.append(hits[order])
+        return np.vstack(all_scores), np.vstack(all_rows).astype(np.int64)
+
+
+BACKENDS = {
+    "sklearn": SklearnIndex,
+    "numpy": NumpyIndex,
+    "hnsw": HNSWIndex,
+    "hybrid": HybridIndex,
+}
+
+
+def create_index(backend, embeddings, **options):
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown suggestion index backend {backend!r}; choose from {', '.join(BACKENDS)}")
+    return cls(embeddings, **options)
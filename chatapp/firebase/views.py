@@ -1,27 +1,33 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
 from datetime import datetime
-import firebase_admin
-from firebase_admin import credentials, firestore
 from urllib.parse import unquote
 from django.views.decorators.csrf import csrf_exempt
+import contextlib
 import json
-from google.cloud.firestore_v1 import ArrayUnion
-import requests
-import pandas as pd
-from sentence_transformers import SentenceTransformer
-from sklearn.neighbors import NearestNeighbors
+import time
+from chatapp import streaming
+from . import bulk, export, learning, llm_suggest, storage, suggest_service, suggester
+from .cache import conversations
+from .writebehind import buffer as write_behind
 
 
 
 
-cred = credentials.Certificate("firebase.json")
+def load_conversation(email, selected, limit=None):
+    # Pending first: a message committed in between is then in one or both, never neither
+    pending = write_behind.pending(email, selected) if write_behind is not None else []
+    if limit is None:
+        messages = storage.read_messages(email, selected)
+    else:
+        page = storage.read_page(email, selected, limit=limit)
+        messages = None if page is None else page[0]
+    if pending:
+        # Show queued messages that have not been flushed yet
+        messages = storage.merge_pending(messages, pending)
+    return messages
 
-# Initialize only if not already initialized
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
-
-db = firestore.client()
 
 @csrf_exempt
 def add_message(request):
@@ -36,27 +42,69 @@ def add_message(request):
                 return JsonResponse({"success": False, "error": "Email cookie not found"})
             email = unquote(str(email))
 
-            doc_ref = db.collection(email).document(selected)
-
-            # First check if document exists
-            doc = doc_ref.get()
-            if doc.exists:
-                # Append using ArrayUnion
-                doc_ref.update({"data": ArrayUnion([message])})
+            if write_behind is not None:
+                # Sequence numbers are only known once the batch commits
+                seq = None
+                message = write_behind.enqueue(email, selected, message)
             else:
-                # Create new document with first message
-                doc_ref.set({"data": [message]})
+                seq, message = storage.append_message(email, selected, message)
+            conversations.append(email, selected, message)
+            learning.observe(email, selected, message)
 
-            # Fetch updated doc
-            doc = doc_ref.get()
-            return JsonResponse({"success": True, "document": doc.to_dict()})
+            # Old clients still expect the whole conversation back
+            if body.get("echo"):
+                document = {"data": conversations.get_or_load(
+                    email, selected, lambda: load_conversation(email, selected))}
+                return JsonResponse({"success": True, "id": message.get("id"), "seq": seq, "document": document})
+            return JsonResponse({"success": True, "id": message.get("id"), "seq": seq, "queued": write_behind is not None})
 
         except Exception as e:
             print("Error:", e)
             return JsonResponse({"success": False, "error": str(e)})
 
 
-        
+@csrf_exempt
+def bulk_import(request):
+    if request.method == "POST":
+        try:
+            email = request.COOKIES.get("email")
+            if not email:
+                return JsonResponse({"success": False, "error": "Email cookie not found"})
+            email = unquote(str(email))
+
+            # Read the body as a stream; request.body would hold all of it
+            result = bulk.import_messages(email, request)
+            for selected in result["conversations"]:
+                conversations.invalidate(email, selected)
+            return JsonResponse({"success": True, **result})
+        except Exception as e:
+            print("Error:", e)
+            return JsonResponse({"success": False, "error": str(e)})
+    return JsonResponse({"success": False, "error": "POST required"}, status=405)
+
+
+def export_chats(request):
+    email = request.COOKIES.get("email")
+    if not email:
+        return JsonResponse({"success": False, "error": "Email cookie not found"})
+    email = unquote(str(email))
+    cursor = request.GET.get("cursor")
+    if cursor:
+        try:
+            export.decode_cursor(cursor)
+        except Exception:
+            return JsonResponse({"success": False, "error": "Invalid cursor"}, status=400)
+
+    if request.GET.get("format") == "zip":
+        response = StreamingHttpResponse(export.zip_ndjson(email, cursor), content_type="application/zip")
+        filename = "chat-backup.zip"
+    else:
+        response = StreamingHttpResponse(export.gzip_ndjson(email, cursor), content_type="application/gzip")
+        filename = "chat-backup.ndjson.gz"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
 @csrf_exempt
 def fetch_data(request):
     if request.method == "POST":
@@ -69,34 +117,90 @@ def fetch_data(request):
             selected = body.get("selected")
             if not selected:
                 return JsonResponse({"success": False, "error": "Selected contact not provided"})
-            doc_ref = db.collection(email).document(selected)
-            doc = doc_ref.get()
-            if not doc.exists:
+            # limit/before/since page through the chat; without them the
+            # whole conversation comes back as it always has
+            limit, before, since = body.get("limit"), body.get("before"), body.get("since")
+            if limit is None and before is None and since is None:
+                messages = conversations.get_or_load(
+                    email, selected, lambda: load_conversation(email, selected))
+                page = None if messages is None else (messages, None)
+            else:
+                cached = conversations.get(email, selected)
+                if cached is not None:
+                    page = storage.paginate(cached, storage.page_limit(limit), before, since)
+                else:
+                    page = storage.read_page(email, selected, limit=limit, before=before, since=since)
+            if page is None:
                 return JsonResponse({"success": False, "error": "No chat found with this contact"})
-            return JsonResponse({"success": True, "data": doc.to_dict()})
+            messages, next_cursor = page
+            return JsonResponse({"success": True, "data": {"data": messages}, "next_cursor": next_cursor})
         except Exception as e:
             print("Error:", e)
             return JsonResponse({"success": False, "error": str(e)})
 
 
 
-df = pd.read_csv(r"chats.csv")
-
-# Load embeddings model
-model = SentenceTransformer("all-MiniLM-L6-v2")
-
-# Encode input sentences
-X = model.encode(df["input"], convert_to_tensor=False)
-
-# Fit NearestNeighbors
-knn = NearestNeighbors(n_neighbors=5, metric="cosine")
-knn.fit(X)
-
-def get_replies(user_input, top_k=5):
-    vec = model.encode([user_input], convert_to_tensor=False)
-    distances, indices = knn.kneighbors(vec.reshape(1, -1), n_neighbors=top_k)
-    results = [df["reply"].iloc[idx] for idx in indices[0]]
-    return results
+def _turn_text(turn):
+    # Plain strings, stored chat messages ("text") or chat-API turns ("content")
+    if isinstance(turn, dict):
+        return str(turn.get("text") or turn.get("content") or "")
+    return str(turn)
+
+
+def _turn_role(turn, me):
+    # The LLM suggests the requesting user's next reply, so their own
+    # messages are "assistant" turns and everyone else's "user" turns
+    if isinstance(turn, dict):
+        if turn.get("role") in ("user", "assistant"):
+            return turn["role"]
+        if me and turn.get("senderId") == me:
+            return "assistant"
+    return "user"
+
+
+def suggestion_context(request, body, user_input):
+    """Earlier turns for /suggest/, oldest first: the posted history, or the stored chat."""
+    history = body.get("history")
+    email = request.COOKIES.get("email")
+    email = unquote(str(email)) if email else None
+    if history is None and body.get("selected") and email:
+        selected = body["selected"]
+        # Served from the conversation cache in a running chat; otherwise
+        # read only the last turns (plus the one being answered)
+        history = conversations.get(email, selected)
+        if history is None:
+            history = load_conversation(email, selected, limit=settings.SUGGEST_CONTEXT.get("TURNS", 4) + 1)
+    return context_turns(history, user_input, email)
+
+
+def context_turns(history, user_input, me=None):
+    """The last TURNS turns as chat messages ({"role", "content"}), ``me`` being the requesting user."""
+    turns = []
+    for turn in history or []:
+        text = _turn_text(turn)
+        if text.strip():
+            turns.append({"role": _turn_role(turn, me), "content": text})
+    if turns and turns[-1]["content"].strip() == str(user_input).strip():
+        turns.pop()  # the message being answered is already stored
+    return turns[-settings.SUGGEST_CONTEXT.get("TURNS", 4):]
+
+
+def turn_texts(context):
+    # KNN pools the texts alone (see suggester.query_vectors)
+    return [turn["content"] for turn in context]
+
+
+def suggestion_events(user_input, context, knn):
+    """Streaming /suggest/: the KNN list at once, then each LLM suggestion as it is generated."""
+    yield {"source": "knn", "suggestions": knn}
+    if llm_suggest.enabled():
+        try:
+            with contextlib.closing(llm_suggest.get_suggester().stream(user_input, context)) as suggestions:
+                for suggestion in suggestions:
+                    yield {"source": "llm", "suggestion": suggestion}
+        except Exception as e:
+            yield {"source": "llm", "error": str(e)}
+    yield {"done": True}
 
 
 @csrf_exempt
@@ -111,9 +215,32 @@ def suggest_reply(request):
             if not user_input:
                 return JsonResponse({"error": "No input provided"}, status=400)
 
-            suggestions = get_replies(user_input, top_k=5)
-            return JsonResponse({"input": user_input, "suggestions": suggestions}, safe=False)
+            started = time.monotonic()
+            context = suggestion_context(request, body, user_input)
+            if body.get("stream"):
+                knn = suggester.get_replies(user_input, top_k=5, context=turn_texts(context))
+                return streaming.response(suggestion_events(user_input, context, knn), body.get("format", "sse"))
+            # The LLM runs while KNN answers; it only gets until the deadline
+            llm = llm_suggest.get_suggester() if llm_suggest.enabled() else None
+            pending = llm.start(user_input, context) if llm is not None else None
+            suggestions = suggester.get_replies(user_input, top_k=5, context=turn_texts(context))
+            source = "knn"
+            if llm is not None:
+                suggestions, source = llm.finish(pending, suggestions, 5, started)
+            return JsonResponse({"input": user_input, "suggestions": suggestions, "source": source}, safe=False)
+        except suggest_service.ServiceBusy as e:
+            response = JsonResponse({"error": str(e)}, status=503)
+            response["Retry-After"] = "1"
+            return response
+        except suggest_service.ServiceTimeout as e:
+            return JsonResponse({"error": str(e)}, status=504)
+        except suggest_service.ServiceUnavailable as e:
+            return JsonResponse({"error": str(e)}, status=503)
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=500)
     return JsonResponse({"error": "POST required"}, status=405)
 
+
+def suggest_ready(request):
+    state = suggester.readiness()
+    return JsonResponse(state, status=200 if state["ready"] else 503)
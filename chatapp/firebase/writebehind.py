@@ -0,0 +1,237 @@
+"""Write-behind buffer for add_message.
+
+With ``CHAT_WRITE_BEHIND["ENABLED"]`` on, add_message only appends the
+message to a local spool file and an in-memory queue and returns. A
+background thread groups queued messages per conversation and commits
+them with Firestore batch writes once ``MAX_BATCH`` messages are waiting
+or every ``FLUSH_INTERVAL`` seconds, whichever comes first.
+
+Every process spools to its own ``<SPOOL_DIR>/messages-<pid>.ndjson``.
+A spool file is deleted only after everything in it has been committed,
+so messages queued when a worker crashes are still on disk. The next
+process to start claims spools left by dead processes and replays them.
+Idempotency comes from the storage layer: per-message docs are keyed by
+message id and ArrayUnion ignores exact duplicates. A message queued
+without an id in the messages layout gets a random one before it is
+spooled, so a replay rewrites its document instead of adding a copy.
+
+Each conversation is committed on its own, so one that keeps failing
+(say an array-layout document past Firestore's 1 MiB limit) does not hold
+up anyone else's. A failed conversation is retried with exponential
+backoff up to ``MAX_ATTEMPTS`` times, then its messages are moved to
+``<SPOOL_DIR>/dead-letter-<pid>.ndjson`` (never replayed automatically).
+Until a message is committed, ``pending()`` keeps returning it, so reads
+merge it in even while its commit is in progress.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from django.conf import settings
+
+from chatapp import metrics
+from . import storage
+
+
+class WriteBehindBuffer:
+    def __init__(self, spool_dir, max_batch=400, flush_interval=0.5, fsync=False, max_attempts=8, retry_backoff=1.0):
+        self.spool_dir = Path(spool_dir)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._pending = OrderedDict()
+        self._queued = 0
+        self._inflight = OrderedDict()  # taken from _pending, not committed yet
+        self._attempts = {}  # conversation -> (failed attempts, monotonic time of the next one)
+        self._spooled = False  # written to the current spool file since it was opened
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._done = []  # rotated spool files; deleted once _inflight is empty
+        self._rotations = 0
+        self.enqueued = self.flushed = self.commits = self.failures = self.dead_lettered = 0
+
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self._recover()
+        self._spool_path = self.spool_dir / f"messages-{os.getpid()}.ndjson"
+        self._spool = open(self._spool_path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _recover(self):
+        for path in sorted(self.spool_dir.glob("messages-*.ndjson*")):
+            # messages-<pid>.ndjson[.<n>][.claimed-<pid>]: the last pid owns it
+            if ".claimed-" in path.name:
+                pid = path.name.rsplit(".claimed-", 1)[1]
+            else:
+                pid = path.name.split("-", 1)[1].split(".", 1)[0]
+            if pid.isdigit() and _alive(int(pid)):
+                continue
+            claimed = path.with_name(f"{path.name}.claimed-{os.getpid()}")
+            try:
+                # rename is atomic: if two workers race, one of them loses
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            with open(claimed, encoding="utf-8") as spool:
+                for line in spool:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn final line from the crash
+                    self._add(record["email"], record["selected"], record["message"])
+            self._done.append(claimed)
+
+    def _add(self, email, selected, message):
+        self._pending.setdefault((email, selected), []).append(message)
+        self._queued += 1
+
+    def enqueue(self, email, selected, message):
+        """Queue a message and return it as it will be stored."""
+        message = storage.prepare_message(message)
+        if not message.get("id") and storage.storage_layout() == storage.MESSAGES:
+            message = dict(message, id=uuid.uuid4().hex)
+        line = json.dumps({"email": email, "selected": selected, "message": message}) + "\n"
+        with self._lock:
+            self._spool.write(line)
+            self._spool.flush()
+            self._spooled = True
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self._add(email, selected, message)
+            self.enqueued += 1
+            if self._queued >= self.max_batch:
+                self._wake.set()
+        return message
+
+    def pending(self, email, selected):
+        """Messages for the conversation that Firestore may not have yet, oldest first."""
+        key = (email, selected)
+        with self._lock:
+            return self._inflight.get(key, []) + self._pending.get(key, [])
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Write-behind flush failed:", e)
+
+    def flush(self, force=False):
+        """Commit what is queued, one conversation at a time; force ignores retry backoff."""
+        with self._flush_lock:
+            with self._lock:
+                for key, messages in self._pending.items():
+                    self._inflight[key] = self._inflight.get(key, []) + messages
+                self._pending, self._queued = OrderedDict(), 0
+                if self._spooled:
+                    # Everything spooled so far is in _inflight; new messages
+                    # go to a fresh spool file
+                    self._spool.close()
+                    self._rotations += 1
+                    rotated = self._spool_path.with_name(f"{self._spool_path.name}.{self._rotations}")
+                    os.rename(self._spool_path, rotated)
+                    self._done.append(rotated)
+                    self._spool = open(self._spool_path, "a", encoding="utf-8")
+                    self._spooled = False
+                now = time.monotonic()
+                due = [(key, messages) for key, messages in self._inflight.items()
+                       if force or self._attempts.get(key, (0, 0))[1] <= now]
+
+            for key, messages in due:
+                try:
+                    self.commits += storage.write_grouped({key: messages})
+                except Exception as e:
+                    self._failed(key, messages, e)
+                    continue
+                with self._lock:
+                    del self._inflight[key]
+                    self._attempts.pop(key, None)
+                self.flushed += len(messages)
+
+            with self._lock:
+                if not self._inflight:
+                    for path in self._done:
+                        path.unlink(missing_ok=True)
+                    self._done = []
+
+    def _failed(self, key, messages, error):
+        self.failures += 1
+        attempts = self._attempts.get(key, (0, 0))[0] + 1
+        if attempts < self.max_attempts:
+            delay = min(self.retry_backoff * 2 ** (attempts - 1), 300)
+            print(f"Write-behind commit failed for {key} (attempt {attempts}, retrying in {delay:.0f}s):", error)
+            with self._lock:
+                self._attempts[key] = (attempts, time.monotonic() + delay)
+            return
+        print(f"Write-behind gave up on {key} after {attempts} attempts:", error)
+        email, selected = key
+        with open(self.spool_dir / f"dead-letter-{os.getpid()}.ndjson", "a", encoding="utf-8") as dead:
+            for message in messages:
+                dead.write(json.dumps({"email": email, "selected": selected, "message": message,
+                                       "error": str(error)}) + "\n")
+        with self._lock:
+            del self._inflight[key]
+            self._attempts.pop(key, None)
+        self.dead_lettered += len(messages)
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+        self.flush(force=True)
+        with self._lock:
+            self._spool.close()
+            # Anything still uncommitted stays on disk for the next process
+            if not self._queued and not self._spooled:
+                self._spool_path.unlink(missing_ok=True)
+
+    def stats(self):
+        return {
+            "queued": self._queued,
+            "in_flight": sum(len(messages) for messages in self._inflight.values()),
+            "retrying": len(self._attempts),
+            "dead_lettered": self.dead_lettered,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "commits": self.commits,
+            "failures": self.failures,
+        }
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+buffer = None
+_config = getattr(settings, "CHAT_WRITE_BEHIND", {})
+if _config.get("ENABLED"):
+    buffer = WriteBehindBuffer(
+        _config.get("SPOOL_DIR", settings.BASE_DIR / "spool"),
+        max_batch=_config.get("MAX_BATCH", 400),
+        flush_interval=_config.get("FLUSH_INTERVAL", 0.5),
+        fsync=_config.get("FSYNC", False),
+        max_attempts=_config.get("MAX_ATTEMPTS", 8),
+        retry_backoff=_config.get("RETRY_BACKOFF", 1.0),
+    )
+    # Flush on interpreter shutdown (runserver reload, gunicorn worker exit)
+    atexit.register(buffer.close)
+    metrics.register("write_behind", buffer.stats)
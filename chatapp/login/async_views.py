@@ -0,0 +1,140 @@
+"""Async versions of signup, login and bot, for ASGI deployments.
+
+urls.py routes to these instead of views.py when ``ASYNC_VIEWS["ENABLED"]``
+is set. Upstream calls use the async pooled clients from
+chatapp/outbound.py, so a worker waiting on Identity Toolkit or a long
+OpenRouter completion is free to serve other requests meanwhile.
+"""
+import contextlib
+import json
+from urllib.parse import unquote
+
+from django.http import JsonResponse
+from django.shortcuts import redirect
+from django.views.decorators.csrf import csrf_exempt
+
+from chatapp import outbound, streaming
+from . import bot_cache, bot_memory, views
+from .views import API_KEY, API_URL, FIREBASE_SIGNIN_URL, FIREBASE_SIGNUP_URL, SYSTEM_PROMPT
+
+
+@csrf_exempt
+async def signup(request):
+    if request.method == "POST":
+        email = request.POST.get("email")
+        password = request.POST.get("password")
+        data = {
+            "email": email,
+            "password": password
+        }
+        r = await outbound.async_client("identitytoolkit").post(FIREBASE_SIGNUP_URL, json=data)
+        if r.status_code == 200:
+            token = r.json()["idToken"]
+            resp = JsonResponse({"message": "Signup successful"})
+            resp.set_cookie("token", token, httponly=True)
+            resp.set_cookie("email", email, httponly=True)
+        return redirect('http://localhost:3000/')
+
+
+@csrf_exempt
+async def login(request):
+    if request.method == "POST":
+        email = request.POST.get("email")
+        password = request.POST.get("password")
+        data = {
+            "email": email,
+            "password": password,
+            "returnSecureToken": True
+        }
+        r = await outbound.async_client("identitytoolkit").post(FIREBASE_SIGNIN_URL, json=data)
+        if r.status_code == 200:
+            token = r.json()["idToken"]
+
+            # Only queues the email (see otp_delivery.py)
+            views.send_otp(request, email)
+            return redirect('http://localhost:5000/register-email-user?email='+email)
+        else:
+            return JsonResponse({"Message": r.json()}, status=400)
+
+
+async def complete(headers, payload):
+    response = await outbound.async_client("openrouter").post(API_URL, headers=headers, json=payload)
+    body = response.json()
+    return body["choices"][0]["message"]["content"], body.get("usage")
+
+
+async def stream_bot(question, headers, payload, session=None, cache=True):
+    """views.stream_bot for async views: an async generator of events, or BotBusy before it starts."""
+    gateway = bot_cache.get_gateway()
+    cached, how = (await gateway.alookup(question)) if cache else (None, None)
+    if cached is not None:
+        bot_memory.record(session, question, cached)
+        return cached_events(cached, how)
+    slot = contextlib.AsyncExitStack()
+    await slot.enter_async_context(gateway.aslot())
+    return relay_bot(slot, gateway, question, headers, payload, session, cache)
+
+
+async def cached_events(answer, how):
+    yield {"delta": answer, "source": how}
+    yield {"done": True}
+
+
+async def relay_bot(slot, gateway, question, headers, payload, session, cache):
+    # Cancelled when the client disconnects; leaving the block closes the upstream request
+    try:
+        async with slot, outbound.async_client("openrouter").stream(
+                "POST", API_URL, headers=headers, json=dict(payload, stream=True)) as r:
+            r.raise_for_status()
+            parts = []
+            async for line in r.aiter_lines():
+                delta = views.openrouter_delta(line)
+                if delta is views.DONE:
+                    if cache:
+                        await gateway.astore(question, "".join(parts))
+                    bot_memory.record(session, question, "".join(parts))
+                    break
+                if delta:
+                    parts.append(delta)
+                    yield {"delta": delta}
+        yield {"done": True}
+    except Exception as e:
+        yield {"error": str(e)}
+
+
+@csrf_exempt
+async def bot(request):
+    if request.method == "POST":
+        try:
+            data = json.loads(request.body)
+            user_message = data.get("message")
+            if not user_message:
+                return JsonResponse({"message": "No message provided"}, status=400)
+
+            headers = {
+                "Authorization": f"Bearer {API_KEY}",
+                "Content-Type": "application/json",
+            }
+            # SYSTEM_PROMPT first and unchanged, then this user's memory (see bot_memory.py)
+            session, messages = bot_memory.begin(unquote(request.COOKIES.get("email", "")), SYSTEM_PROMPT, user_message)
+            # With earlier turns in the prompt the answer is not the question's alone
+            cache = session is None or session.empty()
+            payload = {
+                "model": "gpt-oss-20b",
+                "messages": messages,
+                "temperature": 0.7,
+                "max_tokens": 512
+            }
+            if data.get("stream"):
+                events = await stream_bot(user_message, headers, payload, session, cache)
+                return streaming.response(events, data.get("format", "sse"))
+            ai_response, source = await bot_cache.get_gateway().aanswer(user_message, lambda: complete(headers, payload), cache)
+            bot_memory.record(session, user_message, ai_response)
+            return JsonResponse({"message": ai_response, "source": source})
+        except bot_cache.BotBusy as e:
+            response = JsonResponse({"error": str(e)}, status=503)
+            response["Retry-After"] = "1"
+            return response
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+    return JsonResponse({"message": "Invalid request"}, status=400)
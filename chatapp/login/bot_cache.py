@@ -0,0 +1,325 @@
+"""Cached, coalesced and admission-controlled /bot/ answers.
+
+Every /bot/ call sends the whole SYSTEM_PROMPT to OpenRouter, and most
+users ask the same handful of questions. ``BotGateway.answer(question,
+call)`` only runs ``call`` (the OpenRouter completion) when it has to:
+
+- an answer cached for the same normalized question is returned as is;
+  with ``SIMILARITY_THRESHOLD`` set, so is the answer to a cached question
+  whose embedding (the suggestion engine's encoder) is at least that close
+- a request for a question that is already being answered waits for that
+  call instead of making its own
+- otherwise the call needs one of ``MAX_CONCURRENT`` upstream slots. At
+  most ``MAX_QUEUE`` requests wait for one, each for at most
+  ``QUEUE_TIMEOUT`` seconds; past that ``BotBusy`` is raised (503 in the
+  views), so a spike cannot pile up unbounded 60-second calls.
+
+Answers that depend on more than the question (a /bot/ request carrying
+conversation memory) pass ``cache=False``: they only take a slot.
+
+``aanswer`` does the same for async views. Async callers share the cache
+and the in-flight calls with sync ones; their slots are counted per event
+loop, and similarity lookups encode in a worker thread, not on the loop.
+When a request making a shared call is cancelled (its client went away),
+the requests waiting on it retry instead of failing with it.
+
+Hits, coalesced requests, the calls and tokens they saved and the queue
+wait percentiles are in ``/stats/`` under ``bot``.
+"""
+import asyncio
+import contextlib
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from chatapp import metrics
+from firebase.cache import LRUCache
+from firebase.suggest_cache import normalize_text
+
+
+class BotBusy(Exception):
+    pass
+
+
+class LeaderGone(Exception):
+    """The request making the shared call went away (cancelled) before it finished."""
+
+
+class BotGateway:
+    def __init__(self, max_entries=2000, ttl=24 * 3600, similarity_threshold=None,
+                 max_concurrent=8, max_queue=32, queue_timeout=10):
+        self.cache = LRUCache(max_entries, ttl)  # normalized question -> (answer, usage)
+        self.threshold = similarity_threshold
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self._async_slots = weakref.WeakKeyDictionary()  # event loop -> asyncio.Semaphore
+        self._inflight = {}  # normalized question -> Future of (answer, usage)
+        self._vectors = OrderedDict()  # normalized question -> embedding, for similarity hits
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._waits = deque(maxlen=2048)
+        self.counts = {"exact": 0, "similar": 0, "coalesced": 0, "upstream": 0, "busy": 0, "saved_tokens": 0}
+
+    # Cache
+
+    def lookup(self, question):
+        """The cached answer for question, or one close enough: (answer, "exact"/"similar") or (None, None)."""
+        key = normalize_text(question)
+        entry, how = self.cache.get(key, None), "exact"
+        if entry is None and self.threshold is not None:
+            entry, how = self._similar(key), "similar"
+        if entry is None:
+            return None, None
+        self.counts[how] += 1
+        self._saved(entry)
+        return entry[0], how
+
+    def store(self, question, answer, usage=None):
+        if not answer or not self.cache.max_entries:
+            return
+        key = normalize_text(question)
+        self.cache.set(key, (answer, usage))
+        if self.threshold is not None:
+            vec = self._embed(key)
+            if vec is not None:
+                with self._lock:
+                    self._vectors[key] = vec
+                    self._vectors.move_to_end(key)
+                    while len(self._vectors) > self.cache.max_entries:
+                        self._vectors.popitem(last=False)
+
+    async def alookup(self, question):
+        """lookup() for async callers; similarity lookups encode off the event loop."""
+        if self.threshold is None:
+            return self.lookup(question)
+        return await sync_to_async(self.lookup, thread_sensitive=False)(question)
+
+    async def astore(self, question, answer, usage=None):
+        if self.threshold is None:
+            return self.store(question, answer, usage)
+        return await sync_to_async(self.store, thread_sensitive=False)(question, answer, usage)
+
+    def _embed(self, key):
+        from firebase import suggest_service, suggester
+
+        if suggest_service.enabled():
+            return None  # the encoder lives in the suggestion service process
+        try:
+            return suggester.get_engine().encode([key])[0]
+        except Exception as e:
+            print("Error:", e)
+            return None
+
+    def _similar(self, key):
+        with self._lock:
+            keys, vecs = list(self._vectors), list(self._vectors.values())
+        if not keys:
+            return None
+        vec = self._embed(key)
+        if vec is None:
+            return None
+        import numpy as np
+
+        scores = np.vstack(vecs) @ vec
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None
+        entry = self.cache.get(keys[best], None)
+        if entry is None:
+            with self._lock:
+                self._vectors.pop(keys[best], None)  # expired or evicted
+        return entry
+
+    def _saved(self, entry):
+        usage = entry[1] or {}
+        self.counts["saved_tokens"] += usage.get("total_tokens", 0)
+
+    # Admission
+
+    def _admit(self):
+        # Returns the wait start, or raises BotBusy when the queue is full
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self.counts["busy"] += 1
+                raise BotBusy("The assistant is busy, try again in a moment")
+            self._waiting += 1
+        return time.perf_counter()
+
+    def _left_queue(self, started):
+        with self._lock:
+            self._waiting -= 1
+            self._waits.append(time.perf_counter() - started)
+
+    def _busy(self):
+        self.counts["busy"] += 1
+        return BotBusy("The assistant is busy, try again in a moment")
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold one upstream slot for the block, queueing for it if needed."""
+        if not self.slots.acquire(blocking=False):
+            started = self._admit()
+            try:
+                acquired = self.slots.acquire(timeout=self.queue_timeout)
+            finally:
+                self._left_queue(started)
+            if not acquired:
+                raise self._busy()
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            slots = self._async_slots.setdefault(loop, asyncio.Semaphore(self.max_concurrent))
+        if slots.locked():
+            started = self._admit()
+            acquired = False
+            try:
+                await asyncio.wait_for(slots.acquire(), self.queue_timeout)
+                acquired = True
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                # Also when the request is cancelled (client gone) while it waits
+                self._left_queue(started)
+            if not acquired:
+                raise self._busy()
+        else:
+            await slots.acquire()  # free: returns at once
+        try:
+            yield
+        finally:
+            slots.release()
+
+    # Answers
+
+    def _join(self, question):
+        # (key, future, leader): the leader makes the call, everyone else waits on its future
+        key = normalize_text(question)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.counts["coalesced"] += 1
+                return key, future, False
+            future = self._inflight[key] = Future()
+            return key, future, True
+
+    def _settle(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is None:
+            self.counts["upstream"] += 1
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)  # the upstream failed: it would for the followers too
+        else:
+            # Cancelled (or interrupted): followers make the call themselves
+            future.set_exception(LeaderGone())
+
+    def answer(self, question, call, cache=True):
+        """(answer, source) for question; ``call()`` returns (answer, usage) from OpenRouter."""
+        if not cache:
+            with self.slot():
+                result = call()
+            self.counts["upstream"] += 1
+            return result[0], "upstream"
+        while True:
+            answer, how = self.lookup(question)
+            if answer is not None:
+                return answer, how
+            key, future, leader = self._join(question)
+            if not leader:
+                try:
+                    result = future.result()
+                except LeaderGone:
+                    continue
+                self._saved(result)
+                return result[0], "coalesced"
+            try:
+                with self.slot():
+                    result = call()
+            except BaseException as e:
+                self._settle(key, future, error=e)
+                raise
+            self._settle(key, future, result)
+            self.store(key, *result)
+            return result[0], "upstream"
+
+    async def aanswer(self, question, call, cache=True):
+        """answer() for async views; ``call()`` returns an awaitable."""
+        if not cache:
+            async with self.aslot():
+                result = await call()
+            self.counts["upstream"] += 1
+            return result[0], "upstream"
+        while True:
+            answer, how = await self.alookup(question)
+            if answer is not None:
+                return answer, how
+            key, future, leader = self._join(question)
+            if not leader:
+                try:
+                    # shield: a cancelled follower must not cancel the leader's call
+                    result = await asyncio.shield(asyncio.wrap_future(future))
+                except LeaderGone:
+                    continue
+                self._saved(result)
+                return result[0], "coalesced"
+            try:
+                async with self.aslot():
+                    result = await call()
+            except BaseException as e:
+                self._settle(key, future, error=e)
+                raise
+            self._settle(key, future, result)
+            await self.astore(key, *result)
+            return result[0], "upstream"
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            waiting, in_flight = self._waiting, len(self._inflight)
+        percentile = lambda p: round(waits[min(int(len(waits) * p), len(waits) - 1)] * 1000, 2)
+        return dict(
+            self.counts,
+            saved_calls=self.counts["exact"] + self.counts["similar"] + self.counts["coalesced"],
+            in_flight=in_flight,
+            waiting=waiting,
+            queue_wait_p50_ms=percentile(0.5) if waits else None,
+            queue_wait_p95_ms=percentile(0.95) if waits else None,
+            queue_wait_max_ms=round(waits[-1] * 1000, 2) if waits else None,
+            cache=self.cache.stats(),
+        )
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                config = getattr(settings, "BOT_CACHE", {})
+                _gateway = BotGateway(
+                    max_entries=config.get("MAX_ENTRIES", 2000),
+                    ttl=config.get("TTL", 24 * 3600),
+                    similarity_threshold=config.get("SIMILARITY_THRESHOLD"),
+                    max_concurrent=config.get("MAX_CONCURRENT", 8),
+                    max_queue=config.get("MAX_QUEUE", 32),
+                    queue_timeout=config.get("QUEUE_TIMEOUT", 10),
+                )
+                metrics.register("bot", _gateway.stats)
+    return _gateway
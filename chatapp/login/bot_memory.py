@@ -0,0 +1,209 @@
+"""Per-user conversation memory for /bot/, within a token budget.
+
+Each signed-in user (the ``email`` cookie) gets a session. The prompt for
+a request is built as follows:
+
+1. ``SYSTEM_PROMPT``, byte for byte the same for every user and every
+   request, so OpenRouter's prompt (prefix) caching keeps hitting
+2. a rolling summary of the older turns, if there is one (at most
+   ``SUMMARY_TOKENS``)
+3. the most recent question/answer pairs verbatim (at most
+   ``HISTORY_TOKENS``)
+4. the new message
+
+A pair that no longer fits the history budget leaves the prompt at once.
+A background thread then folds it into the summary, with one OpenRouter
+call per session at a time, never on a request's path. However long a
+session runs, the prompt stays within the system prompt plus both budgets
+plus the new message.
+
+Tokens are estimated as UTF-8 bytes / 4. That overestimates for most
+text, which is the safe side for a budget. Sessions live in this process:
+``MAX_USERS`` at most, forgotten after ``IDLE_TTL`` seconds without a
+message. Anonymous requests stay single-turn, as before.
+
+Memory is off unless ``BOT_MEMORY["ENABLED"]`` is set. Once a session has
+history, its answers depend on more than the question, so they bypass the
+answer cache (bot_cache.py): turning memory on trades cache hits for
+context.
+"""
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from chatapp import metrics, outbound
+from firebase.cache import LRUCache
+
+SUMMARY_PROMPT = (
+    "You maintain the memory of a chat between a user and ChatBuddy, the assistant of a chat app. "
+    "Rewrite the summary so far to also cover the new turns, in at most {words} words. Keep what the "
+    "user told about themselves, their preferences, decisions and open questions; drop greetings and "
+    "small talk. Reply with the summary only."
+)
+
+
+def estimate_tokens(text):
+    return (len(str(text).encode("utf-8")) + 3) // 4
+
+
+class Session:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pairs = deque()  # (question, answer, tokens), oldest first
+        self.tokens = 0
+        self.summary = ""
+        self.pending = []  # pairs out of the prompt, not yet in the summary
+        self.summarizing = False
+
+    def empty(self):
+        with self.lock:
+            return not self.pairs and not self.summary and not self.pending
+
+
+class BotMemory:
+    def __init__(self, history_tokens=1500, summary_tokens=300, max_users=10_000, idle_ttl=3600, model="gpt-oss-20b"):
+        self.history_tokens = history_tokens
+        self.summary_tokens = summary_tokens
+        self.model = model
+        self.sessions = LRUCache(max_users, idle_ttl)
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(1, thread_name_prefix="bot-summary")
+        self._prompt_tokens = deque(maxlen=2048)
+        self.counts = {"summaries": 0, "summary_errors": 0, "dropped_pairs": 0}
+
+    def session(self, user):
+        """The memory of user, or None for anonymous requests."""
+        if not user:
+            return None
+        with self._lock:
+            session = self.sessions.get(user, None)
+            if session is None:
+                session = Session()
+            self.sessions.set(user, session)  # refreshes the idle TTL
+            return session
+
+    def messages(self, session, system_prompt, message):
+        """The chat messages to send for message, with session's memory if any."""
+        messages = [{"role": "system", "content": system_prompt}]
+        if session is not None:
+            with session.lock:
+                if session.summary:
+                    messages.append({"role": "system", "content": "Earlier in this conversation: " + session.summary})
+                for question, answer, _ in session.pairs:
+                    messages.append({"role": "user", "content": question})
+                    messages.append({"role": "assistant", "content": answer})
+        messages.append({"role": "user", "content": message})
+        self._prompt_tokens.append(sum(estimate_tokens(m["content"]) for m in messages))
+        return messages
+
+    def record(self, session, question, answer):
+        """Add a finished exchange; pairs past the budget go to the summarizer."""
+        if session is None or not answer:
+            return
+        tokens = estimate_tokens(question) + estimate_tokens(answer)
+        with session.lock:
+            session.pairs.append((question, answer, tokens))
+            session.tokens += tokens
+            while session.tokens > self.history_tokens:
+                pair = session.pairs.popleft()
+                session.tokens -= pair[2]
+                session.pending.append(pair)
+            # If summaries keep failing, forget the oldest turns rather than grow
+            while sum(pair[2] for pair in session.pending) > 4 * self.history_tokens:
+                session.pending.pop(0)
+                self.counts["dropped_pairs"] += 1
+            if session.pending and not session.summarizing:
+                session.summarizing = True
+                self._pool.submit(self._summarize, session)
+
+    def _summarize(self, session):
+        with session.lock:
+            summary, pending = session.summary, list(session.pending)
+        try:
+            summary = self._call(summary, pending)
+        except Exception as e:
+            self.counts["summary_errors"] += 1
+            print("Error:", e)
+            summary = None
+        with session.lock:
+            if summary is not None:
+                session.summary = summary
+                taken = {id(pair) for pair in pending}
+                session.pending = [pair for pair in session.pending if id(pair) not in taken]
+                self.counts["summaries"] += 1
+            session.summarizing = False
+            # Pairs that arrived meanwhile get their own pass; failures wait for the next message
+            if summary is not None and session.pending:
+                session.summarizing = True
+                self._pool.submit(self._summarize, session)
+
+    def _call(self, summary, pairs):
+        from .views import API_KEY, API_URL
+
+        turns = "\n".join(f"User: {question}\nChatBuddy: {answer}" for question, answer, _ in pairs)
+        payload = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT.format(words=int(self.summary_tokens * 0.75))},
+                {"role": "user", "content": f"Summary so far:\n{summary or '(none)'}\n\nNew turns:\n{turns}"},
+            ],
+            "temperature": 0.2,
+            "max_tokens": self.summary_tokens,
+        }
+        headers = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+        response = outbound.client("openrouter").post(API_URL, headers=headers, json=payload)
+        response.raise_for_status()
+        summary = response.json()["choices"][0]["message"]["content"].strip()
+        # max_tokens bounds the model's tokens, not our estimate of them
+        limit = self.summary_tokens * 4
+        return summary if len(summary.encode("utf-8")) <= limit else summary.encode("utf-8")[:limit].decode("utf-8", "ignore")
+
+    def stats(self):
+        tokens = sorted(self._prompt_tokens)
+        return dict(
+            self.counts,
+            sessions=len(self.sessions),
+            prompt_tokens_p50=tokens[len(tokens) // 2] if tokens else None,
+            prompt_tokens_max=tokens[-1] if tokens else None,
+        )
+
+
+_memory = None
+_memory_lock = threading.Lock()
+
+
+def get_memory():
+    global _memory
+    if _memory is None:
+        with _memory_lock:
+            if _memory is None:
+                config = getattr(settings, "BOT_MEMORY", {})
+                _memory = BotMemory(
+                    history_tokens=config.get("HISTORY_TOKENS", 1500),
+                    summary_tokens=config.get("SUMMARY_TOKENS", 300),
+                    max_users=config.get("MAX_USERS", 10_000),
+                    idle_ttl=config.get("IDLE_TTL", 3600),
+                    model=config.get("SUMMARY_MODEL", "gpt-oss-20b"),
+                )
+                metrics.register("bot_memory", _memory.stats)
+    return _memory
+
+
+def enabled():
+    return bool(getattr(settings, "BOT_MEMORY", {}).get("ENABLED"))
+
+
+def begin(user, system_prompt, message):
+    """(session, messages) for a /bot/ request; session is None when there is no memory to keep."""
+    memory = get_memory() if enabled() else None
+    session = memory.session(user) if memory is not None else None
+    if session is None:
+        return None, [{"role": "system", "content": system_prompt}, {"role": "user", "content": message}]
+    return session, memory.messages(session, system_prompt, message)
+
+
+def record(session, question, answer):
+    if session is not None:
+        get_memory().record(session, question, answer)
@@ -0,0 +1,286 @@
+"""Background delivery of OTP emails.
+
+``send_otp`` only builds the message and queues it here, so a login never
+waits for the mail server. ``WORKERS`` threads take up to ``BATCH``
+messages at a time and send them over an SMTP session each worker keeps
+open and authenticated between batches. The session is replaced after
+``MAX_MESSAGES_PER_CONNECTION`` messages, or when it sat idle
+``IDLE_TIMEOUT`` seconds (servers drop idle clients anyway), and whenever
+the server hangs up.
+
+A failed message is retried up to ``RETRIES`` times, with full-jitter
+exponential backoff from ``BACKOFF`` seconds, when the failure is
+temporary (a connection problem or a 4xx reply). A 5xx reply fails it at
+once. ``status(id)`` reports where a message stands (queued, retrying,
+sent, failed or dropped) for the last ``HISTORY`` deliveries. Totals, send
+latency and queue wait are in ``/stats/`` under ``otp_delivery``; failures
+are logged with the delivery id ``enqueue`` returned.
+
+The queue is in memory: OTPs are short-lived, and one lost in a crash is
+re-requested by logging in again. On a clean shutdown ``close`` sends what
+is queued, retries included without their backoff, and logs whatever
+could not go out in time.
+"""
+import atexit
+import heapq
+import itertools
+import random
+import smtplib
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+
+from chatapp import metrics
+from firebase.cache import LRUCache
+
+
+def _temporary(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code < 500
+    return isinstance(error, OSError)  # SMTPException is one too
+
+
+class SMTPSession:
+    """One authenticated connection, reopened as needed."""
+
+    def __init__(self, host, port, username=None, password=None, starttls=True, timeout=10,
+                 max_messages=100, idle_timeout=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.connection = None
+        self.sent = 0
+        self.last_used = 0.0
+        self.connects = 0
+
+    def _open(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+        self.connection, self.sent, self.last_used = connection, 0, time.monotonic()
+        self.connects += 1
+
+    def send(self, sender, recipient, message):
+        if self.connection is not None and (
+                self.sent >= self.max_messages or time.monotonic() - self.last_used > self.idle_timeout):
+            self.close()
+        if self.connection is None:
+            self._open()
+        try:
+            self.connection.sendmail(sender, [recipient], message)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            raise  # the server refused this message; the session is still good
+        except OSError:  # SMTPServerDisconnected and socket errors
+            self.close()
+            raise
+        self.sent += 1
+        self.last_used = time.monotonic()
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except Exception:
+                self.connection.close()
+            self.connection = None
+
+
+class DeliveryQueue:
+    def __init__(self, sender, session_options, workers=2, batch=20, retries=4, backoff=1.0, history=10_000):
+        self.sender = sender
+        self.session_options = session_options
+        self.batch = batch
+        self.retries = retries
+        self.backoff = backoff
+        self.statuses = LRUCache(history, 24 * 3600)  # delivery id -> status dict
+        self._ready = deque()
+        self._delayed = []  # heap of (due, n, item)
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._closing = False  # retry delayed items now instead of at their due time
+        self._stopped = False
+        self._busy = 0
+        self._latencies = deque(maxlen=2048)
+        self._waits = deque(maxlen=2048)  # enqueue to first attempt
+        self.counts = {"queued": 0, "sent": 0, "retried": 0, "failed": 0, "dropped": 0}
+        self._sessions = []
+        self._threads = [
+            threading.Thread(target=self._run, name=f"otp-delivery-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def enqueue(self, recipient, message):
+        """Queue an email.message.Message for recipient; returns its delivery id."""
+        delivery_id = uuid.uuid4().hex
+        item = {"id": delivery_id, "to": recipient, "message": message.as_string(),
+                "attempts": 0, "queued_at": time.monotonic()}
+        self._record(item, "queued")
+        with self._cond:
+            self._ready.append(item)
+            self.counts["queued"] += 1
+            self._cond.notify()
+        return delivery_id
+
+    def status(self, delivery_id):
+        """{"status", "attempts", "error"} for a delivery id, or None if unknown (or forgotten)."""
+        return self.statuses.peek(delivery_id, None)
+
+    def _record(self, item, status, error=None):
+        self.statuses.set(item["id"], {"status": status, "attempts": item["attempts"],
+                                       "error": None if error is None else str(error)})
+
+    def _next_batch(self, idle_timeout):
+        # A batch, [] after idle_timeout without work, or None once closed
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and (self._closing or self._delayed[0][0] <= now):
+                    self._ready.append(heapq.heappop(self._delayed)[2])
+                if self._ready:
+                    # Split a backlog across the workers rather than hand it all to one
+                    size = min(self.batch, -(-len(self._ready) // len(self._threads)))
+                    batch = [self._ready.popleft() for _ in range(size)]
+                    self._busy += 1
+                    return batch
+                if self._stopped:
+                    return None
+                timeout = self._delayed[0][0] - now if self._delayed else idle_timeout
+                if not self._cond.wait(timeout) and not self._delayed:
+                    return []
+
+    def _run(self):
+        session = SMTPSession(**self.session_options)
+        self._sessions.append(session)
+        while True:
+            batch = self._next_batch(session.idle_timeout)
+            if not batch:
+                session.close()  # closed, or idle: don't hold a connection slot on the server
+                if batch is None:
+                    return
+                continue
+            try:
+                for item in batch:
+                    self._send(session, item)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    self._cond.notify_all()
+
+    def _send(self, session, item):
+        if not item["attempts"]:
+            self._waits.append(time.monotonic() - item["queued_at"])
+        item["attempts"] += 1
+        started = time.perf_counter()
+        try:
+            session.send(self.sender, item["to"], item["message"])
+        except Exception as e:
+            self._failed(item, e)
+            return
+        self._latencies.append(time.perf_counter() - started)
+        self.counts["sent"] += 1
+        self._record(item, "sent")
+
+    def _failed(self, item, error):
+        print(f"OTP delivery {item['id']} failed (attempt {item['attempts']}):", error)
+        if item["attempts"] > self.retries or not _temporary(error):
+            self.counts["failed"] += 1
+            self._record(item, "failed", error)
+            return
+        self.counts["retried"] += 1
+        self._record(item, "retrying", error)
+        # Full jitter, as for outbound HTTP retries
+        delay = random.uniform(0, self.backoff * 2 ** (item["attempts"] - 1))
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._order), item))
+            self._cond.notify()
+
+    def close(self, timeout=10):
+        """Send what is queued, retries included, then stop; log what is left after timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            while (self._ready or self._delayed or self._busy) and time.monotonic() < deadline:
+                self._cond.wait(max(deadline - time.monotonic(), 0))
+            self._stopped = True
+            left = list(self._ready) + [item for _, _, item in self._delayed]
+            self._ready.clear()
+            self._delayed = []
+            self.counts["dropped"] += len(left)
+            self._cond.notify_all()
+        for item in left:
+            self._record(item, "dropped", "Shut down before it was sent")
+            print(f"OTP delivery {item['id']} to {item['to']} dropped at shutdown after {item['attempts']} attempts")
+        for thread in self._threads:
+            thread.join(timeout=max(deadline - time.monotonic(), 0.1))
+
+    def stats(self):
+        latencies, waits = sorted(self._latencies), sorted(self._waits)
+        percentile = lambda values, p: round(values[min(int(len(values) * p), len(values) - 1)] * 1000, 2)
+        with self._cond:
+            waiting, delayed = len(self._ready), len(self._delayed)
+        return dict(
+            self.counts,
+            waiting=waiting,
+            delayed=delayed,
+            connects=sum(session.connects for session in self._sessions),
+            send_p50_ms=percentile(latencies, 0.5) if latencies else None,
+            send_p95_ms=percentile(latencies, 0.95) if latencies else None,
+            queue_wait_p95_ms=percentile(waits, 0.95) if waits else None,
+        )
+
+
+_queue = None
+_lock = threading.Lock()
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                config = getattr(settings, "OTP_EMAIL", {})
+                _queue = DeliveryQueue(
+                    config.get("FROM") or config.get("USERNAME"),
+                    {
+                        "host": config.get("HOST", "localhost"),
+                        "port": config.get("PORT", 25),
+                        "username": config.get("USERNAME"),
+                        "password": config.get("PASSWORD"),
+                        "starttls": config.get("STARTTLS", False),
+                        "timeout": config.get("TIMEOUT", 10),
+                        "max_messages": config.get("MAX_MESSAGES_PER_CONNECTION", 100),
+                        "idle_timeout": config.get("IDLE_TIMEOUT", 60),
+                    },
+                    workers=config.get("WORKERS", 2),
+                    batch=config.get("BATCH", 20),
+                    retries=config.get("RETRIES", 4),
+                    backoff=config.get("BACKOFF", 1.0),
+                    history=config.get("HISTORY", 10_000),
+                )
+                # Give queued OTPs a chance to go out on worker exit
+                atexit.register(_queue.close)
+                metrics.register("otp_delivery", _queue.stats)
+    return _queue
+
+
+def status(delivery_id):
+    """{"status": "queued" | "retrying" | "sent" | "failed" | "dropped", "attempts", "error"}, or None."""
+    return get_queue().status(delivery_id)
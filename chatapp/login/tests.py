@@ -1,3 +1,408 @@
-from django.test import TestCase
+import asyncio
+import json
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from chatapp import outbound
+
+from . import bot_cache, bot_memory, otp_delivery, views
+from .bot_cache import BotBusy, BotGateway
+
+
+class BotGatewayTests(SimpleTestCase):
+    def test_exact_hit_after_first_answer(self):
+        gateway = BotGateway()
+        calls = []
+
+        def call():
+            calls.append(1)
+            return "I'm ChatBuddy", {"total_tokens": 900}
+
+        self.assertEqual(gateway.answer("Who are you?", call), ("I'm ChatBuddy", "upstream"))
+        self.assertEqual(gateway.answer("who are you", call), ("I'm ChatBuddy", "exact"))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(gateway.stats()["saved_tokens"], 900)
+
+    def test_uncached_answers_skip_the_cache(self):
+        gateway = BotGateway()
+        gateway.answer("hi", lambda: ("first", None))
+        self.assertEqual(gateway.answer("hi", lambda: ("second", None), cache=False), ("second", "upstream"))
+
+    def test_identical_requests_share_one_call(self):
+        gateway = BotGateway()
+        release, calls, results = threading.Event(), [], []
+
+        def call():
+            calls.append(1)
+            release.wait(5)
+            return "answer", None
+
+        threads = [threading.Thread(target=lambda: results.append(gateway.answer("same", call))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while gateway.stats()["coalesced"] < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(source for _, source in results), ["coalesced"] * 3 + ["upstream"])
+
+    def test_upstream_errors_reach_followers(self):
+        gateway = BotGateway()
+        key, future, _ = gateway._join("q")
+        gateway._settle(key, future, error=ValueError("upstream down"))
+        with self.assertRaises(ValueError):
+            future.result()
+
+    def test_full_queue_is_busy(self):
+        gateway = BotGateway(max_concurrent=1, max_queue=0, queue_timeout=0.05)
+        with gateway.slot():
+            with self.assertRaises(BotBusy):
+                with gateway.slot():
+                    pass
+        self.assertEqual(gateway.stats()["busy"], 1)
+        with gateway.slot():
+            pass
+
+    def test_slot_wait_times_out(self):
+        gateway = BotGateway(max_concurrent=1, max_queue=1, queue_timeout=0.05)
+        with gateway.slot():
+            with self.assertRaises(BotBusy):
+                with gateway.slot():
+                    pass
+        self.assertEqual(gateway.stats()["waiting"], 0)
+
+    def test_cancelled_waiters_leave_the_queue(self):
+        gateway = BotGateway(max_concurrent=1, max_queue=2, queue_timeout=5)
+
+        async def wait_for_slot():
+            async with gateway.aslot():
+                pass
+
+        async def main():
+            async with gateway.aslot():
+                waiters = [asyncio.ensure_future(wait_for_slot()) for _ in range(2)]
+                await asyncio.sleep(0.05)
+                self.assertEqual(gateway.stats()["waiting"], 2)
+                for waiter in waiters:
+                    waiter.cancel()
+                await asyncio.gather(*waiters, return_exceptions=True)
+            self.assertEqual(gateway.stats()["waiting"], 0)
+            # The queue is usable again
+            return await gateway.aanswer("later", self._answer("fine"))
+
+        self.assertEqual(asyncio.run(main()), ("fine", "upstream"))
+
+    def test_cancelled_leader_does_not_fail_followers(self):
+        gateway = BotGateway()
+        started = asyncio.Event
+
+        async def main():
+            leader_started = started()
+
+            async def slow():
+                leader_started.set()
+                await asyncio.sleep(10)
+                return "never", None
+
+            leader = asyncio.ensure_future(gateway.aanswer("q", slow))
+            await leader_started.wait()
+            follower = asyncio.ensure_future(gateway.aanswer("q", self._answer("from the follower")))
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(main()), ("from the follower", "upstream"))
+        self.assertEqual(gateway.stats()["in_flight"], 0)
+
+    @staticmethod
+    def _answer(text):
+        async def call():
+            return text, None
+        return call
+
+
+class StreamBotTests(SimpleTestCase):
+    def setUp(self):
+        self.gateway = BotGateway(max_concurrent=1, max_queue=0)
+        patcher = mock.patch.object(bot_cache, "get_gateway", return_value=self.gateway)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self):
+        body = json.dumps({"message": "hi", "stream": True})
+        return RequestFactory().post("/bot/", body, content_type="application/json")
+
+    def test_busy_gateway_is_503_before_the_stream_starts(self):
+        with self.gateway.slot():
+            response = views.bot(self.request())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "1")
+
+    def test_async_busy_gateway_is_503_before_the_stream_starts(self):
+        from . import async_views
+
+        async def main():
+            async with self.gateway.aslot():
+                return await async_views.bot(self.request())
+
+        response = asyncio.run(main())
+        self.assertEqual(response.status_code, 503)
+
+    def test_slot_is_released_when_the_stream_ends(self):
+        upstream = mock.Mock()
+        upstream.iter_lines.return_value = [b'data: {"choices": [{"delta": {"content": "Hey"}}]}', b"data: [DONE]"]
+        with mock.patch.object(views.outbound, "client") as client:
+            client.return_value.post.return_value = upstream
+            response = views.bot(self.request())
+            self.assertEqual(response.status_code, 200)
+            b"".join(response.streaming_content)
+        upstream.close.assert_called_once()
+        with self.gateway.slot():
+            pass
+
+
+class OpenRouterStreamTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(bot_cache, "get_gateway", return_value=BotGateway())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_delta_parsing(self):
+        self.assertEqual(views.openrouter_delta('data: {"choices": [{"delta": {"content": "Hi"}}]}'), "Hi")
+        self.assertEqual(views.openrouter_delta('data:{"choices": [{"delta": {"content": " there"}}]}'), " there")
+        self.assertIs(views.openrouter_delta("data: [DONE]"), views.DONE)
+        self.assertIsNone(views.openrouter_delta(": OPENROUTER PROCESSING"))
+        self.assertIsNone(views.openrouter_delta(""))
+        self.assertIsNone(views.openrouter_delta('data: {"choices": [{"delta": {"role": "assistant"}}]}'))
+        self.assertIsNone(views.openrouter_delta('data: {"choices": []}'))
+
+    def stream(self, lines, fmt="sse"):
+        upstream = mock.Mock()
+        upstream.iter_lines.return_value = [line.encode() for line in lines]
+        body = json.dumps({"message": "hi", "stream": True, "format": fmt})
+        with mock.patch.object(views.outbound, "client") as client:
+            client.return_value.post.return_value = upstream
+            response = views.bot(RequestFactory().post("/bot/", body, content_type="application/json"))
+            return response, b"".join(response.streaming_content).decode()
+
+    def test_sse_frames(self):
+        lines = [": OPENROUTER PROCESSING", "", 'data: {"choices": [{"delta": {"content": "Hé"}}]}', "",
+                 'data: {"choices": [{"delta": {"content": "llo"}}]}', "data: [DONE]"]
+        response, body = self.stream(lines)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(body, 'data: {"delta": "Hé"}\n\ndata: {"delta": "llo"}\n\ndata: {"done": true}\n\n')
+        # The finished answer is cached and streams back whole next time
+        _, body = self.stream([], fmt="ndjson")
+        self.assertEqual(body, '{"delta": "Héllo", "source": "exact"}\n{"done": true}\n')
+
+    def test_upstream_failure_is_an_error_event(self):
+        response, body = self.stream(["data: {not json"])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(body.startswith('data: {"error": '))
+        self.assertTrue(body.endswith("\n\n"))
+
+
+class OutboundRetryTests(SimpleTestCase):
+    def serve(self, statuses):
+        # A local upstream answering with the given statuses in turn, Retry-After: 1 on refusals
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                seen.append(time.monotonic())
+                status = statuses[min(len(seen), len(statuses)) - 1]
+                self.send_response(status)
+                if status in outbound.RETRY_STATUSES:
+                    self.send_header("Retry-After", "1")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f"http://127.0.0.1:{server.server_port}", seen
+
+    def test_refusal_is_retried_after_retry_after(self):
+        url, seen = self.serve([503, 200])
+        upstream = outbound.Upstream("test-retry", url, retries=1, backoff=0)
+        self.addCleanup(upstream.close)
+        self.assertEqual(upstream.post("/chat", json={}).status_code, 200)
+        self.assertEqual(len(seen), 2)
+        self.assertGreaterEqual(seen[1] - seen[0], 0.9)
+        self.assertEqual(upstream.stats.snapshot()["outcomes"], {"2xx": 1})
+
+    def test_refusals_past_the_retries_come_back_and_count_as_errors(self):
+        url, seen = self.serve([429, 429])
+        upstream = outbound.Upstream("test-refused", url, retries=0, backoff=0)
+        self.addCleanup(upstream.close)
+        self.assertEqual(upstream.post("/chat", json={}).status_code, 429)
+        self.assertEqual(len(seen), 1)
+        url, seen = self.serve([503])
+        upstream = outbound.Upstream("test-refused", url, retries=0, backoff=0)
+        self.addCleanup(upstream.close)
+        upstream.post("/chat", json={})
+        stats = upstream.stats.snapshot()
+        self.assertEqual(stats["outcomes"], {"4xx": 1, "5xx": 1})
+        self.assertEqual(stats["errors"], 1)
+
+    def test_async_refusal_is_retried_after_retry_after(self):
+        import httpx
+
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            if len(calls) == 1:
+                return httpx.Response(429, headers={"Retry-After": "0.2"})
+            return httpx.Response(200, json={"ok": True})
+
+        async def main():
+            upstream = outbound.AsyncUpstream("test-async-retry", "http://upstream", retries=1, backoff=0)
+            upstream.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+            started = time.monotonic()
+            response = await upstream.post("/chat", json={})
+            await upstream.client.aclose()
+            return response, time.monotonic() - started, upstream.stats.snapshot()
+
+        response, elapsed, stats = asyncio.run(main())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(calls), 2)
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertEqual(stats["outcomes"], {"4xx": 1, "2xx": 1})
+
+
+class FakeSession:
+    """Stands in for SMTPSession; fails each recipient's first sends as listed in ``errors``."""
+    errors = {}
+
+    def __init__(self, **options):
+        self.idle_timeout = 60
+        self.connects = 0
+        self.sent = []
+
+    def send(self, sender, recipient, message):
+        pending = self.errors.get(recipient)
+        if pending:
+            raise pending.pop(0)
+        self.sent.append(recipient)
+
+    def close(self):
+        pass
+
+
+class DeliveryQueueTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(otp_delivery, "SMTPSession", FakeSession)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queue(self, **options):
+        queue = otp_delivery.DeliveryQueue("noreply@x.com", {}, workers=1, backoff=0.01, **options)
+        self.addCleanup(queue.close, 1)
+        return queue
+
+    def message(self):
+        message = EmailMessage()
+        message.set_content("123456")
+        return message
+
+    def wait_for(self, queue, count, value=1):
+        deadline = time.monotonic() + 5
+        while queue.stats()[count] < value and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return queue.stats()
+
+    def test_temporary_failures_are_retried(self):
+        FakeSession.errors = {"a@x.com": [smtplib.SMTPServerDisconnected("gone"),
+                                          smtplib.SMTPResponseException(421, b"try later")]}
+        queue = self.queue()
+        delivery_id = queue.enqueue("a@x.com", self.message())
+        stats = self.wait_for(queue, "sent")
+        self.assertEqual((stats["sent"], stats["retried"], stats["failed"]), (1, 2, 0))
+        self.assertEqual(queue.status(delivery_id), {"status": "sent", "attempts": 3, "error": None})
+
+    def test_permanent_failures_are_not(self):
+        FakeSession.errors = {"b@x.com": [smtplib.SMTPRecipientsRefused({"b@x.com": (550, b"no such user")})]}
+        queue = self.queue()
+        delivery_id = queue.enqueue("b@x.com", self.message())
+        stats = self.wait_for(queue, "failed")
+        self.assertEqual((stats["failed"], stats["retried"]), (1, 0))
+        self.assertEqual(queue.status(delivery_id)["status"], "failed")
+
+    def test_retries_run_out(self):
+        FakeSession.errors = {"c@x.com": [OSError("network down")] * 3}
+        queue = self.queue(retries=2)
+        queue.enqueue("c@x.com", self.message())
+        stats = self.wait_for(queue, "failed")
+        self.assertEqual((stats["failed"], stats["retried"]), (1, 2))
+
+    def test_close_sends_waiting_retries_now(self):
+        FakeSession.errors = {"d@x.com": [OSError("network down")]}
+        queue = otp_delivery.DeliveryQueue("noreply@x.com", {}, workers=1, backoff=3600)
+        queue.enqueue("d@x.com", self.message())
+        self.wait_for(queue, "retried")
+        started = time.monotonic()
+        queue.close(timeout=5)
+        self.assertLess(time.monotonic() - started, 2)  # didn't wait out the backoff
+        self.assertEqual((queue.stats()["sent"], queue.stats()["dropped"]), (1, 0))
+
+    def test_close_logs_what_it_could_not_send(self):
+        FakeSession.errors = {}
+        queue = otp_delivery.DeliveryQueue("noreply@x.com", {}, workers=1, batch=1)
+        slow = lambda *args: time.sleep(0.5)
+        with mock.patch.object(FakeSession, "send", side_effect=slow), mock.patch("builtins.print") as log:
+            ids = [queue.enqueue("f@x.com", self.message()) for _ in range(3)]
+            queue.close(timeout=0.2)
+        self.assertEqual(queue.stats()["dropped"], 2)
+        queue._threads[0].join(5)  # the send in flight at the deadline still finishes
+        self.assertEqual(sorted(queue.status(i)["status"] for i in ids), ["dropped", "dropped", "sent"])
+        self.assertIn("dropped at shutdown", str(log.call_args_list[-1]))
+
+
+class BotMemoryTests(SimpleTestCase):
+    def test_off_by_default_so_answers_stay_cacheable(self):
+        session, messages = bot_memory.begin("a@x.com", "system", "hi")
+        self.assertIsNone(session)
+        self.assertEqual([m["role"] for m in messages], ["system", "user"])
+
+    def test_history_within_budget(self):
+        memory = bot_memory.BotMemory(history_tokens=10)
+        session = memory.session("a@x.com")
+        with mock.patch.object(memory, "_call", return_value="they said hi"):
+            memory.record(session, "hi", "hello")
+            self.assertEqual(len(memory.messages(session, "system", "again")), 4)
+            memory.record(session, "x" * 40, "y" * 40)  # over budget: summarized, not sent verbatim
+            memory._pool.shutdown(wait=True)
+        messages = memory.messages(session, "system", "again")
+        self.assertEqual(messages[1]["content"], "Earlier in this conversation: they said hi")
+        self.assertFalse(session.pairs)
+
+    def test_enabled_setting(self):
+        with override_settings(BOT_MEMORY=dict(settings.BOT_MEMORY, ENABLED=True)):
+            self.assertTrue(bot_memory.enabled())
+
+
+class OtpStatusViewTests(SimpleTestCase):
+    def test_known_and_unknown_ids(self):
+        queue = mock.Mock()
+        queue.status.side_effect = lambda i: {"status": "sent", "attempts": 1, "error": None} if i == "abc" else None
+        with mock.patch.object(otp_delivery, "get_queue", return_value=queue):
+            found = views.otp_status(RequestFactory().get("/otp/status/", {"id": "abc"}))
+            missing = views.otp_status(RequestFactory().get("/otp/status/", {"id": "nope"}))
+        self.assertEqual(json.loads(found.content)["status"], "sent")
+        self.assertEqual(missing.status_code, 404)
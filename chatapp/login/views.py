@@ -1,17 +1,20 @@
 from django.conf import settings
 from django.http import JsonResponse,HttpResponse
-import requests
+from chatapp import outbound, streaming
+from . import bot_cache, bot_memory, otp_delivery
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import redirect
+import contextlib
 import json
 import random
-import smtplib
+from urllib.parse import unquote
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 
-FIREBASE_SIGNUP_URL = f"https://identitytoolkit.googleapis.com/v1/accounts:signUp?key={settings.FIREBASE_API_KEY}"
-FIREBASE_SIGNIN_URL = f"https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={settings.FIREBASE_API_KEY}"
+# Identity Toolkit paths, relative to OUTBOUND["identitytoolkit"]["BASE_URL"]
+FIREBASE_SIGNUP_URL = f"/v1/accounts:signUp?key={settings.FIREBASE_API_KEY}"
+FIREBASE_SIGNIN_URL = f"/v1/accounts:signInWithPassword?key={settings.FIREBASE_API_KEY}"
 
 @csrf_exempt
 def signup(request):
@@ -22,7 +25,7 @@ def signup(request):
             "email": email,
             "password": password
         }
-        r = requests.post(FIREBASE_SIGNUP_URL, json=data)
+        r = outbound.client("identitytoolkit").post(FIREBASE_SIGNUP_URL, json=data)
         if r.status_code == 200:
             token = r.json()["idToken"]
             resp = JsonResponse({"message": "Signup successful"})
@@ -40,7 +43,7 @@ def login(request):
             "password": password,
             "returnSecureToken": True
         }
-        r = requests.post(FIREBASE_SIGNIN_URL, json=data)
+        r = outbound.client("identitytoolkit").post(FIREBASE_SIGNIN_URL, json=data)
         if r.status_code == 200:
             token = r.json()["idToken"]
             
@@ -57,9 +60,8 @@ def send_otp(request,email):
     try:
         otp = str(random.randint(100000, 999999))
 
-        # Sender credentials
-        sender_email = "abcdef@gmail.com"
-        sender_password = ""
+        # Sender credentials: settings.OTP_EMAIL
+        sender_email = settings.OTP_EMAIL["FROM"]
 
         message = MIMEMultipart("alternative")
         message["From"] = sender_email
@@ -84,17 +86,21 @@ def send_otp(request,email):
         message.attach(part1)
         message.attach(part2)
 
-        # Send email
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, email, message.as_string())
-        server.quit()
-        return JsonResponse({"success": True, "message": "OTP sent successfully"})
+        # Sent by a background worker over a pooled SMTP session (see otp_delivery.py)
+        delivery_id = otp_delivery.get_queue().enqueue(email, message)
+        return JsonResponse({"success": True, "message": "OTP queued", "id": delivery_id})
     except Exception as e:
         return JsonResponse({"success": False, "error": str(e)})
     
 
+def otp_status(request):
+    """Where the OTP email send_otp queued stands: ?id=<the id it returned>."""
+    status = otp_delivery.status(request.GET.get("id", ""))
+    if status is None:
+        return JsonResponse({"success": False, "error": "Unknown delivery id"}, status=404)
+    return JsonResponse(dict(status, success=True))
+
+
 @csrf_exempt
 def check_otp(request):
     if request.method == "POST":
@@ -180,11 +186,80 @@ Bot: "Quantum physics is the study of how tiny particles like electrons behave.
 user can only send messages and receive from one to one and we got chat backups if user ask for any more featurestell him it will be coming soon
 """
 
-API_URL = "https://openrouter.ai/api/v1/chat/completions"
+API_URL = "/chat/completions"  # relative to OUTBOUND["openrouter"]["BASE_URL"]
 API_KEY = ""
 
 
 
+def openrouter_delta(line):
+    """The text delta in one line of OpenRouter's SSE stream; None for keep-alives, DONE at the end."""
+    if not line.startswith("data:"):
+        return None  # blank separators and ": OPENROUTER PROCESSING" comments
+    data = line[5:].strip()
+    if data == "[DONE]":
+        return DONE
+    choices = json.loads(data).get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content")
+
+
+DONE = object()
+
+
+def complete(headers, payload):
+    """One OpenRouter completion: (answer, usage)."""
+    response = outbound.client("openrouter").post(API_URL, headers=headers, json=payload)
+    body = response.json()
+    return body["choices"][0]["message"]["content"], body.get("usage")
+
+
+def stream_bot(question, headers, payload, session=None, cache=True):
+    """Events for a streamed bot reply.
+
+    The upstream slot is taken here, before the response starts, so a
+    busy gateway raises BotBusy (a 503) instead of an error event in a
+    200 stream. Closing the generator closes the upstream request and
+    frees the slot.
+    """
+    gateway = bot_cache.get_gateway()
+    cached, how = gateway.lookup(question) if cache else (None, None)
+    if cached is not None:
+        bot_memory.record(session, question, cached)
+        return cached_events(cached, how)
+    slot = contextlib.ExitStack()
+    slot.enter_context(gateway.slot())
+    return relay_bot(slot, gateway, question, headers, payload, session, cache)
+
+
+def cached_events(answer, how):
+    yield {"delta": answer, "source": how}
+    yield {"done": True}
+
+
+def relay_bot(slot, gateway, question, headers, payload, session, cache):
+    r = None
+    try:
+        with slot:
+            r = outbound.client("openrouter").post(API_URL, headers=headers, json=dict(payload, stream=True), stream=True)
+            r.raise_for_status()
+            parts = []
+            for line in r.iter_lines():
+                delta = openrouter_delta(line.decode("utf-8"))
+                if delta is DONE:
+                    if cache:
+                        gateway.store(question, "".join(parts))
+                    bot_memory.record(session, question, "".join(parts))
+                    break
+                if delta:
+                    parts.append(delta)
+                    yield {"delta": delta}
+        yield {"done": True}
+    except Exception as e:
+        yield {"error": str(e)}
+    finally:
+        if r is not None:
+            r.close()
+
+
 @csrf_exempt
 def bot(request):
     if request.method == "POST":
@@ -198,19 +273,29 @@ def bot(request):
                 "Authorization": f"Bearer {API_KEY}",
                 "Content-Type": "application/json",
             }
+            # SYSTEM_PROMPT first and unchanged, then this user's memory (see bot_memory.py)
+            session, messages = bot_memory.begin(unquote(request.COOKIES.get("email", "")), SYSTEM_PROMPT, user_message)
+            # With earlier turns in the prompt the answer is not the question's alone
+            cache = session is None or session.empty()
             payload = {
                 "model": "gpt-oss-20b",
-                "messages": [
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    {"role": "user", "content": user_message}
-                ],
+                "messages": messages,
                 "temperature": 0.7,
                 "max_tokens": 512
             }
-            response = requests.post(API_URL, headers=headers, json=payload, timeout=60)
-            ai_response = response.json()["choices"][0]["message"]["content"]
+            # "stream": true sends tokens as they are generated (SSE, or
+            # NDJSON with "format": "ndjson") instead of one JSON at the end
+            if data.get("stream"):
+                return streaming.response(stream_bot(user_message, headers, payload, session, cache), data.get("format", "sse"))
+            # Cached, or shared with an identical request in flight (see bot_cache.py)
+            ai_response, source = bot_cache.get_gateway().answer(user_message, lambda: complete(headers, payload), cache)
+            bot_memory.record(session, user_message, ai_response)
             print(ai_response)
-            return JsonResponse({"message": ai_response})
+            return JsonResponse({"message": ai_response, "source": source})
+        except bot_cache.BotBusy as e:
+            response = JsonResponse({"error": str(e)}, status=503)
+            response["Retry-After"] = "1"
+            return response
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=500)
     return JsonResponse({"message": "Invalid request"}, status=400)
@@ -1,8 +1,10 @@
-import requests
 import json
+import re
 
-# Ollama server (change if running on another port or host)
-OLLAMA_URL = "http://127.0.0.1:11434"
+from chatapp import outbound
+
+# Ollama server: OUTBOUND["ollama"]["BASE_URL"] in settings
+# (http://127.0.0.1:11434 when run outside Django)
 
 # System prompt ensures Ollama replies with short JSON suggestions only
 SYSTEM_PROMPT = """
@@ -15,15 +17,11 @@ Rules:
 - No explanations, no extra text
 """
 
-def get_suggestions(messages, model="llama3"):
-    """
-    messages: list of dicts like [{ "role": "user", "content": "..." }]
-    returns: list of suggestion strings
-    """
+def build_payload(messages, model="llama3"):
     # Add system instructions + last 8 messages
     formatted = [{"role": "system", "content": SYSTEM_PROMPT}] + messages[-8:]
 
-    payload = {
+    return {
         "model": model,
         "messages": formatted,
         "stream": False,
@@ -35,27 +33,103 @@ def get_suggestions(messages, model="llama3"):
         }
     }
 
+
+def parse_suggestions(data):
+    raw = data.get("message", {}).get("content", "").strip()
+
+    # Parse JSON from model response
+    suggestions = []
+    try:
+        parsed = json.loads(raw)
+        if isinstance(parsed.get("suggestions"), list):
+            suggestions = [s.strip() for s in parsed["suggestions"] if isinstance(s, str)]
+    except Exception as e:
+        print("⚠️ Could not parse JSON. Raw response was:\n", raw)
+
+    return suggestions
+
+
+def get_suggestions(messages, model="llama3"):
+    """
+    messages: list of dicts like [{ "role": "user", "content": "..." }]
+    returns: list of suggestion strings
+    """
+    try:
+        r = outbound.client("ollama").post("/api/chat", json=build_payload(messages, model))
+        r.raise_for_status()
+        return parse_suggestions(r.json())
+    except Exception as e:
+        print("❌ Error:", e)
+        return []
+
+
+async def aget_suggestions(messages, model="llama3"):
+    """get_suggestions for async callers, on the async Ollama client."""
     try:
-        r = requests.post(f"{OLLAMA_URL}/api/chat", json=payload, timeout=30)
+        r = await outbound.async_client("ollama").post("/api/chat", json=build_payload(messages, model))
         r.raise_for_status()
-        data = r.json()
-        raw = data.get("message", {}).get("content", "").strip()
-
-        # Parse JSON from model response
-        suggestions = []
-        try:
-            parsed = json.loads(raw)
-            if isinstance(parsed.get("suggestions"), list):
-                suggestions = [s.strip() for s in parsed["suggestions"] if isinstance(s, str)]
-        except Exception as e:
-            print("⚠️ Could not parse JSON. Raw response was:\n", raw)
-
-        return suggestions
+        return parse_suggestions(r.json())
     except Exception as e:
         print("❌ Error:", e)
         return []
 
 
+class SuggestionStream:
+    """Pulls each suggestion out of the JSON reply as soon as its string is complete."""
+    STRING = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self):
+        self.text = ""
+        self.emitted = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+        start = self.text.find("[")
+        if start < 0:
+            return []
+        found = [json.loads(f'"{s}"').strip() for s in self.STRING.findall(self.text[start:])]
+        new, self.emitted = found[self.emitted:], len(found)
+        return [s for s in new if s]
+
+
+def stream_suggestions(messages, model="llama3"):
+    """Yield suggestions one by one while Ollama is still generating (stream: true).
+
+    Closing the generator closes the upstream connection, which stops
+    generation.
+    """
+    payload = dict(build_payload(messages, model), stream=True)
+    r = outbound.client("ollama").post("/api/chat", json=payload, stream=True)
+    try:
+        r.raise_for_status()
+        parser = SuggestionStream()
+        for line in r.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            yield from parser.feed(chunk.get("message", {}).get("content", ""))
+            if chunk.get("done"):
+                break
+    finally:
+        r.close()
+
+
+async def astream_suggestions(messages, model="llama3"):
+    """stream_suggestions for async callers."""
+    payload = dict(build_payload(messages, model), stream=True)
+    async with outbound.async_client("ollama").stream("POST", "/api/chat", json=payload) as r:
+        r.raise_for_status()
+        parser = SuggestionStream()
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            for suggestion in parser.feed(chunk.get("message", {}).get("content", "")):
+                yield suggestion
+            if chunk.get("done"):
+                break
+
+
 if __name__ == "__main__":
     # Example chat history
     chat_history = [